@@ -0,0 +1,41 @@
+"""
+    Index build throughput of `iter_instances()` on synthetic fleets.
+
+    Usage: python -m benchmarks.instances_list
+"""
+
+import time
+
+from src import cloudssh
+
+sizes = [1000, 10000, 50000, 100000, 200000]
+page_size = 1000
+
+
+def iter_pages(count):
+    """ Yield synthetic `describe_instances` reservations, one page at a time """
+
+    for start in range(0, count, page_size):
+        for i in range(start, min(start + page_size, count)):
+            yield {
+                'Instances': [{
+                    'InstanceId': 'i-%017x' % (i),
+                    'PrivateIpAddress': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                    'State': {'Name': 'running'},
+                    # Every tenth instance reuses the name of another one
+                    'Tags': [{'Key': 'Name', 'Value': 'web-%d' % (i // 10 if i % 10 == 0 else i)}],
+                }]
+            }
+
+
+def main():
+    print('%10s %10s %15s' % ('instances', 'seconds', 'instances/s'))
+    for count in sizes:
+        start = time.perf_counter()
+        n = sum(1 for _ in cloudssh.iter_instances(iter_pages(count)))
+        elapsed = time.perf_counter() - start
+        print('%10d %10.3f %15d' % (n, elapsed, n / elapsed))
+
+
+if __name__ == '__main__':
+    main()
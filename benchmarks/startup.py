@@ -0,0 +1,54 @@
+"""
+    Cold startup time of `cssh <indexed-name> --info` (an index hit).
+
+    Usage: python -m benchmarks.startup [runs]
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from statistics import median
+
+
+def timed_runs(command, env, runs):
+    """ Return the wall times of `runs` executions of a command """
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def main(runs=20):
+    with tempfile.TemporaryDirectory() as home:
+        # Config and index with 1000 instances in a temporary home directory
+        os.makedirs(home + '/.cloudssh')
+        with open(home + '/.cloudssh/cloudssh.cfg', 'w') as f:
+            f.write('[MAIN]\nregion = us-east-1\n')
+        with open(home + '/.cloudssh/index.json', 'w') as f:
+            json.dump({'default': {'us-east-1': [
+                {'name': 'web-%d' % (i), 'detail': {'id': 'i-%d' % (i), 'public_ip': '1.2.3.4', 'tags': []}}
+                for i in range(1000)]}}, f)
+
+        env = dict(os.environ, HOME=home)
+        commands = [
+            ('python', [sys.executable, '-c', 'pass']),
+            ('import boto3', [sys.executable, '-c', 'import boto3']),
+            ('cssh web-42 --info', [sys.executable, '-m', 'src.cloudssh', 'web-42', '--info']),
+        ]
+
+        print('%-20s %10s %10s %10s' % ('command', 'min (ms)', 'p50 (ms)', 'max (ms)'))
+        for label, command in commands:
+            timings = timed_runs(command, env, runs)
+            print('%-20s %10.1f %10.1f %10.1f' %
+                  (label, min(timings) * 1000, median(timings) * 1000, max(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,236 @@
+"""
+    Benchmark suite on synthetic fleets served by a stubbed EC2 backend.
+
+    For each fleet size, a child process generates paginated
+    `describe_instances` responses (duplicate names, many tags), serves them
+    with botocore's Stubber and times `build_index`, `read_index`, `search`,
+    `autocomplete`, `instance_lookup` and the cold CLI startup. Results
+    (throughput, latency percentiles, process peak RSS) are written as JSON
+    so runs can be diffed across releases. The peak RSS is the high-water mark
+    of the process running the phases in order, not the memory of one phase:
+    a phase only shows up if it raised the peak of the phases before it.
+
+    Usage: python -m benchmarks.suite [--sizes 1000,10000] [--engine json] [--queries 50] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from statistics import quantiles
+
+from src import cloudssh
+
+sizes = [1000, 10000, 50000, 100000, 200000]
+page_size = 1000
+tags_count = 12
+region_name = 'us-east-1'
+
+
+def get_page(start, count):
+    """ Return a synthetic `describe_instances` page of the instances `start` to `start + page_size` """
+
+    reservations = []
+    for i in range(start, min(start + page_size, count)):
+        reservations.append({
+            'Instances': [{
+                'InstanceId': 'i-%017x' % (i),
+                'InstanceType': 't3.micro',
+                'PublicIpAddress': '3.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                'PrivateIpAddress': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                'VpcId': 'vpc-%08x' % (i % 16),
+                'SubnetId': 'subnet-%08x' % (i % 64),
+                'State': {'Name': 'running'},
+                # Every tenth instance reuses the name of another one
+                'Tags': [{'Key': 'Name', 'Value': get_name(i // 10 if i % 10 == 0 else i)}] + [
+                    {'Key': 'tag-%d' % (t), 'Value': 'value-%d' % ((i + t) % 50)} for t in range(tags_count)],
+            }]
+        })
+
+    page = {'Reservations': reservations}
+    if start + page_size < count:
+        page['NextToken'] = str(start + page_size)
+
+    return page
+
+
+def get_name(i):
+    """ Return the synthetic name of an instance """
+
+    return '%s-%s-%d' % (('web', 'api', 'db', 'cache', 'worker')[i % 5], ('prod', 'staging', 'dev')[i % 3], i)
+
+
+def get_stubbed_client(count):
+    """ Return an EC2 client answering the paginated `describe_instances` calls of a fleet """
+
+    import boto3
+    from botocore.stub import Stubber
+
+    client = boto3.client('ec2', region_name=region_name,
+                          aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+    stubber = Stubber(client)
+    for start in range(0, max(count, 1), page_size):
+        expected = {'Filters': [cloudssh.running_filter]}
+        if start:
+            expected['NextToken'] = str(start)
+        stubber.add_response('describe_instances',
+                             get_page(start, count), expected)
+    stubber.activate()
+
+    return client
+
+
+def get_peak_rss():
+    """ Return the peak resident set size of this process in KB """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Bytes on macOS, KB on Linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def summarize(phase, count, timings):
+    """ Return the result of a phase from its timings (seconds) """
+
+    result = {
+        'phase': phase,
+        'instances': count,
+        'runs': len(timings),
+        'seconds': sum(timings),
+        # High-water mark of the whole process so far
+        'process_peak_rss_kb': get_peak_rss(),
+    }
+
+    if len(timings) > 1:
+        percentiles = quantiles(timings, n=100, method='inclusive')
+        result.update({
+            'p50_ms': percentiles[49] * 1000,
+            'p90_ms': percentiles[89] * 1000,
+            'p99_ms': percentiles[98] * 1000,
+            'max_ms': max(timings) * 1000,
+        })
+
+    return result
+
+
+def timed(function, args_list):
+    """ Call a function with each item of `args_list` and return the wall times """
+
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def run(count, engine, queries=50, startup_runs=5):
+    """ Run every phase on a fleet of `count` instances and return the results """
+
+    results = []
+    sample = random.Random(count)
+
+    with tempfile.TemporaryDirectory() as home:
+        os.makedirs(home + '/.cloudssh')
+        with open(home + '/.cloudssh/cloudssh.cfg', 'w') as f:
+            f.write('[MAIN]\nregion = %s\nindex_engine = %s\n' %
+                    (region_name, engine))
+
+        cloudssh.config_dir = home + '/.cloudssh/'
+        cloudssh.parse_user_config()
+        cloudssh.set_region()
+
+        # Responses are validated by the Stubber before the timer starts
+        client = get_stubbed_client(count)
+        cloudssh.get_aws_client = lambda region_name=None, profile_name=None: client
+
+        timings = timed(cloudssh.build_index, [()])
+        results.append(dict(summarize('build_index', count, timings),
+                            instances_per_second=count / timings[0]))
+
+        timings = timed(cloudssh.get_instances_list_from_index, [()] * 5)
+        results.append(dict(summarize('read_index', count, timings),
+                            instances_per_second=count * len(timings) / sum(timings)))
+
+        # Names of indexed instances (multiples of 10 reuse another name)
+        names = [get_name(i + 1 if i % 10 == 0 else i)
+                 for i in (sample.randrange(count - 1) for _ in range(queries))]
+
+        results.append(summarize('search', count, timed(
+            cloudssh.match_instances, [(name[:-1],) for name in names])))
+
+        results.append(summarize('autocomplete', count, timed(
+            cloudssh.complete_prefix, [(name[:len(name) // 2],) for name in names])))
+
+        results.append(summarize('instance_lookup', count, timed(
+            cloudssh.instance_lookup, [(name,) for name in names])))
+
+        # Cold interpreter resolving an indexed name
+        command = [sys.executable, '-m', 'src.cloudssh', names[0], '--info']
+        env = dict(os.environ, HOME=home)
+        timings = timed(lambda: subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True),
+                        [()] * startup_runs)
+        result = summarize('cli_startup', count, timings)
+        # Largest CLI process
+        result['process_peak_rss_kb'] = resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss
+        results.append(result)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default=','.join(str(size) for size in sizes),
+                        help='Comma separated fleet sizes')
+    parser.add_argument('--engine', default='json',
+                        choices=['json', 'sqlite', 'mmap', 'sharded'])
+    parser.add_argument('--queries', type=int, default=50,
+                        help='Number of timed searches, completions and lookups per fleet')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Measure one fleet size and print its results (peak RSS is per process)
+    if args.child is not None:
+        print(json.dumps(run(args.child, args.engine, args.queries)))
+        return
+
+    results = []
+    print('%10s %-16s %10s %10s %10s %10s %12s' %
+          ('instances', 'phase', 'seconds', 'p50 (ms)', 'p99 (ms)', 'inst/s', 'proc peak KB'))
+    for count in [int(size) for size in args.sizes.split(',')]:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.suite', '--child', str(count),
+             '--engine', args.engine, '--queries', str(args.queries)],
+            stdout=subprocess.PIPE, check=True).stdout
+        for result in json.loads(output):
+            results.append(result)
+            print('%10d %-16s %10.3f %10s %10s %10s %12d' % (
+                count, result['phase'], result['seconds'],
+                '%.2f' % result['p50_ms'] if 'p50_ms' in result else '',
+                '%.2f' % result['p99_ms'] if 'p99_ms' in result else '',
+                '%d' % result['instances_per_second'] if 'instances_per_second' in result else '',
+                result['process_peak_rss_kb']))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'engine': args.engine,
+            'timestamp': time.time(),
+            'results': results,
+        }, f, indent=2)
+
+    print('Results stored in %s.' % (args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,43 @@
 import subprocess
 import configparser
-from sys import argv, exit
+from sys import argv, exit, executable
 import os
 import json
-import readline
-
-import boto3
+import time
+import threading
 import argparse
+from contextlib import contextmanager
+
+# `readline` and `boto3` are imported where they are used so an instance
+# found in the local index does not pay for the AWS SDK import
 
 region = None
 user_config = None
+user_config_sections = {}
 config_dir = '~/.cloudssh/'
 
+# Names used by the auto-completion, kept until the index changes
+completion_cache = {}
+
+# Durations recorded by `timed_phase()` and AWS calls counted by `count_aws_calls()`,
+# `depth` is the nesting depth of the main thread
+timings = {'started_at': time.monotonic(), 'phases': [], 'depth': 0,
+           'aws': {'requests': 0, 'retries': 0, 'bytes': 0}}
+timings_lock = threading.Lock()
+
+# Nesting depth of the phases of a worker thread
+timings_local = threading.local()
+
+# Sessions of the roles of the `[ROLES]` section as `{account: (session, expiration)}`
+role_sessions = {}
+role_sessions_lock = threading.Lock()
+
+# Serializes the writers of the route cache within a process (`flock` across processes)
+route_cache_lock = threading.Lock()
+
+# Server-side filter of the running instances
+running_filter = {'Name': 'instance-state-name', 'Values': ['running']}
+
 # Sourced from https://docs.aws.amazon.com/general/latest/gr/rande.html
 regions = ['us-east-2', 'us-east-1', 'us-west-1', 'us-west-2', 'ap-south-1',
            'ap-northeast-3', 'ap-northeast-2', 'ap-southeast-1', 'ap-southeast-2',
@@ -25,22 +51,59 @@ def parse_cli_args():
     # Parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("-r", "--region", type=str,
-                        help="Region", choices=regions, nargs='?')
+                        help="Region", nargs='?')
     parser.add_argument('instance', nargs='*')
-    parser.add_argument("-b", "--build_index", action='store_true',
-                        help="Build a local index of your AWS instances")
+    parser.add_argument("-b", "--build_index", nargs='*', metavar='PROFILE',
+                        help="Build a local index of your AWS instances (optionally for a list of AWS profiles)")
+    parser.add_argument("--all-regions", dest='all_regions', action='store_true',
+                        help="Index every AWS region enabled for the account (use with --build_index)")
+    parser.add_argument("--export-ssh-config", dest='export_ssh_config', action='store_true',
+                        help="Write the index as an ssh_config include file")
+    parser.add_argument("--refresh", action='store_true',
+                        help="Incrementally refresh the regions of the index older than `index_ttl`")
     parser.add_argument("-s", "--search",
-                        help="Search an instance")
+                        help="Search an instance by name or by tags (e.g. 'env=prod role~web*')")
+    parser.add_argument("-f", "--fuzzy", action='store_true',
+                        help="Ranked search tolerant to typos (use with --search)")
+    parser.add_argument("--limit", type=int, default=10,
+                        help="Maximum number of fuzzy search results")
+    parser.add_argument("-p", "--probe", action='store_true',
+                        help="Probe port 22 of every candidate and select the fastest reachable one")
     parser.add_argument("-i", "--info", action='store_true',
                         help="Display instance information (ID, IPs)")
+    parser.add_argument("-e", "--exec", dest='exec_command', metavar='COMMAND',
+                        help="Run a command on every instance matching a name or tag query")
+    parser.add_argument("--parallel", type=int,
+                        help="Maximum number of concurrent connections with --exec")
+    parser.add_argument("--close", action='store_true',
+                        help="Close the multiplexed SSH connection of an instance")
+    parser.add_argument("--completion", choices=['bash', 'zsh', 'fish'],
+                        help="Print a shell completion script (e.g. `source <(cssh --completion bash)`)")
+    parser.add_argument("--timings", action='store_true',
+                        help="Print the duration of each phase and the AWS requests on exit")
+    parser.add_argument("--daemon", action='store_true',
+                        help="Run a resolver daemon keeping the index and AWS clients warm")
     args = parser.parse_args()
 
     return {
         'region': args.region,
         'instance': args.instance[0] if type(args.instance) is list and len(args.instance) > 0 else None,
-        'build_index': args.build_index if args.build_index else False,
+        'build_index': args.build_index is not None,
+        'profiles': args.build_index if args.build_index else None,
+        'all_regions': args.all_regions if args.all_regions else False,
+        'refresh': args.refresh if args.refresh else False,
+        'export_ssh_config': args.export_ssh_config if args.export_ssh_config else False,
         'search': args.search if args.search else None,
+        'fuzzy': args.fuzzy if args.fuzzy else False,
+        'limit': args.limit if args.limit else 10,
+        'probe': args.probe if args.probe else False,
         'info': args.info if args.info else None,
+        'exec': args.exec_command if args.exec_command else None,
+        'parallel': args.parallel if args.parallel else None,
+        'close': args.close if args.close else False,
+        'completion': args.completion if args.completion else None,
+        'timings': args.timings if args.timings else False,
+        'daemon': args.daemon if args.daemon else False,
     }
 
 
@@ -53,11 +116,17 @@ def parse_user_config(filename='cloudssh.cfg'):
     full_path = resolve_home(config_dir) + filename
 
     user_config = None
+    user_config_sections.clear()
     if os.path.isfile(full_path):
         config = configparser.ConfigParser()
         config.read(full_path)
         user_config = config['MAIN']
 
+        # Other sections (e.g. `[BASTIONS]`)
+        for section in config.sections():
+            if section != 'MAIN':
+                user_config_sections[section] = dict(config[section])
+
     return user_config
 
 
@@ -71,6 +140,12 @@ def get_value_from_user_config(item):
             pass
 
 
+def get_user_config_section(section):
+    """ Return the items of a section of the user config other than [MAIN] """
+
+    return user_config_sections.get(section, {})
+
+
 def set_region(from_args=None, default='us-east-1'):
     """ Set AWS region """
 
@@ -85,18 +160,183 @@ def set_region(from_args=None, default='us-east-1'):
         region = default
 
     if region not in regions:
-        raise RuntimeError('%s is not a valid AWS region' % (region))
+        # Regions discovered by `--all-regions` are selectable once indexed
+        indexed = os.path.exists(resolve_home(config_dir) + get_index_filename())
+        if not indexed or region not in [region_name for profile_name, region_name in get_index_regions()]:
+            raise RuntimeError('%s is not a valid AWS region' % (region))
 
     return region
 
 
-def get_aws_client():
+def get_index_workers(default=8):
+    """ Return the number of concurrent workers used to build the index """
+
+    workers = get_value_from_user_config('index_workers')
+
+    return int(workers) if workers else default
+
+
+def get_index_ttl(default=3600):
+    """ Return the number of seconds an indexed region is considered fresh """
+
+    ttl = get_value_from_user_config('index_ttl')
+
+    return int(ttl) if ttl else default
+
+
+def get_profile_key(profile_name=None):
+    """ Return the name of a profile in the index """
+
+    return profile_name or get_value_from_user_config('aws_profile_name') or 'default'
+
+
+def get_index_profiles(from_args=None):
+    """ Return the list of AWS profiles to index or None for the default profile """
+
+    if from_args:  # Read from CLI args
+        return from_args
+
+    # Read from config file
+    profiles = get_value_from_user_config('aws_profile_names')
+    if profiles:
+        return [p.strip() for p in profiles.split(',') if p.strip()]
+
+    return None
+
+
+def get_partition(region_name=None):
+    """ Return the AWS partition of a region (`aws`, `aws-cn`, `aws-us-gov`...) """
+
+    region_name = region_name or region
+
+    if region_name.startswith('cn-'):
+        return 'aws-cn'
+    if region_name.startswith('us-gov-'):
+        return 'aws-us-gov'
+    if region_name.startswith('us-isob-'):
+        return 'aws-iso-b'
+    if region_name.startswith('us-iso-'):
+        return 'aws-iso'
+
+    return 'aws'
+
+
+def get_role_arns():
+    """
+        Return the roles of the `[ROLES]` section as `{account ID: role ARN}`:
+        the `role_arns` list and the `role_name` role of each of the `accounts`,
+        in the `partition` of the section or of the active region.
+    """
+
+    roles = get_user_config_section('ROLES')
+
+    arns = [arn.strip() for arn in roles.get('role_arns', '').split(',') if arn.strip()]
+    role_name = roles.get('role_name', 'OrganizationAccountAccessRole').strip()
+    partition = roles.get('partition', '').strip() or get_partition()
+    arns += ['arn:%s:iam::%s:role/%s' % (partition, account.strip(), role_name)
+             for account in roles.get('accounts', '').split(',') if account.strip()]
+
+    accounts = {}
+    for arn in arns:
+        parts = arn.split(':')
+        if len(parts) < 6 or not parts[4]:
+            raise RuntimeError('%s is not a valid role ARN' % (arn))
+        accounts[parts[4]] = arn
+
+    return accounts
+
+
+def get_role_session(account):
+    """ Return a boto3 session with the credentials of the role of an account, assumed once until it expires """
+
+    with role_sessions_lock:
+        if account in role_sessions:
+            session, expiration = role_sessions[account]
+            if expiration - time.time() > 60:
+                return session
+
+    import boto3
+
+    roles = get_user_config_section('ROLES')
+    params = {'RoleArn': get_role_arns()[account],
+              'RoleSessionName': roles.get('session_name', 'cloudssh')}
+    if roles.get('external_id'):
+        params['ExternalId'] = roles['external_id']
+
+    # Roles are assumed from the identity of `source_profile` (default credentials otherwise)
+    with timed_phase('assume_role'):
+        client = count_aws_calls(boto3.Session(profile_name=roles.get(
+            'source_profile')).client('sts', region_name=region))
+        credentials = client.assume_role(**params)['Credentials']
+
+    session = boto3.Session(aws_access_key_id=credentials['AccessKeyId'],
+                            aws_secret_access_key=credentials['SecretAccessKey'],
+                            aws_session_token=credentials['SessionToken'])
+    with role_sessions_lock:
+        role_sessions[account] = (
+            session, credentials['Expiration'].timestamp())
+
+    return session
+
+
+def assume_roles(accounts):
+    """ Assume the roles of several accounts concurrently, returns the accounts whose role was assumed """
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    assumed = []
+    with ThreadPoolExecutor(max_workers=get_index_workers()) as executor:
+        futures = {executor.submit(get_role_session, account): account
+                   for account in accounts}
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+                assumed.append(futures[future])
+            except Exception as e:  # Role missing or not trusting the source identity
+                print('Unable to assume %s: %s' %
+                      (get_role_arns()[futures[future]], e))
+
+    return assumed
+
+
+def get_aws_client(region_name=None, profile_name=None):
     """ Return an instance of the AWS client """
 
-    # Client connection
-    session = boto3.Session(
-        profile_name=get_value_from_user_config('aws_profile_name'))
-    return session.client("ec2", region_name=region)
+    with timed_phase('import boto3'):
+        import boto3
+
+    # Client connection (credentials resolution)
+    with timed_phase('get_aws_client'):
+        profile_name = profile_name or get_value_from_user_config(
+            'aws_profile_name')
+        if profile_name in get_role_arns():  # Account of the `[ROLES]` section
+            session = get_role_session(profile_name)
+        else:
+            session = boto3.Session(profile_name=profile_name)
+        client = session.client("ec2", region_name=region_name or region)
+
+    return count_aws_calls(client)
+
+
+def count_aws_calls(client):
+    """ Count the requests, retries and response bytes of a boto3 client """
+
+    def after_call(http_response=None, parsed=None, **kwargs):
+        try:
+            size = len(http_response.content)
+        except Exception:  # No raw response (e.g. stubbed)
+            size = 0
+
+        with timings_lock:
+            timings['aws']['requests'] += 1
+            timings['aws']['retries'] += (parsed or {}).get(
+                'ResponseMetadata', {}).get('RetryAttempts', 0)
+            timings['aws']['bytes'] += size
+
+    client.meta.events.register('after-call', after_call)
+
+    return client
 
 
 def is_instance_id(instance):
@@ -108,36 +348,83 @@ def is_instance_id(instance):
     return False
 
 
+def is_ip_address(instance):
+    """ Return True if the user input is an IP address """
+
+    import ipaddress
+
+    try:
+        ipaddress.ip_address(instance)
+        return True
+    except ValueError:
+        return False
+
+
+def get_lookup_filters(instance, private=None):
+    """
+        Return the `describe_instances` filters matching a name or an IP address.
+        An IP address is matched as a private IP if it is not a global address
+        (RFC 1918, 100.64.0.0/10...) unless `private` says otherwise.
+    """
+
+    import ipaddress
+
+    if is_ip_address(instance):
+        # Private and public IPs are different filters
+        if private is None:
+            private = not ipaddress.ip_address(instance).is_global
+        name = 'private-ip-address' if private else 'ip-address'
+    else:
+        name = 'tag:Name'
+
+    return [{'Name': name, 'Values': [instance]}]
+
+
 def aws_lookup(client, instance=None, max_results=5):
     """ Lookup for instances in AWS """
 
-    Filters = []
+    # Only running instances can be reached, let AWS skip the others
+    Filters = [running_filter]
 
     if instance:
-        if is_instance_id(instance) is False:  # Lookup by name
-            Filters = [
-                {
-                    'Name': 'tag:Name',
-                    'Values': [instance]
-                },
-            ]
+        if is_instance_id(instance) is False:  # Lookup by name or IP address
+            Filters = get_lookup_filters(instance) + Filters
         else:  # Lookup by AWS instance ID
             return client.describe_instances(
                 InstanceIds=[instance]
             )
 
-    # Search instances
+    response = describe_instances(client, Filters, max_results)
+
+    # VPCs can use any range privately: match an unknown IP with the other filter
+    if instance and is_ip_address(instance) and not response['Reservations']:
+        private = Filters[0]['Name'] != 'private-ip-address'
+        Filters = get_lookup_filters(instance, private) + Filters[1:]
+        response = describe_instances(client, Filters, max_results)
+
+    return response
+
+
+def describe_instances(client, Filters, max_results=5):
+    """ Search instances, following every page of results if `max_results` is None """
+
     if max_results:
-        response = client.describe_instances(
+        return client.describe_instances(
             Filters=Filters,
             MaxResults=max_results
         )
-    else:
-        response = client.describe_instances(
-            Filters=Filters
-        )
 
-    return response
+    # Follow `NextToken` through every page of results
+    return {'Reservations': list(iter_reservations(client, Filters))}
+
+
+def iter_reservations(client, Filters=None):
+    """ Yield the reservations of every `describe_instances` page as they arrive """
+
+    paginator = client.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=Filters or []):
+        for reservation in page['Reservations']:
+            yield reservation
 
 
 def get_instance_infos(reservations):
@@ -150,7 +437,7 @@ def get_instance_infos(reservations):
     # Get first instance
     reservation = reservations[0]['Instances'][0]
 
-    if reservation.get('PublicIpAddress'):
+    if reservation.get('PublicIpAddress') or reservation.get('PrivateIpAddress'):
         return {
             'id': reservation['InstanceId'],
             'public_ip': reservation.get('PublicIpAddress'),
@@ -162,11 +449,11 @@ def get_instance_infos(reservations):
             'tags': reservation.get('Tags'),
         }
 
-    print('No public IP found for this instance.')
+    print('No IP address found for this instance.')
     exit()
 
 
-def get_ssh_command(public_ip, user=None, proxyjump=None, flag=None):
+def get_ssh_command(public_ip, user=None, proxyjump=None, flag=None, control_path=None, control_persist=None):
     """ Return SSH command  """
 
     command = ['ssh']
@@ -177,6 +464,11 @@ def get_ssh_command(public_ip, user=None, proxyjump=None, flag=None):
     if flag:
         command.extend([flag.strip()])
 
+    if control_path:  # Connection multiplexing
+        command.extend(['-o', 'ControlMaster=auto',
+                        '-o', 'ControlPath=%s' % (control_path),
+                        '-o', 'ControlPersist=%s' % (control_persist or '10m')])
+
     if user:
         command.extend(['%s@%s' % (user, public_ip)])
     else:
@@ -185,10 +477,181 @@ def get_ssh_command(public_ip, user=None, proxyjump=None, flag=None):
     return command
 
 
+def get_control_path(instance_id):
+    """ Return the path of the SSH control socket of an instance or None if multiplexing is disabled """
+
+    if not instance_id or get_value_from_user_config('ssh_multiplexing') == 'false':
+        return None
+
+    return resolve_home(config_dir) + 'cm/' + instance_id
+
+
+def get_instance_ssh_command(ip, instance_id=None, proxyjump=None):
+    """ Return the SSH command of an instance using the user config and the proxy jump of its route """
+
+    control_path = get_control_path(instance_id)
+    if control_path:
+        os.makedirs(os.path.dirname(control_path), mode=0o700, exist_ok=True)
+
+    return get_ssh_command(
+        public_ip=ip,
+        user=get_value_from_user_config('ssh_user'),
+        proxyjump=proxyjump,
+        flag=get_value_from_user_config('ssh_flag'),
+        control_path=control_path,
+        control_persist=get_value_from_user_config('ssh_control_persist')
+    )
+
+
+def get_bastion(detail):
+    """ Return the bastion of an instance subnet or VPC from the `[BASTIONS]` section or None """
+
+    bastions = get_user_config_section('BASTIONS')
+    for key in (detail.get('subnet'), detail.get('vpc')):
+        if key and bastions.get(key.lower()):
+            return bastions[key.lower()].strip()
+
+    return None
+
+
+def get_route_cache_path():
+    """ Return the path of the file storing the last working route of each VPC """
+
+    return resolve_home(config_dir) + 'routes.json'
+
+
+def read_route_cache():
+    """ Return the last working route of each VPC """
+
+    path = get_route_cache_path()
+    if not os.path.isfile(path):
+        return {}
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:  # Corrupted cache
+        return {}
+
+
+def save_route(vpc, route):
+    """ Remember the route that worked for a VPC """
+
+    from . import storage
+
+    if not vpc or read_route_cache().get(vpc) == route:
+        return False
+
+    path = get_route_cache_path()
+    with route_cache_lock, storage.locked(path):
+        # Merge in the routes saved by the other writers
+        routes = read_route_cache()
+        if routes.get(vpc) == route:
+            return False
+        routes[vpc] = route
+        with storage.open_atomically(path) as f:
+            json.dump(routes, f)
+
+    return True
+
+
+def get_routes(detail, order=None, route_cache=None):
+    """
+        Return the candidate routes of an instance as `{'route', 'ip', 'proxyjump'}`
+        in the `ssh_routes` order, the last working route of its VPC first.
+        `ssh_proxyjump` only applies to the public IP and the private IP is
+        dialed directly, so probing a private route probes the instance itself.
+    """
+
+    bastion = get_bastion(detail)
+
+    candidates = {
+        'private': {'route': 'private', 'ip': detail.get('private_ip'), 'proxyjump': None},
+        'bastion': {'route': 'bastion', 'ip': detail.get('private_ip') if bastion else None, 'proxyjump': bastion},
+        'public': {'route': 'public', 'ip': detail.get('public_ip'), 'proxyjump': get_value_from_user_config('ssh_proxyjump')},
+    }
+
+    # The public IP first unless configured
+    order = list(order or [route.strip() for route in (get_value_from_user_config(
+        'ssh_routes') or 'public, bastion, private').split(',')])
+
+    if route_cache is None:
+        route_cache = read_route_cache()
+    cached = route_cache.get(detail.get('vpc'))
+    if cached in order:
+        order.remove(cached)
+        order.insert(0, cached)
+
+    return [candidates[route] for route in order if route in candidates and candidates[route]['ip']]
+
+
+def get_probe_target(route):
+    """ Return the `(host, port)` reached first by a route: its proxy jump or the instance """
+
+    if not route['proxyjump']:
+        return (route['ip'], 22)
+
+    # First hop of `[user@]host[:port][,...]`
+    host = route['proxyjump'].split(',')[0].rsplit('@', 1)[-1]
+    if host.count(':') == 1:
+        host, port = host.split(':')
+        return (host, int(port))
+
+    return (host, 22)
+
+
+def get_cached_route(detail, routes):
+    """ Return the route of `routes` that last worked for the VPC of an instance or None """
+
+    cached = read_route_cache().get(detail.get('vpc'))
+
+    return next((route for route in routes if route['route'] == cached), None)
+
+
+def select_route(detail, routes=None):
+    """
+        Return the first reachable route of an instance (the routes are probed
+        at once) and remember it for its VPC
+    """
+
+    from . import probe
+
+    routes = routes or get_routes(detail)
+    if not routes:
+        print('No IP address found for this instance.')
+        exit()
+
+    # Nothing to choose from, or the multiplexed connection is already open
+    control_path = get_control_path(detail.get('id'))
+    if len(routes) == 1 or (control_path and os.path.exists(control_path)):
+        return routes[0]
+
+    targets = [get_probe_target(route) for route in routes]
+    latencies = probe.probe(set(targets), timeout=get_probe_timeout())
+
+    for route, target in zip(routes, targets):
+        if latencies.get(target) is not None:
+            save_route(detail.get('vpc'), route['route'])
+            return route
+
+    # Nothing answered, let SSH report the error
+    return routes[0]
+
+
+def get_close_command(ip, instance_id):
+    """ Return the command closing the multiplexed connection of an instance or None """
+
+    control_path = get_control_path(instance_id)
+    if not control_path or not os.path.exists(control_path):
+        return None
+
+    return ['ssh', '-o', 'ControlPath=%s' % (control_path), '-O', 'exit', ip]
+
+
 def ssh_subprocess(ssh_command):
-    """ Open an ssh subprocess """
+    """ Open an ssh subprocess and return its exit code """
 
-    subprocess.call(ssh_command)
+    return subprocess.call(ssh_command)
 
 
 def resolve_home(path):
@@ -214,16 +677,14 @@ def mkdir(path):
     return True
 
 
-def get_instances_list(reservations):
-    """ Return a list of instance names from reservations """
-
-    if len(reservations) == 0:
-        print('No instances found.')
-        exit()
+def iter_instances(reservations):
+    """
+        Yield the index records of the running instances of an iterable of
+        reservations (e.g. streamed from the `describe_instances` paginator)
+    """
 
-    # List instances
-    instances_list = []
-    instances_names = []
+    # Number of instances seen for each case folded name
+    names_count = {}
     for reservation in reservations:
         for instance in reservation['Instances']:
             # Skip non running instances
@@ -231,250 +692,1232 @@ def get_instances_list(reservations):
                 continue
 
             # Lookup instance name
-            if instance.get('Tags') and len(instance['Tags']) > 0:
-                for tag in instance['Tags']:
-                    if tag.get('Key') and tag['Key'] == 'Name':
-                        # Suffix if multiple instances have the same name
-                        n = len(
-                            [i for i in instances_names if i.lower() == tag['Value'].lower()])
-                        suffix = '#' + str(n).zfill(2) if n > 0 else ''
+            for tag in instance.get('Tags') or []:
+                if tag.get('Key') and tag['Key'] == 'Name':
+                    # Suffix if multiple instances have the same name
+                    folded = tag['Value'].lower()
+                    n = names_count.get(folded, 0)
+                    names_count[folded] = n + 1
+                    suffix = '#' + str(n).zfill(2) if n > 0 else ''
+
+                    yield {
+                        'name': tag['Value'] + suffix,
+                        'detail': {
+                            'id': instance['InstanceId'],
+                            'public_ip': instance.get('PublicIpAddress'),
+                            'private_ip': instance.get('PrivateIpAddress'),
+                            'type': instance.get('InstanceType'),
+                            'vpc': instance.get('VpcId'),
+                            'subnet': instance.get('SubnetId'),
+                            'launch_date': str(instance.get('LaunchTime')) if instance.get('LaunchTime') else None,
+                            'tags': instance.get('Tags'),
+                        }
+                    }
 
-                        instances_list.append(
-                            {
-                                'name': tag['Value'] + suffix,
-                                'detail': {
-                                    'id': instance['InstanceId'],
-                                    'public_ip': instance.get('PublicIpAddress'),
-                                    'private_ip': instance.get('PrivateIpAddress'),
-                                    'type': instance.get('InstanceType'),
-                                    'vpc': instance.get('VpcId'),
-                                    'subnet': instance.get('SubnetId'),
-                                    'launch_date': str(instance.get('LaunchTime')) if instance.get('LaunchTime') else None,
-                                    'tags': instance.get('Tags'),
-                                }
-                            }
-                        )
 
-                        instances_names.append(tag['Value'])
+def get_instances_list(reservations):
+    """ Return a list of instance names from reservations """
 
-    return instances_list
+    if len(reservations) == 0:
+        print('No instances found.')
+        exit()
 
+    return list(iter_instances(reservations))
 
-def read_index(filename):
-    """ Read index file """
 
-    if os.path.isfile(resolve_home(config_dir) + filename):
-        with open(resolve_home(config_dir) + filename, 'r') as f:
-            content = f.read()
-            return json.loads(content)
+def get_refreshed_at(index, profile_name=None, region_name=None):
+    """ Return the last refresh timestamp of a profile/region or None """
 
-    return {}
+    return index.get('_refreshed_at', {}).get(
+        get_profile_key(profile_name), {}).get(region_name or region)
 
 
-def write_index(filename, content={}):
-    """ Write index file """
+def is_index_fresh(index, profile_name=None, region_name=None, ttl=None):
+    """ Returns True if a profile/region was refreshed less than `ttl` seconds ago """
 
-    with open(resolve_home(config_dir) + filename, 'w') as f:
-        content = json.dumps(content)
-        f.write(content)
+    refreshed_at = get_refreshed_at(index, profile_name, region_name)
+    if refreshed_at is None:
+        return False
 
-        return True
+    return time.time() - refreshed_at < (ttl if ttl is not None else get_index_ttl())
 
 
-def append_to_index(existing_index, new):
-    """ Add new values to the index """
+def merge_instances_list(existing, new):
+    """
+        Merge a freshly fetched instances list into an existing one.
+        Unchanged records are kept as is, new and changed records are taken
+        from `new` and records missing from `new` are dropped.
+        Returns the merged list and a count of the changes.
+    """
 
-    # Set profile name
-    profile_name = get_value_from_user_config('aws_profile_name') or 'default'
+    existing_by_id = {i.get('detail', {}).get('id'): i for i in existing}
+
+    merged = []
+    changes = {'new': 0, 'changed': 0, 'removed': 0}
+    for instance in new:
+        previous = existing_by_id.pop(instance['detail']['id'], None)
+        if previous is None:
+            changes['new'] += 1
+            merged.append(instance)
+        elif previous == instance:
+            merged.append(previous)
+        else:
+            changes['changed'] += 1
+            merged.append(instance)
 
-    if not existing_index.get(profile_name):
-        existing_index[profile_name] = {}
+    # Remaining instances have been terminated or stopped
+    changes['removed'] = len(existing_by_id)
 
-    existing_index[profile_name][region] = new
+    return merged, changes
 
-    return existing_index
 
+def iter_region_instances(region_name, profile_name=None):
+    """ Return an iterator on the index records of a region, fed page by page """
 
-def build_index(filename='index.json'):
-    """ Build instance index """
+    client = get_aws_client(region_name=region_name,
+                            profile_name=profile_name)
 
-    # Create config directory if necessary
-    if not is_dir(config_dir):
-        mkdir(config_dir)
+    # Pages are processed and released one at a time
+    return iter_instances(iter_reservations(client, [running_filter]))
 
-    # Read existing index
-    index = read_index(filename)
 
-    # Get instances list
-    response = aws_lookup(
-        client=get_aws_client(),
-        max_results=None
-    )
+def get_region_instances(region_name, profile_name=None):
+    """ Return the instances list of a region, or an empty list """
 
-    # Get instance names
-    instances_list = get_instances_list(response['Reservations'])
+    return list(iter_region_instances(region_name, profile_name))
 
-    # Build new index
-    index = append_to_index(index, instances_list)
 
-    # Write index to file
-    write_index(filename=filename, content=index)
+def aws_search(query):
+    """ Return the running instances whose name contains `query` (case sensitive) from AWS """
 
-    return True
+    client = get_aws_client()
 
+    with timed_phase('describe_instances'):
+        return list(iter_instances(iter_reservations(
+            client, [{'Name': 'tag:Name', 'Values': ['*%s*' % (query)]}, running_filter])))
 
-def search(query):
-    """ Search an instance by name """
 
-    instances_list = get_instances_list_from_index()
+def get_enabled_regions(profile_name=None):
+    """ Return the regions enabled for the account of a profile, in its partition """
 
-    # Get matches
-    matches = [s for s in instances_list if query.lower() in s['name'].lower()]
+    client = get_aws_client(profile_name=profile_name)
 
-    if matches:
-        if len(matches) > 1:
-            print('Results:')
-            for match in matches:
-                print('* %s' % match['name'])
-            exit()
-        else:
-            if confirm('Found "%s", continue?' % matches[0]['name'], True):
-                return 'index', matches[0]['detail']
-    else:
-        print('No result!')
-        exit()
+    try:
+        # Opt-in regions that are not enabled are left out
+        with timed_phase('describe_regions'):
+            response = client.describe_regions()
+        return sorted(r['RegionName'] for r in response['Regions'])
+    except Exception:  # Not allowed to describe the regions
+        import boto3
+        return boto3.Session().get_available_regions('ec2', partition_name=client.meta.partition)
 
 
-def confirm(prompt=None, resp=False):
-    """
-        Source: http://code.activestate.com/recipes/541096-prompt-the-user-for-confirmation/
-        prompts for yes or no response from the user. Returns True for yes and
-        False for no.
-        'resp' should be set to the default value assumed by the caller when
-        user simply types ENTER.
-        >>> confirm(prompt='Create Directory?', resp=True)
-        Create Directory? [y]|n:
-        True
-    """
+def get_enabled_targets(profiles=None):
+    """ Return the `(profile_name, region_name)` pairs of the regions enabled for each profile, queried concurrently """
 
-    if prompt is None:
-        prompt = 'Confirm'
+    from concurrent.futures import ThreadPoolExecutor
 
-    if resp:
-        prompt = '%s [Y/n]: ' % (prompt)
-    else:
-        prompt = '%s [y/N]: ' % (prompt)
+    profiles = profiles or [None]
+    with ThreadPoolExecutor(max_workers=get_index_workers()) as executor:
+        futures = [executor.submit(get_enabled_regions, profile_name)
+                   for profile_name in profiles]
 
-    while True:
-        ans = input(prompt)
-        if not ans:
-            return resp
-        if ans not in ['y', 'Y', 'n', 'N']:
-            print('please enter y or n.')
-            continue
-        if ans == 'y' or ans == 'Y':
-            return True
-        if ans == 'n' or ans == 'N':
-            return False
+    targets = []
+    for profile_name, future in zip(profiles, futures):
+        try:
+            targets += [(profile_name, region_name)
+                        for region_name in future.result()]
+        except Exception as e:  # Invalid profile or role that can't be assumed
+            print('Unable to list the regions of %s: %s' %
+                  (profile_name or 'default', e))
 
+    return targets
 
-def get_instances_list_from_index(filename='index.json'):
 
-    # Read index
-    index = read_index(filename)
+def fetch_targets(targets):
+    """ Fetch the instances of a list of `(profile_name, region_name)` concurrently """
 
-    # Set profile name
-    profile_name = get_value_from_user_config('aws_profile_name') or 'default'
+    from concurrent.futures import ThreadPoolExecutor, as_completed
 
-    # If there is no data for this profile name, return an empty list
-    if not index.get(profile_name):
-        return []
+    # Roles are assumed once per account before fetching its regions
+    accounts = {profile_name for profile_name, region_name in targets
+                if profile_name in get_role_arns()}
+    if accounts:
+        with timed_phase('assume_roles'):
+            assumed = assume_roles(accounts)
+        targets = [(profile_name, region_name) for profile_name, region_name in targets
+                   if profile_name not in accounts or profile_name in assumed]
 
-    values = index[profile_name].get(region, [])
-    return sorted(values, key=lambda k: k['name'])
+    results = {}
+    with ThreadPoolExecutor(max_workers=get_index_workers()) as executor:
+        futures = {executor.submit(get_region_instances, region_name, profile_name): (profile_name, region_name)
+                   for profile_name, region_name in targets}
 
+        for future in as_completed(futures):
+            profile_name, region_name = futures[future]
+            try:
+                results[(profile_name, region_name)] = future.result()
+            except Exception as e:  # Invalid profile, region disabled or not reachable
+                print('Unable to index %s/%s: %s' %
+                      (profile_name or 'default', region_name, e))
 
-def autocomplete(text, state, is_case_sensitive=False):
-    """ Generic readline completion entry point. """
+    return results
 
-    buffer = readline.get_line_buffer()
 
-    completion_list = comp = [i['name']
-                              for i in get_instances_list_from_index()]
+def get_index_engine():
+    """ Return the module of the configured index storage engine or None for the JSON index """
 
-    if not is_case_sensitive:
-        buffer = buffer.lower()
-        comp = [c.lower() for c in completion_list]
+    engine = get_value_from_user_config('index_engine')
 
-    results = [c for c in comp if c.startswith(buffer)] + [None]
+    if engine == 'sqlite':
+        from . import index_sqlite
+        return index_sqlite
+    if engine == 'mmap':
+        from . import index_mmap
+        return index_mmap
+    if engine == 'sharded':
+        from . import index_sharded
+        return index_sharded
 
-    # Handle multi-word inputs by truncating strings at the last space
-    if buffer.find(' ') > 0:
-        strip_pos = buffer.rfind(' ') + 1
-        results = [i[strip_pos:] for i in results if i is not None] + [None]
+    return None
 
-    return results[state]
 
+def get_index_filename(filename=None):
+    """ Return the file name of the index in the config directory """
 
-def get_input_autocomplete(message=''):
-    """ Allow user to type input and provide auto-completion """
+    if filename:
+        return filename
 
-    readline.set_completer_delims(' \t\n;')
-    readline.parse_and_bind("tab: complete")
-    readline.set_completer(autocomplete)
+    engine = get_index_engine()
 
-    try:
-        return input(message).strip()
-    except KeyboardInterrupt:
-        return False
-    except Exception:  # Other Exception
-        return False
+    return engine.filename if engine else 'index.json'
 
 
-def instance_lookup(instance):
-    """ Lookup an instance to find it's public IP """
+def read_index_meta(filename=None):
+    """ Return an index containing at least the refresh timestamps (`_refreshed_at`) """
 
-    # Read index
-    instances_list = get_instances_list_from_index()
+    filename = get_index_filename(filename)
+    engine = get_index_engine()
 
-    # Search in index first
-    if instances_list:
-        result = [i for i in instances_list if
-                  i['name'].lower() == instance.lower()]
-        if len(result) > 0:
-            return ('index', result[0]['detail'])
+    if engine:
+        return {'_refreshed_at': engine.read_refreshed_at(resolve_home(config_dir) + filename)}
+
+    # Only the timestamps are decoded
+    from . import index_stream
+    return {'_refreshed_at': index_stream.read_refreshed_at(resolve_home(config_dir) + filename)}
+
+
+def save_regions(results, filename=None, merge=False):
+    """
+        Store instances lists keyed by `(profile_name, region_name)` in the index.
+        The lists can be iterables (e.g. streamed from the AWS pages): the JSON
+        index writes them as they are consumed.
+        With `merge`, the lists are merged in the existing regions and a region
+        is only replaced if something changed.
+    """
+
+    from . import index_stream
+
+    filename = get_index_filename(filename)
+    engine = get_index_engine() or index_stream
+    path = resolve_home(config_dir) + filename
+    refreshed_at = time.time()
+
+    # `{(profile, region): (instances_list, refreshed_at)}`, a None list means unchanged
+    updates = {}
+    # Modified regions given as lists for the search indexes
+    search_updates = {}
+    for (profile_name, region_name), instances_list in results.items():
+        profile_name = get_profile_key(profile_name)
+        if merge:
+            existing = engine.read_region(path, profile_name, region_name)
+            instances_list, changes = merge_instances_list(
+                existing, instances_list)
+            if not any(changes.values()):
+                instances_list = None
+        elif engine is not index_stream:
+            instances_list = list(instances_list)
+
+        if instances_list is None or isinstance(instances_list, list):
+            search_updates[(profile_name, region_name)] = (
+                instances_list, refreshed_at)
+        else:  # Search index written once the region is streamed
+            instances_list = iter_write_search_index(
+                instances_list, profile_name, region_name)
+
+        updates[(profile_name, region_name)] = (instances_list, refreshed_at)
+
+    engine.write_regions(path, updates)
+
+    # Rebuild the search indexes of the modified regions
+    write_search_indexes(search_updates)
+
+    return True
+
+
+def iter_write_search_index(instances, profile_name, region_name):
+    """
+        Yield the instances, then write the search index of the region.
+        Only the names and the postings of this region are kept meanwhile.
+    """
+
+    from . import search_index
+
+    content = search_index.new()
+    for instance in instances:
+        search_index.add(content, instance)
+        yield instance
+
+    search_index.write(get_search_index_path(profile_name, region_name),
+                       search_index.finish(content))
+
+
+def get_search_index_path(profile_name=None, region_name=None):
+    """ Return the path of the search index of a profile/region """
+
+    return resolve_home(config_dir) + 'search/%s.%s.json' % (get_profile_key(profile_name), region_name or region)
+
+
+def write_search_indexes(updates):
+    """ Write the search indexes of the modified regions of an index update """
+
+    from . import search_index
+
+    for (profile_name, region_name), (instances_list, refreshed_at) in updates.items():
+        if instances_list is not None:
+            search_index.write(
+                get_search_index_path(profile_name, region_name),
+                search_index.build(instances_list)
+            )
+
+    return True
+
+
+def get_search_index():
+    """ Return the search index of the active profile/region """
 
-    # AWS instance lookup
-    response = aws_lookup(
-        client=get_aws_client(),
-        instance=instance
+    from . import search_index
+
+    content = search_index.read(get_search_index_path())
+
+    # Index built before the search indexes existed: built once
+    if not content or 'tags' not in content:
+        content = search_index.build(get_instances_list_from_index())
+        search_index.write(get_search_index_path(), content)
+
+    return content
+
+
+def build_index(filename=None, all_regions=False, profiles=None, refresh=False):
+    """ Build instance index """
+
+    # Create config directory if necessary
+    if not is_dir(config_dir):
+        mkdir(config_dir)
+
+    # Accounts of the `[ROLES]` section are indexed with the profiles
+    accounts = list(get_role_arns())
+    if accounts:
+        profiles = [profile_name for profile_name in profiles or [None]
+                    if get_profile_key(profile_name) not in accounts] + accounts
+
+    if all_regions:
+        # Each profile or account may have its own partition and opt-in regions
+        with timed_phase('enabled_regions'):
+            targets = get_enabled_targets(profiles)
+    else:
+        targets = [(profile_name, region) for profile_name in profiles or [None]]
+
+    if refresh:
+        # Skip regions that are still fresh
+        with timed_phase('read_index'):
+            index = read_index_meta(filename)
+        targets = [(profile_name, region_name) for profile_name, region_name in targets
+                   if not is_index_fresh(index, profile_name, region_name)]
+
+        if targets:
+            # Only refetch stale regions and apply the changes
+            with timed_phase('fetch'):
+                results = fetch_targets(targets)
+            with timed_phase('save_regions'):
+                save_regions(results, filename, merge=True)
+    elif all_regions or profiles:
+        # Fetch every profile and region concurrently, then merge the results
+        with timed_phase('fetch'):
+            results = fetch_targets(targets)
+        with timed_phase('save_regions'):
+            save_regions(results, filename)
+    else:
+        # Instances are written to the index as the pages arrive
+        with timed_phase('fetch'):
+            results = {(None, region): iter_region_instances(region)}
+        with timed_phase('save_regions'):
+            save_regions(results, filename)
+
+    # Keep the SSH config include and the shell completion in sync with the index
+    with timed_phase('export'):
+        export_ssh_config(filename)
+        write_completion_names_file(filename)
+
+    return True
+
+
+def get_completion_names_path():
+    """ Return the path of the names list read by the shell completion scripts """
+
+    return resolve_home(config_dir) + 'names'
+
+
+def write_completion_names_file(filename=None):
+    """ Write the names of the active profile/region sorted, one per line, for the shell completion """
+
+    from . import storage
+
+    # Code point order is the byte order of the C locale used by the scripts
+    names = sorted({name for name in get_names_from_index(filename)
+                    if '\n' not in name})
+
+    path = get_completion_names_path()
+    with storage.open_atomically(path) as f:
+        f.write(''.join(name + '\n' for name in names))
+
+    return path
+
+
+def get_index_regions(filename=None):
+    """ Return the `(profile, region)` pairs of the index, the active profile/region first """
+
+    from . import index_stream
+
+    engine = get_index_engine()
+    path = resolve_home(config_dir) + get_index_filename(filename)
+    if engine:
+        pairs = [(profile_name, region_name)
+                 for profile_name, profile_regions in engine.read_refreshed_at(path).items()
+                 for region_name in profile_regions]
+    else:  # Without decoding the instances
+        pairs = index_stream.read_regions(path)
+
+    return sorted(pairs, key=lambda k: k != (get_profile_key(), region))
+
+
+def get_ssh_config_options(flag):
+    """ Translate the `ssh_flag` command line options into ssh_config `(keyword, value)` options """
+
+    import shlex
+
+    switches = {
+        '-4': ('AddressFamily', 'inet'),
+        '-6': ('AddressFamily', 'inet6'),
+        '-A': ('ForwardAgent', 'yes'),
+        '-a': ('ForwardAgent', 'no'),
+        '-C': ('Compression', 'yes'),
+        '-q': ('LogLevel', 'QUIET'),
+        '-v': ('LogLevel', 'VERBOSE'),
+        '-vv': ('LogLevel', 'DEBUG2'),
+        '-vvv': ('LogLevel', 'DEBUG3'),
+        '-X': ('ForwardX11', 'yes'),
+        '-Y': ('ForwardX11Trusted', 'yes'),
+    }
+    keywords = {'-i': 'IdentityFile', '-p': 'Port', '-l': 'User'}
+
+    options = []
+    tokens = shlex.split(flag or '')
+    while tokens:
+        token = tokens.pop(0)
+        if token in switches:
+            options.append(switches[token])
+        elif token[:2] in keywords or token[:2] == '-o':
+            value = token[2:] or (tokens.pop(0) if tokens else '')
+            if token[:2] == '-o':  # `-o Keyword=value` or `-o "Keyword value"`
+                keyword, separator, value = value.replace(
+                    '=', ' ', 1).partition(' ')
+                options.append((keyword, value.strip()))
+            else:
+                options.append((keywords[token[:2]], value))
+        # Other options have no ssh_config equivalent
+
+    return options
+
+
+def get_ssh_config_host(name, detail, route_cache=None):
+    """ Return the ssh_config `Host` block of an instance or None if it has no IP address """
+
+    # Static file: prefer the routes that work from anywhere unless a route worked for the VPC
+    routes = get_routes(
+        detail, order=['public', 'bastion', 'private'], route_cache=route_cache)
+    if not routes:
+        return None
+
+    lines = ['Host %s' % ('"%s"' % (name) if '#' in name else name),
+             '    HostName %s' % (routes[0]['ip'])]
+
+    if get_value_from_user_config('ssh_user'):
+        lines.append('    User %s' % (get_value_from_user_config('ssh_user')))
+    if routes[0]['proxyjump']:
+        lines.append('    ProxyJump %s' % (routes[0]['proxyjump'].strip()))
+
+    for keyword, value in get_ssh_config_options(get_value_from_user_config('ssh_flag')):
+        lines.append('    %s %s' % (keyword, value))
+
+    # Share the multiplexed connection with `cssh`
+    control_path = get_control_path(detail.get('id'))
+    if control_path:
+        lines.extend([
+            '    ControlMaster auto',
+            '    ControlPath "%s"' % (control_path),
+            '    ControlPersist %s' % (get_value_from_user_config('ssh_control_persist') or '10m'),
+        ])
+
+    return '\n'.join(lines)
+
+
+def export_ssh_config(filename=None, output='ssh_config'):
+    """
+        Write a `Host` block for each indexed instance to an ssh_config
+        include file. Returns the path of the file.
+    """
+
+    from . import storage
+
+    route_cache = read_route_cache()
+
+    # `ssh` doesn't create the directory of the `ControlPath` sockets
+    if get_value_from_user_config('ssh_multiplexing') != 'false':
+        os.makedirs(resolve_home(config_dir) + 'cm', mode=0o700, exist_ok=True)
+
+    path = resolve_home(config_dir) + output
+    with storage.open_atomically(path) as f:
+        f.write('# Generated by cloudssh from the instances index, do not edit\n')
+
+        # Written as the regions are read, only the names are kept
+        seen = set()  # OpenSSH matches host names case insensitively
+        for profile_name, region_name in get_index_regions(filename):
+            for instance in iter_instances_from_index(filename, profile_name, region_name):
+                name = instance['name']
+
+                # Host names can't contain spaces, quotes or patterns
+                if name.lower() in seen or any(c in name for c in ' \t"*?!,'):
+                    continue
+
+                block = get_ssh_config_host(
+                    name, instance.get('detail') or {}, route_cache)
+                if block:
+                    seen.add(name.lower())
+                    f.write('\n' + block + '\n')
+
+    return path
+
+
+def is_index_stale(filename=None, ttl=None):
+    """ Returns True if the index file was not written for more than `ttl` seconds """
+
+    path = resolve_home(config_dir) + get_index_filename(filename)
+    if not os.path.exists(path):
+        return False
+
+    return time.time() - os.path.getmtime(path) >= (ttl if ttl is not None else get_index_ttl())
+
+
+def get_self_command():
+    """ Return the command used to run cloudssh in a subprocess """
+
+    # Run as a module (`__main__` with `python -m`) so the relative imports work
+    if __spec__ is not None:
+        return [executable, '-m', __spec__.name]
+
+    return [executable, os.path.abspath(__file__)]
+
+
+def refresh_index_in_background(lock_filename='refresh.lock', lock_ttl=300):
+    """
+        Start a detached `--refresh` process unless one was started less than
+        `lock_ttl` seconds ago. Returns True if a process was started.
+    """
+
+    lock_path = resolve_home(config_dir) + lock_filename
+
+    # Expire an old lock left by a previous refresh
+    if os.path.isfile(lock_path) and time.time() - os.path.getmtime(lock_path) >= lock_ttl:
+        os.remove(lock_path)
+
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:  # A refresh is already running
+        return False
+
+    subprocess.Popen(
+        get_self_command() + ['--refresh'],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
     )
 
+    return True
+
+
+def fuzzy_search(query, limit=10, probe=False):
+    """ Search an instance by name with typo tolerance, best match first """
+
+    from . import search_index
+
+    matches = search_index.fuzzy_search(query, get_search_index(), limit)
+
+    if not matches:
+        print('No result!')
+        exit()
+
+    if len(matches) > 1 and probe:
+        return select_reachable(get_records(matches))
+
+    if len(matches) > 1:
+        print('Results:')
+        for match in matches:
+            print('* %s' % match)
+
+    if confirm('Found "%s", continue?' % matches[0], True):
+        return 'index', index_lookup(matches[0])
+
+    exit()
+
+
+def find_by_tags(predicates):
+    """ Return the index records matching every tag predicate """
+
+    from . import search_index
+
+    engine = get_index_engine()
+    if hasattr(engine, 'find_by_tags'):  # Indexed query of the tags
+        return engine.find_by_tags(resolve_home(config_dir) + get_index_filename(),
+                                   get_profile_key(), region, predicates)
+
+    names = set(search_index.tag_search(predicates, get_search_index()))
+
+    return [i for i in get_instances_list_from_index() if i['name'] in names]
+
+
+def tag_search(predicates, probe=False):
+    """ Search instances by tags """
+
+    matches = find_by_tags(predicates)
+
+    if matches:
+        if len(matches) > 1 and probe:
+            return select_reachable(matches)
+        elif len(matches) > 1:
+            print('Results:')
+            for match in matches:
+                print('* %s' % match['name'])
+            exit()
+        else:
+            if confirm('Found "%s", continue?' % matches[0]['name'], True):
+                return 'index', matches[0]['detail']
+    else:
+        print('No result!')
+        exit()
+
+
+def search(query, probe=False):
+    """ Search an instance by name """
+
+    # Ask the resolver daemon first
+    response = daemon_request({'op': 'search', 'query': query})
+    if response is not None:
+        matches = response['matches']
+    else:
+        matches = index_search(query)
+
+    # Not indexed: let AWS filter the names
+    source = 'index'
+    if not matches:
+        source = 'aws'
+        matches = aws_search(query)
+
+    if matches:
+        if len(matches) > 1 and probe:
+            return select_reachable(matches)
+        elif len(matches) > 1:
+            print('Results:')
+            for match in matches:
+                print('* %s' % match['name'])
+            exit()
+        else:
+            if confirm('Found "%s", continue?' % matches[0]['name'], True):
+                return source, matches[0]['detail']
+    else:
+        print('No result!')
+        exit()
+
+
+def index_search(query):
+    """ Return the index records whose name contains `query` (case insensitive) """
+
+    engine = get_index_engine()
+    if engine:  # Let the storage engine filter the names
+        return engine.search(
+            resolve_home(config_dir) + get_index_filename(), get_profile_key(), region, query)
+
+    return [i for i in get_instances_list_from_index() if query.lower() in i['name'].lower()]
+
+
+def get_records(names):
+    """ Return the index records of a list of names in the same order """
+
+    records = {i['name']: i for i in get_instances_list_from_index()}
+
+    return [records[name] for name in names if name in records]
+
+
+def get_duplicate_records(instance):
+    """ Return the index records of a name and of its duplicates (`name#01`, `name#02`...) """
+
+    instance = instance.lower()
+
+    return [i for i in get_instances_list_from_index()
+            if i['name'].lower() == instance or i['name'].lower().rsplit('#', 1)[0] == instance]
+
+
+def get_probe_timeout(default=1.0):
+    """ Return the number of seconds a reachability probe waits for the candidates """
+
+    timeout = get_value_from_user_config('probe_timeout')
+
+    return float(timeout) if timeout else default
+
+
+def probe_records(records, timeout=None):
+    """
+        Probe port 22 of the public and private IPs of every record at once.
+        Returns the records annotated with `reachable`, `latency` (seconds) and
+        `ip`, fastest reachable first.
+    """
+
+    from . import probe
+
+    addresses = {record['detail'].get(key) for record in records
+                 for key in ('public_ip', 'private_ip') if record['detail'].get(key)}
+    latencies = probe.probe(
+        addresses, timeout=timeout or get_probe_timeout())
+
+    results = []
+    for record in records:
+        # Fastest address of the instance
+        reachable = sorted((latencies[ip], ip) for ip in (record['detail'].get('public_ip'), record['detail'].get('private_ip'))
+                           if ip and latencies.get(ip) is not None)
+        results.append(dict(
+            record,
+            reachable=bool(reachable),
+            latency=reachable[0][0] if reachable else None,
+            ip=reachable[0][1] if reachable else None))
+
+    return sorted(results, key=lambda k: (not k['reachable'], k['latency'] or 0))
+
+
+def select_reachable(records):
+    """ Print the candidates annotated with their reachability and select the fastest reachable one """
+
+    results = probe_records(records)
+
+    print('Results:')
+    for result in results:
+        if result['reachable']:
+            print('* %s (%.1f ms via %s)' %
+                  (result['name'], result['latency'] * 1000, result['ip']))
+        else:
+            print('* %s (unreachable)' % (result['name']))
+
+    if not results[0]['reachable']:
+        print('No reachable instance!')
+        exit()
+
+    if confirm('Fastest reachable: "%s", continue?' % results[0]['name'], True):
+        return 'index', results[0]['detail']
+
+    exit()
+
+
+def match_instances(pattern):
+    """ Return the index records matching a name (substring) or a tag query """
+
+    from . import search_index
+
+    predicates = search_index.parse_tag_query(pattern)
+    if predicates:
+        return find_by_tags(predicates)
+
+    return index_search(pattern)
+
+
+def confirm(prompt=None, resp=False):
+    """
+        Source: http://code.activestate.com/recipes/541096-prompt-the-user-for-confirmation/
+        prompts for yes or no response from the user. Returns True for yes and
+        False for no.
+        'resp' should be set to the default value assumed by the caller when
+        user simply types ENTER.
+        >>> confirm(prompt='Create Directory?', resp=True)
+        Create Directory? [y]|n:
+        True
+    """
+
+    if prompt is None:
+        prompt = 'Confirm'
+
+    if resp:
+        prompt = '%s [Y/n]: ' % (prompt)
+    else:
+        prompt = '%s [y/N]: ' % (prompt)
+
+    while True:
+        ans = input(prompt)
+        if not ans:
+            return resp
+        if ans not in ['y', 'Y', 'n', 'N']:
+            print('please enter y or n.')
+            continue
+        if ans == 'y' or ans == 'Y':
+            return True
+        if ans == 'n' or ans == 'N':
+            return False
+
+
+def get_instances_list_from_index(filename=None, profile_name=None, region_name=None):
+
+    engine = get_index_engine()
+    if engine:  # Already sorted by the storage engine
+        return engine.read_region(
+            resolve_home(config_dir) + get_index_filename(filename), get_profile_key(profile_name), region_name or region)
+
+    return sorted(iter_instances_from_index(filename, profile_name, region_name), key=lambda k: k['name'])
+
+
+def iter_instances_from_index(filename=None, profile_name=None, region_name=None):
+    """ Iterate on the instances of a profile/region, streamed from the JSON index (in index order) """
+
+    from . import index_stream
+
+    path = resolve_home(config_dir) + get_index_filename(filename)
+
+    engine = get_index_engine()
+    if engine:
+        return iter(engine.read_region(path, get_profile_key(profile_name), region_name or region))
+
+    # Only this region is decoded
+    return index_stream.iter_region(path, get_profile_key(profile_name), region_name or region)
+
+
+def get_names_from_index(filename=None, profile_name=None, region_name=None):
+    """ Return the sorted names of a profile/region without decoding the instances details """
+
+    from . import index_stream
+
+    engine = get_index_engine() or index_stream
+    names = engine.read_names(resolve_home(config_dir) + get_index_filename(filename),
+                              get_profile_key(profile_name), region_name or region)
+
+    return sorted(names)
+
+
+def get_index_signature(profile_name=None, region_name=None):
+    """ Return a value that changes when the active index is modified, or None """
+
+    path = resolve_home(config_dir) + get_index_filename()
+    if not os.path.exists(path):
+        return None
+
+    stat = os.stat(path)
+
+    return (path, stat.st_mtime_ns, stat.st_size, get_profile_key(profile_name), region_name or region)
+
+
+def build_completion_names(names):
+    """ Return the names with sorted `(name, position)` arrays to answer prefix queries with bisect """
+
+    exact = sorted((name, position) for position, name in enumerate(names))
+    folded = sorted((name.lower(), position)
+                    for position, name in enumerate(names))
+
+    return {
+        'names': names,
+        'exact': ([name for name, position in exact], [position for name, position in exact]),
+        'folded': ([name for name, position in folded], [position for name, position in folded]),
+    }
+
+
+def get_completion_names():
+    """
+        Return the names of the index with sorted prefix arrays.
+        The index is only read again when its signature changes.
+    """
+
+    signature = get_index_signature()
+    if signature is None or completion_cache.get('signature') != signature:
+        completion_cache.clear()
+        completion_cache.update(build_completion_names(
+            get_names_from_index()))
+        completion_cache['signature'] = signature
+
+    return completion_cache
+
+
+def complete_prefix(prefix, is_case_sensitive=False, completion_names=None):
+    """ Return the names starting with `prefix` in index order """
+
+    from bisect import bisect_left, bisect_right
+
+    if completion_names is None:
+        # Ask the resolver daemon first
+        response = daemon_request(
+            {'op': 'complete', 'prefix': prefix, 'case_sensitive': is_case_sensitive})
+        if response is not None:
+            return response['names']
+
+        completion_names = get_completion_names()
+
+    keys, positions = completion_names['exact'] if is_case_sensitive else completion_names['folded']
+
+    start = bisect_left(keys, prefix)
+    end = bisect_right(keys, prefix + '\U0010ffff')
+
+    return [keys[i] for i in sorted(range(start, end), key=lambda i: positions[i])]
+
+
+def autocomplete(text, state, is_case_sensitive=False):
+    """ Generic readline completion entry point. """
+
+    import readline
+
+    buffer = readline.get_line_buffer()
+
+    if not is_case_sensitive:
+        buffer = buffer.lower()
+
+    # Readline calls this function for each `state` of the same input
+    key = (buffer, is_case_sensitive, get_index_signature())
+    if state == 0 or key[2] is None or completion_cache.get('results_key') != key:
+        results = complete_prefix(buffer, is_case_sensitive)
+        completion_cache.update({'results_key': key, 'results': results})
+    results = completion_cache['results'] + [None]
+
+    # Handle multi-word inputs by truncating strings at the last space
+    if buffer.find(' ') > 0:
+        strip_pos = buffer.rfind(' ') + 1
+        results = [i[strip_pos:] for i in results if i is not None] + [None]
+
+    return results[state]
+
+
+def get_input_autocomplete(message=''):
+    """ Allow user to type input and provide auto-completion """
+
+    import readline
+
+    readline.set_completer_delims(' \t\n;')
+    readline.parse_and_bind("tab: complete")
+    readline.set_completer(autocomplete)
+
+    try:
+        return input(message).strip()
+    except KeyboardInterrupt:
+        return False
+    except Exception:  # Other Exception
+        return False
+
+
+def index_lookup(instance):
+    """ Return the detail of an instance from the index or None """
+
+    # Ask the resolver daemon first
+    response = daemon_request({'op': 'lookup', 'instance': instance})
+    if response is not None:
+        return response['detail']
+
+    engine = get_index_engine()
+    if engine:  # Indexed lookup by instance ID, IP address or name
+        path = resolve_home(config_dir) + get_index_filename()
+        if is_instance_id(instance):
+            result = engine.find_by(
+                path, get_profile_key(), region, 'id', instance)
+            result = result[0] if result else None
+        elif is_ip_address(instance):  # Public IP first, then private IP
+            result = [i for field in ('public_ip', 'private_ip')
+                      for i in engine.find_by(path, get_profile_key(), region, field, instance)]
+            result = result[0] if result else None
+        else:
+            result = engine.lookup(path, get_profile_key(), region, instance)
+
+        return result['detail'] if result else None
+
+    # Read index
+    instances_list = get_instances_list_from_index()
+
+    if instances_list:
+        if is_ip_address(instance):
+            result = [i for i in instances_list if instance in (
+                i.get('detail', {}).get('public_ip'), i.get('detail', {}).get('private_ip'))]
+        else:
+            result = [i for i in instances_list if
+                      i['name'].lower() == instance.lower()]
+        if len(result) > 0:
+            return result[0]['detail']
+
+    return None
+
+
+def instance_lookup(instance):
+    """ Lookup an instance to find it's public IP """
+
+    # Search in index first
+    with timed_phase('index_lookup'):
+        detail = index_lookup(instance)
+    if detail:
+        return ('index', detail)
+
+    # Recent AWS lookup of the same input
+    with timed_phase('lookup_cache'):
+        found, detail = get_cached_lookup(instance)
+    if found:
+        # A cached miss exits with the usual message
+        return ('cache', detail or get_instance_infos([]))
+
+    # AWS instance lookup (with a warm client if the resolver daemon is running)
+    with timed_phase('daemon_request'):
+        response = daemon_request({'op': 'describe', 'instance': instance})
+    if not response:
+        client = get_aws_client()
+        with timed_phase('describe_instances'):
+            response = aws_lookup(client=client, instance=instance)
+
+    if not response['Reservations']:
+        cache_lookup(instance, None)
+
     # Fetch public IP address or exit with a graceful message
-    return ('aws', get_instance_infos(response['Reservations']))
+    detail = get_instance_infos(response['Reservations'])
+    cache_lookup(instance, detail)
 
+    return ('aws', detail)
 
-def main():
-    # Read user config
-    parse_user_config()
 
-    # Read CLI arguments
-    args = parse_cli_args()
+def get_lookup_cache_path():
+    """ Return the path of the AWS lookups cache """
+
+    return resolve_home(config_dir) + 'lookup_cache.json'
+
+
+def get_lookup_cache_ttl(negative=False):
+    """ Return the number of seconds an AWS lookup (or a miss with `negative`) is cached """
+
+    if negative:
+        ttl = get_value_from_user_config('lookup_cache_negative_ttl')
+        return int(ttl) if ttl else 30
+
+    ttl = get_value_from_user_config('lookup_cache_ttl')
+    return int(ttl) if ttl else 300
+
+
+def get_lookup_cache_size(default=1000):
+    """ Return the maximum number of cached AWS lookups """
+
+    size = get_value_from_user_config('lookup_cache_size')
+
+    return int(size) if size else default
+
+
+def get_lookup_cache_key(instance):
+    """ Return the key of a lookup in the cache """
+
+    return '%s/%s/%s' % (get_profile_key(), region, instance)
+
+
+def read_lookup_cache():
+    """ Return the cached AWS lookups """
+
+    path = get_lookup_cache_path()
+    if not os.path.isfile(path):
+        return {}
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:  # Corrupted cache
+        return {}
+
+
+def write_lookup_cache(cache):
+    """ Write the cached AWS lookups """
+
+    from . import storage
+
+    if not is_dir(config_dir):
+        mkdir(config_dir)
+
+    with storage.open_atomically(get_lookup_cache_path()) as f:
+        json.dump(cache, f)
+
+    return True
+
+
+def get_cached_lookup(instance, now=None, recency_resolution=60):
+    """
+        Return `(True, detail)` for a fresh cached AWS lookup (`detail` is
+        None for a cached miss) or `(False, None)`
+    """
+
+    now = now or time.time()
+    key = get_lookup_cache_key(instance)
+
+    cache = read_lookup_cache()
+    entry = cache.get(key)
+    if not entry or now - entry['cached_at'] >= get_lookup_cache_ttl(entry['detail'] is None):
+        return False, None
+
+    # Least recently used entries are evicted first, the recency is only
+    # refreshed every `recency_resolution` seconds so most hits don't write
+    if now - entry['used_at'] >= recency_resolution:
+        entry['used_at'] = now
+        write_lookup_cache(cache)
+
+    return True, entry['detail']
+
+
+def cache_lookup(instance, detail, now=None):
+    """ Cache the result of an AWS lookup (None for a miss) """
+
+    now = now or time.time()
+    if get_lookup_cache_ttl(detail is None) <= 0:
+        return False
+
+    cache = read_lookup_cache()
+
+    # Drop the expired entries
+    for key, entry in list(cache.items()):
+        if now - entry['cached_at'] >= get_lookup_cache_ttl(entry['detail'] is None):
+            del cache[key]
+
+    cache[get_lookup_cache_key(instance)] = {
+        'detail': detail, 'cached_at': now, 'used_at': now}
+
+    # Evict the least recently used entries above the size cap
+    excess = len(cache) - get_lookup_cache_size()
+    if excess > 0:
+        for key in sorted(cache, key=lambda k: cache[k]['used_at'])[:excess]:
+            del cache[key]
+
+    return write_lookup_cache(cache)
 
-    # Set region
-    set_region()
+
+def get_daemon_socket_path():
+    """ Return the path of the resolver daemon socket """
+
+    return resolve_home(config_dir) + 'daemon.sock'
+
+
+def daemon_request(payload, timeout=10):
+    """
+        Send a request to the resolver daemon for the active profile/region.
+        Returns the response or None if the daemon is not running or failed.
+    """
+
+    path = get_daemon_socket_path()
+    if not os.path.exists(path):
+        return None
+
+    import socket
+
+    payload = dict(payload, profile=get_profile_key(), region=region)
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                response = json.loads(f.readline())
+    except (OSError, ValueError):  # Not running or unexpected response
+        return None
+
+    return None if 'error' in response else response
+
+
+def main():
+    with timed_phase('config'):
+        # Read user config
+        parse_user_config()
+
+        # Read CLI arguments
+        args = parse_cli_args()
+
+        # Set region
+        set_region()
+
+    # Report the timings on exit (`--timings` and/or JSON lines to `$CLOUDSSH_TRACE`)
+    if args['timings'] or os.environ.get('CLOUDSSH_TRACE'):
+        import atexit
+        atexit.register(report_timings, args['timings'],
+                        os.environ.get('CLOUDSSH_TRACE'))
+
+    # Serve lookups over a Unix socket until interrupted
+    if args['daemon']:
+        from . import daemon
+        daemon.serve(get_daemon_socket_path())
+        exit()
+
+    # Print a shell completion script
+    if args['completion']:
+        from . import completion
+        print(completion.get_script(
+            args['completion'], get_completion_names_path()), end='')
+        exit()
 
     # Build instance index
-    if args['build_index']:
-        build_index()
+    if args['build_index'] or args['refresh']:
+        with timed_phase('build_index'):
+            build_index(all_regions=args['all_regions'],
+                        profiles=get_index_profiles(args['profiles']),
+                        refresh=args['refresh'])
         print("The instances index has been stored in %s." %
               (config_dir))
         exit()
 
+    # Write the ssh_config include file
+    if args['export_ssh_config']:
+        path = export_ssh_config()
+        print("The SSH config has been stored in %s, add `Include %s` at the top of ~/.ssh/config." %
+              (path, path))
+        exit()
+
+    # Run a command on every matching instance
+    if args['exec']:
+        if not args['instance']:
+            raise RuntimeError('Usage: cssh --exec "some command" some_pattern')
+
+        results = exec_on_instances(
+            args['exec'], match_instances(args['instance']), parallel=args['parallel'])
+        exit(0 if results and all(code == 0 for code in results.values()) else 1)
+
     # Search an instance name
     detail = None
-    if args['search']:
-        source, detail = search(query=args['search'])
+    predicates = None
+    if args['search']:  # Tag query (e.g. `env=prod role=web`)
+        from . import search_index
+        predicates = search_index.parse_tag_query(args['search'])
+
+    if args['search'] and predicates:
+        with timed_phase('search'):
+            source, detail = tag_search(predicates, probe=args['probe'])
+    elif args['search'] and args['fuzzy']:
+        with timed_phase('search'):
+            source, detail = fuzzy_search(
+                query=args['search'], limit=args['limit'], probe=args['probe'])
+    elif args['search']:
+        with timed_phase('search'):
+            source, detail = search(query=args['search'], probe=args['probe'])
+    elif args['probe'] and args['instance']:
+        # Pick the fastest reachable of several instances sharing a name
+        records = get_duplicate_records(args['instance'])
+        if len(records) > 1:
+            source, detail = select_reachable(records)
 
     if detail is None:
         # Read instance or request user input
@@ -486,9 +1929,13 @@ def main():
             raise RuntimeError('Usage: cssh some_instance')
 
         # Lookup an instance to find it's public IP
-        source, detail = instance_lookup(input_)
+        with timed_phase('instance_lookup'):
+            source, detail = instance_lookup(input_)
+
+    if args['close']:  # Close the multiplexed connection
+        close(detail.get('public_ip') or detail.get('private_ip'), detail.get('id'))
 
-    if args['info']:  # Display instance informations
+    elif args['info']:  # Display instance informations
         print('* Network')
         print("Public IP: %s" %
               (detail.get('public_ip', 'not available')))
@@ -516,19 +1963,218 @@ def main():
             print('No tags!')
 
     else:  # Open SSH connection in a subprocess
-        connect(detail['public_ip'])
+        # Serve a stale index now and refresh it while the session is open
+        if source == 'index' and get_value_from_user_config('background_refresh') == 'true' and is_index_stale():
+            refresh_index_in_background()
 
+        connect_instance(detail)
 
-def connect(ip):
-    """ Open SSH connection in a subprocess """
 
-    ssh_command = get_ssh_command(
-        public_ip=ip,
-        user=get_value_from_user_config('ssh_user'),
-        proxyjump=get_value_from_user_config('ssh_proxyjump'),
-        flag=get_value_from_user_config('ssh_flag')
+@contextmanager
+def timed_phase(name):
+    """
+        Record the monotonic duration of a phase (phases can be nested).
+        Phases of worker threads are aggregated by name and depth (count and
+        total seconds) under the phase of the main thread that started them.
+    """
+
+    is_main = threading.current_thread() is threading.main_thread()
+    local_depth = 0 if is_main else getattr(timings_local, 'depth', 0)
+
+    entry = {'phase': name, 'depth': timings['depth'] + local_depth, 'seconds': None}
+    if is_main:
+        with timings_lock:
+            timings['phases'].append(entry)
+        timings['depth'] += 1
+    else:
+        timings_local.depth = local_depth + 1
+        with timings_lock:
+            key = (name, entry['depth'])
+            total = next((e for e in timings['phases']
+                          if 'count' in e and (e['phase'], e['depth']) == key), None)
+            if total is None:
+                total = dict(entry, seconds=0, count=0)
+                timings['phases'].append(total)
+
+    start = time.monotonic()
+    try:
+        yield entry
+    finally:
+        entry['seconds'] = time.monotonic() - start
+        if is_main:
+            timings['depth'] -= 1
+        else:
+            timings_local.depth = local_depth
+            with timings_lock:
+                total['count'] += 1
+                total['seconds'] += entry['seconds']
+
+
+def get_timings_report():
+    """ Return the recorded phases and AWS calls as a table """
+
+    lines = ['%-32s %10s' % ('Phase', 'ms')]
+    for entry in timings['phases']:
+        name = '  ' * entry['depth'] + entry['phase']
+        if entry.get('count', 1) > 1:  # Total of the worker threads
+            name += ' (x%d)' % (entry['count'])
+        lines.append('%-32s %10.1f' % (name, (entry['seconds'] or 0) * 1000))
+    lines.append('%-32s %10.1f' %
+                 ('Total', (time.monotonic() - timings['started_at']) * 1000))
+    lines.append('AWS requests: %(requests)d, retries: %(retries)d, bytes: %(bytes)d' % (
+        timings['aws']))
+
+    return '\n'.join(lines)
+
+
+def report_timings(show=False, log_path=None):
+    """ Print the timings table to stderr and/or append them as a JSON line to `log_path` """
+
+    import sys
+
+    if show:
+        print(get_timings_report(), file=sys.stderr)
+
+    if log_path:
+        with open(resolve_home(log_path), 'a') as f:
+            f.write(json.dumps({
+                'timestamp': time.time(),
+                'argv': argv[1:],
+                'profile': get_profile_key(),
+                'region': region,
+                'phases': timings['phases'],
+                'total': time.monotonic() - timings['started_at'],
+                'aws': timings['aws'],
+            }) + '\n')
+
+    return True
+
+
+def connect(ip, instance_id=None, proxyjump=None):
+    """ Open SSH connection in a subprocess and return the exit code of ssh """
+
+    ssh_command = get_instance_ssh_command(ip, instance_id, proxyjump)
+
+    return ssh_subprocess(ssh_command)
+
+
+def connect_instance(detail):
+    """
+        Open an SSH connection to an instance through the last working route
+        of its VPC without probing. The routes are probed when none worked yet
+        for the VPC, or to retry once if that route fails to connect.
+    """
+
+    with timed_phase('select_route'):
+        routes = get_routes(detail)
+        cached = get_cached_route(detail, routes)
+        route = cached or select_route(detail, routes)
+    with timed_phase('ssh'):
+        code = connect(route['ip'], detail.get('id'), route['proxyjump'])
+
+    # ssh exits with 255 when the connection fails
+    if cached and code == 255 and len(routes) > 1:
+        with timed_phase('select_route'):
+            route = select_route(detail, routes)
+        with timed_phase('ssh'):
+            code = connect(route['ip'], detail.get('id'), route['proxyjump'])
+
+    return code
+
+
+def close(ip, instance_id):
+    """ Close the multiplexed SSH connection of an instance """
+
+    close_command = get_close_command(ip, instance_id)
+    if not close_command:
+        print('No open connection to this instance.')
+        return False
+
+    ssh_subprocess(close_command)
+
+    return True
+
+
+def get_exec_parallelism(default=20):
+    """ Return the maximum number of concurrent connections of `--exec` """
+
+    parallel = get_value_from_user_config('exec_parallelism')
+
+    return int(parallel) if parallel else default
+
+
+def run_remote_command(instance, command, print_lock):
+    """ Run a command on an instance, stream its output with a host prefix and return the exit code """
+
+    import sys
+
+    detail = instance['detail']
+    routes = get_routes(detail)
+    if not routes:
+        with print_lock:
+            print('%s | No IP address found for this instance.' %
+                  (instance['name']))
+        return 255
+
+    route = get_cached_route(detail, routes) or select_route(detail, routes)
+
+    # Never prompt for passwords or host keys while running unattended
+    ssh_command = get_instance_ssh_command(
+        route['ip'], detail.get('id'), route['proxyjump'])
+    ssh_command[1:1] = ['-o', 'BatchMode=yes']
+    ssh_command.append(command)
+
+    process = subprocess.Popen(
+        ssh_command,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT
     )
-    ssh_subprocess(ssh_command)
+
+    for line in process.stdout:
+        with print_lock:
+            sys.stdout.write('%s | %s' % (
+                instance['name'], line.decode('utf-8', 'replace').rstrip('\n') + '\n'))
+            sys.stdout.flush()
+
+    return process.wait()
+
+
+def exec_on_instances(command, instances_list, parallel=None):
+    """
+        Run a command on several instances concurrently and print a summary.
+        Returns the exit codes keyed by instance name.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not instances_list:
+        print('No result!')
+        return {}
+
+    print_lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=parallel or get_exec_parallelism()) as executor:
+        futures = {i['name']: executor.submit(run_remote_command, i, command, print_lock)
+                   for i in instances_list}
+
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except (Exception, SystemExit) as e:  # Keep the other hosts and the summary
+                with print_lock:
+                    print('%s | %s' % (name, e or type(e).__name__))
+                results[name] = 255
+
+    # Summary
+    failed = {name: code for name, code in results.items() if code != 0}
+    print('\n%d succeeded, %d failed' %
+          (len(results) - len(failed), len(failed)))
+    for name, code in sorted(failed.items()):
+        print('* %s: exit code %d' % (name, code))
+
+    return results
 
 
 if __name__ == '__main__':
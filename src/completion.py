@@ -0,0 +1,48 @@
+"""
+    Shell completion scripts.
+
+    The scripts read the flat list of instance names written by
+    `--build_index` (sorted, one name per line) so completing an instance
+    name costs a file read instead of starting Python.
+"""
+
+# Commands installed by the package
+commands = ['cssh', 'cloudssh']
+
+bash = """_cloudssh() {
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    [[ "$cur" == -* || ! -r "%(names_path)s" ]] && return 0
+
+    # Names are sorted: stop reading after the last match
+    local IFS=$'\\n'
+    COMPREPLY=($(LC_ALL=C awk -v p="$cur" 'index($0, p) == 1 { print; m = 1; next } m { exit }' "%(names_path)s"))
+}
+complete -o default -F _cloudssh %(commands)s
+"""
+
+zsh = """#compdef %(commands)s
+_cloudssh() {
+    [[ "$PREFIX" == -* || ! -r "%(names_path)s" ]] && return 1
+
+    local -a names
+    names=("${(@f)$(<"%(names_path)s")}")
+    compadd -a names
+}
+compdef _cloudssh %(commands)s
+"""
+
+fish = """for command in %(commands)s
+    complete -c $command -f -a '(cat "%(names_path)s" 2>/dev/null)'
+end
+"""
+
+scripts = {'bash': bash, 'zsh': zsh, 'fish': fish}
+
+
+def get_script(shell, names_path):
+    """ Return the completion script of a shell reading the names from `names_path` """
+
+    if shell not in scripts:
+        raise ValueError('Unsupported shell: %s' % (shell))
+
+    return scripts[shell] % {'names_path': names_path, 'commands': ' '.join(commands)}
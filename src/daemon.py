@@ -0,0 +1,141 @@
+"""
+    Resolver daemon: keeps the parsed config, the index and warm per-profile/region
+    EC2 clients in memory and answers `lookup`, `search`, `complete` and `describe`
+    requests sent by the CLI over a Unix domain socket (one JSON document per line).
+"""
+
+import os
+import json
+import threading
+import socketserver
+
+from . import cloudssh
+
+# `{(profile, region): {...}}` indexed regions, reloaded when the index changes
+regions_cache = {}
+
+# `{(profile, region): client}` EC2 clients with warm credentials and connections
+clients = {}
+
+lock = threading.Lock()
+
+
+def get_region(profile, region):
+    """ Return the cached index data of a profile/region """
+
+    signature = cloudssh.get_index_signature(profile, region)
+
+    with lock:
+        cached = regions_cache.get((profile, region))
+        if cached is None or signature is None or cached['signature'] != signature:
+            instances_list = cloudssh.get_instances_list_from_index(
+                profile_name=profile, region_name=region)
+
+            by_name = {}
+            by_id = {}
+            by_ip = {}
+            for instance in instances_list:
+                detail = instance.get('detail', {})
+                by_name.setdefault(instance['name'].lower(), instance)
+                by_id.setdefault(detail.get('id'), instance)
+                for field in ('public_ip', 'private_ip'):
+                    by_ip.setdefault(detail.get(field), instance)
+
+            cached = regions_cache[(profile, region)] = {
+                'signature': signature,
+                'instances_list': instances_list,
+                'by_name': by_name,
+                'by_id': by_id,
+                'by_ip': by_ip,
+                'completion': cloudssh.build_completion_names([i['name'] for i in instances_list]),
+            }
+
+    return cached
+
+
+def get_client(profile, region):
+    """ Return a warm EC2 client for a profile/region """
+
+    with lock:
+        if (profile, region) not in clients:
+            # `default` is the index key of the default credentials chain (environment, instance role...)
+            clients[(profile, region)] = cloudssh.get_aws_client(
+                region_name=region, profile_name=None if profile == 'default' else profile)
+
+        return clients[(profile, region)]
+
+
+def handle(request):
+    """ Return the response to a request """
+
+    profile, region = request['profile'], request['region']
+
+    if request['op'] == 'lookup':
+        cached = get_region(profile, region)
+        if cloudssh.is_instance_id(request['instance']):
+            instance = cached['by_id'].get(request['instance'])
+        elif cloudssh.is_ip_address(request['instance']):
+            instance = cached['by_ip'].get(request['instance'])
+        else:
+            instance = cached['by_name'].get(request['instance'].lower())
+        return {'detail': instance['detail'] if instance else None}
+
+    if request['op'] == 'search':
+        query = request['query'].lower()
+        return {'matches': [i for i in get_region(profile, region)['instances_list'] if query in i['name'].lower()]}
+
+    if request['op'] == 'complete':
+        return {'names': cloudssh.complete_prefix(
+            request['prefix'], request.get('case_sensitive', False),
+            completion_names=get_region(profile, region)['completion'])}
+
+    if request['op'] == 'describe':
+        response = cloudssh.aws_lookup(
+            client=get_client(profile, region), instance=request['instance'])
+        return {'Reservations': response['Reservations']}
+
+    return {'error': 'Unknown operation %s' % (request['op'])}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = handle(json.loads(line))
+            except Exception as e:  # Reported to the client which falls back to in-process
+                response = {'error': str(e)}
+
+            self.wfile.write(json.dumps(
+                response, default=str).encode('utf-8') + b'\n')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+def serve(path):
+    """ Serve requests on a Unix socket until interrupted """
+
+    # Remove a socket left by a previous daemon
+    if os.path.exists(path):
+        os.remove(path)
+
+    # Only the current user can connect
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, RequestHandler)
+    finally:
+        os.umask(umask)
+
+    print('Listening on %s' % (path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+    return True
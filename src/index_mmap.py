@@ -0,0 +1,313 @@
+"""
+    Compact memory-mapped index.
+
+    Layout:
+        magic (8 bytes) | table length (uint32) | table (JSON) | region sections
+
+    The table maps `{profile: {region: [offset, length, refreshed_at]}}` to a
+    region section (offsets are relative to the end of the table):
+        count (uint32)
+        entries sorted by name: count x (name offset, name length, record offset, record length)
+        permutation of the entries sorted by lowercased name: count x uint32
+        names blob (UTF-8)
+        records blob (one JSON document per instance detail)
+
+    Offsets inside a section are relative to the section so untouched sections
+    are copied as is when the index is rewritten. Readers only decode the
+    names and records they touch.
+"""
+
+import os
+import json
+import mmap
+import struct
+
+from . import storage
+
+# Default file name of the index in the config directory
+filename = 'index.bin'
+
+magic = b'CSSHIDX1'
+header = struct.Struct('<8sI')
+count_struct = struct.Struct('<I')
+entry_struct = struct.Struct('<IIII')
+position_struct = struct.Struct('<I')
+
+
+def open_index(path):
+    """ Return the memory map and the table of an index, or `(None, {})` """
+
+    if not os.path.isfile(path):
+        return None, {}
+
+    if os.path.getsize(path) < header.size:
+        raise RuntimeError('%s is not a valid cloudssh index' % (path))
+
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    file_magic, table_length = header.unpack_from(mm, 0)
+    if file_magic != magic:
+        mm.close()
+        raise RuntimeError('%s is not a valid cloudssh index' % (path))
+
+    table = json.loads(mm[header.size:header.size + table_length])
+
+    # Make section offsets absolute
+    for profile_regions in table.values():
+        for section in profile_regions.values():
+            section[0] += header.size + table_length
+
+    return mm, table
+
+
+def get_section(table, profile, region):
+    """ Return `(offset, length)` of a region section or None """
+
+    section = table.get(profile, {}).get(region)
+
+    return (section[0], section[1]) if section else None
+
+
+def read_count(mm, offset):
+    """ Return the number of instances in a section """
+
+    return count_struct.unpack_from(mm, offset)[0]
+
+
+def read_entry(mm, offset, i):
+    """ Return the entry `i` of a section """
+
+    return entry_struct.unpack_from(mm, offset + count_struct.size + i * entry_struct.size)
+
+
+def read_name(mm, offset, entry):
+    """ Return the name of an entry """
+
+    return mm[offset + entry[0]:offset + entry[0] + entry[1]].decode('utf-8')
+
+
+def read_record(mm, offset, entry):
+    """ Decode the record of an entry """
+
+    return {
+        'name': read_name(mm, offset, entry),
+        'detail': json.loads(mm[offset + entry[2]:offset + entry[2] + entry[3]])
+    }
+
+
+def read_position(mm, offset, count, i):
+    """ Return the entry at position `i` in lowercased name order """
+
+    start = offset + count_struct.size + count * entry_struct.size
+
+    return position_struct.unpack_from(mm, start + i * position_struct.size)[0]
+
+
+def iter_entries(mm, offset):
+    """ Yield every entry of a section sorted by name """
+
+    for i in range(read_count(mm, offset)):
+        yield read_entry(mm, offset, i)
+
+
+def pack_section(instances_list):
+    """ Return the bytes of a region section """
+
+    instances_list = sorted(instances_list, key=lambda k: k['name'])
+    names = [i['name'].encode('utf-8') for i in instances_list]
+    records = [json.dumps(i['detail']).encode('utf-8')
+               for i in instances_list]
+    count = len(instances_list)
+
+    # Names and records are stored after the entries and the permutation
+    position = count_struct.size + count * \
+        (entry_struct.size + position_struct.size)
+    entries = []
+    for name in names:
+        entries.append([position, len(name)])
+        position += len(name)
+    for i, record in enumerate(records):
+        entries[i].extend([position, len(record)])
+        position += len(record)
+
+    lower_order = sorted(
+        range(count), key=lambda i: instances_list[i]['name'].lower())
+
+    content = [count_struct.pack(count)]
+    content.extend(entry_struct.pack(*entry) for entry in entries)
+    content.extend(position_struct.pack(i) for i in lower_order)
+    content.extend(names)
+    content.extend(records)
+
+    return b''.join(content)
+
+
+def write_regions(path, updates):
+    """
+        Replace the instances lists of several profiles/regions.
+        `updates` is a dict `{(profile, region): (instances_list, refreshed_at)}`,
+        an `instances_list` set to None only updates the refresh timestamp.
+        Untouched sections are copied from the current index without being decoded.
+    """
+
+    # Concurrent writers would drop each other's regions
+    with storage.locked(path):
+        mm, table = open_index(path)
+        try:
+            # `{(profile, region): (offset in the current index or None, length, refreshed_at)}`
+            sections = {(profile, region): tuple(section)
+                        for profile, profile_regions in table.items()
+                        for region, section in profile_regions.items()}
+
+            # Only the updated sections are packed in memory
+            packed = {}
+            for key, (instances_list, refreshed_at) in updates.items():
+                if instances_list is None and key in sections:
+                    sections[key] = sections[key][:2] + (refreshed_at,)
+                else:
+                    packed[key] = pack_section(instances_list or [])
+                    sections[key] = (None, len(packed[key]), refreshed_at)
+
+            new_table = {}
+            position = 0
+            for (profile, region), (offset, length, refreshed_at) in sections.items():
+                new_table.setdefault(profile, {})[region] = [
+                    position, length, refreshed_at]
+                position += length
+            table_bytes = json.dumps(new_table).encode('utf-8')
+
+            # Write the sections one by one to a temporary file then swap it in
+            with storage.open_atomically(path, 'wb') as f:
+                f.write(header.pack(magic, len(table_bytes)))
+                f.write(table_bytes)
+                for key, (offset, length, refreshed_at) in sections.items():
+                    if offset is None:
+                        f.write(packed.pop(key))
+                    else:
+                        f.write(mm[offset:offset + length])
+        finally:
+            if mm:
+                mm.close()
+
+    return True
+
+
+def read_refreshed_at(path):
+    """ Return the last refresh timestamps as `{profile: {region: timestamp}}` """
+
+    mm, table = open_index(path)
+    if mm:
+        mm.close()
+
+    return {profile: {region: section[2] for region, section in profile_regions.items()}
+            for profile, profile_regions in table.items()}
+
+
+def read_region(path, profile, region):
+    """ Return the instances list of a profile/region sorted by name """
+
+    mm, table = open_index(path)
+    try:
+        section = get_section(table, profile, region)
+        if not section:
+            return []
+
+        return [read_record(mm, section[0], entry) for entry in iter_entries(mm, section[0])]
+    finally:
+        if mm:
+            mm.close()
+
+
+def read_names(path, profile, region):
+    """ Return the names of a profile/region sorted, without decoding the records """
+
+    mm, table = open_index(path)
+    try:
+        section = get_section(table, profile, region)
+        if not section:
+            return []
+
+        return [read_name(mm, section[0], entry) for entry in iter_entries(mm, section[0])]
+    finally:
+        if mm:
+            mm.close()
+
+
+def lookup(path, profile, region, name):
+    """ Return the first instance matching a name (case insensitive) or None """
+
+    mm, table = open_index(path)
+    try:
+        section = get_section(table, profile, region)
+        if not section:
+            return None
+
+        offset = section[0]
+        count = read_count(mm, offset)
+        name = name.lower()
+
+        # Binary search on the lowercased names
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            entry = read_entry(mm, offset, read_position(
+                mm, offset, count, middle))
+            if read_name(mm, offset, entry).lower() < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < count:
+            entry = read_entry(mm, offset, read_position(
+                mm, offset, count, low))
+            if read_name(mm, offset, entry).lower() == name:
+                return read_record(mm, offset, entry)
+
+        return None
+    finally:
+        if mm:
+            mm.close()
+
+
+def find_by(path, profile, region, field, value):
+    """ Return the instances of a profile/region with `detail[field] == value` """
+
+    storage.check_indexed_field(field)
+
+    # The value as it is serialized in the records
+    needle = json.dumps(value).encode('utf-8')
+
+    mm, table = open_index(path)
+    try:
+        section = get_section(table, profile, region)
+        if not section:
+            return []
+
+        # Only decode the records containing the value
+        offset = section[0]
+        records = (read_record(mm, offset, entry) for entry in iter_entries(mm, offset)
+                   if mm.find(needle, offset + entry[2], offset + entry[2] + entry[3]) >= 0)
+
+        return [i for i in records if i['detail'].get(field) == value]
+    finally:
+        if mm:
+            mm.close()
+
+
+def search(path, profile, region, query):
+    """ Return the instances whose name contains `query` (case insensitive) """
+
+    mm, table = open_index(path)
+    try:
+        section = get_section(table, profile, region)
+        if not section:
+            return []
+
+        # Only decode the records of the matching names
+        query = query.lower()
+        return [read_record(mm, section[0], entry) for entry in iter_entries(mm, section[0])
+                if query in read_name(mm, section[0], entry).lower()]
+    finally:
+        if mm:
+            mm.close()
@@ -0,0 +1,122 @@
+"""
+    Sharded index: one JSON file per profile/region in a directory.
+
+    Layout:
+        manifest.json                   {profile: {region: {'count': n, 'refreshed_at': ts}}}
+        <profile>.<region>.json         instances list of a profile/region
+        <profile>.<region>.json.lock    lock of a shard
+
+    Writing a region only rewrites its shard (temporary file then rename,
+    under the shard lock) and updates the manifest under its own lock, so
+    refreshes of different regions can run concurrently. Readers only open
+    the shard of the profile/region they need.
+"""
+
+import os
+import json
+from urllib.parse import quote
+
+from . import storage
+
+# Default directory name of the index in the config directory
+filename = 'index.d'
+
+manifest_filename = 'manifest.json'
+
+
+def get_shard_path(path, profile, region):
+    """ Return the path of the shard of a profile/region """
+
+    return os.path.join(path, '%s.%s.json' % (quote(profile, safe=''), quote(region, safe='')))
+
+
+def read_json(file_path, default):
+    """ Read a JSON file or return `default` if it does not exist """
+
+    if not os.path.isfile(file_path):
+        return default
+
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def write_json(file_path, content):
+    """ Write a JSON file to a temporary file then swap it in """
+
+    with storage.open_atomically(file_path) as f:
+        json.dump(content, f)
+
+
+def read_manifest(path):
+    """ Return the manifest of an index """
+
+    return read_json(os.path.join(path, manifest_filename), {})
+
+
+def write_regions(path, updates):
+    """
+        Replace the instances lists of several profiles/regions.
+        `updates` is a dict `{(profile, region): (instances_list, refreshed_at)}`,
+        an `instances_list` set to None only updates the refresh timestamp.
+        Only the shards of the updated regions are rewritten.
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    counts = {}
+    for (profile, region), (instances_list, refreshed_at) in updates.items():
+        if instances_list is not None:
+            shard_path = get_shard_path(path, profile, region)
+            with storage.locked(shard_path):
+                write_json(shard_path, sorted(
+                    instances_list, key=lambda k: k['name']))
+            counts[(profile, region)] = len(instances_list)
+
+    manifest_path = os.path.join(path, manifest_filename)
+    with storage.locked(manifest_path):
+        manifest = read_json(manifest_path, {})
+        for (profile, region), (instances_list, refreshed_at) in updates.items():
+            entry = manifest.setdefault(profile, {}).setdefault(
+                region, {'count': 0})
+            entry['count'] = counts.get((profile, region), entry['count'])
+            entry['refreshed_at'] = refreshed_at
+        write_json(manifest_path, manifest)
+
+    return True
+
+
+def read_refreshed_at(path):
+    """ Return the last refresh timestamps as `{profile: {region: timestamp}}` """
+
+    return {profile: {region: entry.get('refreshed_at') for region, entry in profile_regions.items()}
+            for profile, profile_regions in read_manifest(path).items()}
+
+
+def read_region(path, profile, region):
+    """ Return the instances list of a profile/region sorted by name """
+
+    return read_json(get_shard_path(path, profile, region), [])
+
+
+def read_names(path, profile, region):
+    """ Return the names of a profile/region sorted """
+
+    return [i['name'] for i in read_region(path, profile, region)]
+
+
+def lookup(path, profile, region, name):
+    """ Return the first instance matching a name (case insensitive) or None """
+
+    return storage.lookup(read_region(path, profile, region), name)
+
+
+def find_by(path, profile, region, field, value):
+    """ Return the instances of a profile/region with `detail[field] == value` """
+
+    return storage.find_by(read_region(path, profile, region), field, value)
+
+
+def search(path, profile, region, query):
+    """ Return the instances whose name contains `query` (case insensitive) """
+
+    return storage.search(read_region(path, profile, region), query)
@@ -0,0 +1,265 @@
+import json
+import sqlite3
+
+from . import storage
+
+# Default file name of the index in the config directory
+filename = 'index.sqlite'
+
+schema = """
+    CREATE TABLE IF NOT EXISTS instances (
+        profile TEXT NOT NULL,
+        region TEXT NOT NULL,
+        name TEXT NOT NULL,
+        name_lower TEXT NOT NULL,
+        id TEXT,
+        public_ip TEXT,
+        private_ip TEXT,
+        detail TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS instances_name ON instances (profile, region, name);
+    CREATE INDEX IF NOT EXISTS instances_name_lower ON instances (profile, region, name_lower);
+    CREATE INDEX IF NOT EXISTS instances_id ON instances (profile, region, id);
+    CREATE INDEX IF NOT EXISTS instances_public_ip ON instances (profile, region, public_ip);
+    CREATE INDEX IF NOT EXISTS instances_private_ip ON instances (profile, region, private_ip);
+
+    CREATE TABLE IF NOT EXISTS tags (
+        profile TEXT NOT NULL,
+        region TEXT NOT NULL,
+        instance_id TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT
+    );
+    CREATE INDEX IF NOT EXISTS tags_key_value_lower ON tags (profile, region, lower(key), lower(value));
+
+    CREATE TABLE IF NOT EXISTS refreshed_at (
+        profile TEXT NOT NULL,
+        region TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        PRIMARY KEY (profile, region)
+    );
+"""
+
+
+def connect(path):
+    """ Open the index database and create the schema if necessary """
+
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+
+    return conn
+
+
+def to_record(row):
+    """ Return an index record from a `(name, detail)` row """
+
+    return {'name': row[0], 'detail': json.loads(row[1])}
+
+
+def read_region(path, profile, region):
+    """ Return the instances list of a profile/region sorted by name """
+
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            'SELECT name, detail FROM instances WHERE profile = ? AND region = ? ORDER BY name',
+            (profile, region))
+        return [to_record(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def read_names(path, profile, region):
+    """ Return the names of a profile/region sorted """
+
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            'SELECT name FROM instances WHERE profile = ? AND region = ? ORDER BY name',
+            (profile, region))
+        return [row[0] for row in rows]
+    finally:
+        conn.close()
+
+
+def get_row_key(name, instance_id):
+    """ Return the key matching an indexed instance with its new version: its ID, else its name """
+
+    return instance_id or name
+
+
+def get_row(instance):
+    """ Return the `(name, name_lower, id, public_ip, private_ip, detail)` columns of an instance """
+
+    detail = instance['detail']
+
+    return (instance['name'], instance['name'].lower(),
+            detail.get('id'), detail.get('public_ip'), detail.get('private_ip'),
+            json.dumps(detail))
+
+
+def insert_tags(conn, profile, region, instance):
+    """ Insert the tags of an instance, joined on its ID """
+
+    detail = instance['detail']
+    if detail.get('id'):
+        conn.executemany(
+            'INSERT INTO tags VALUES (?, ?, ?, ?, ?)',
+            [(profile, region, detail['id'], tag.get('Key'), tag.get('Value'))
+             for tag in detail.get('tags') or []])
+
+
+def delete_tags(conn, profile, region, instance_id):
+    """ Delete the tags of an instance """
+
+    if instance_id:
+        conn.execute(
+            'DELETE FROM tags WHERE profile = ? AND region = ? AND instance_id = ?',
+            (profile, region, instance_id))
+
+
+def write_instances(conn, profile, region, instances_list):
+    """
+        Replace the instances list of a profile/region by only writing the rows
+        that changed: new, modified (same ID, or same name without ID) and removed instances.
+    """
+
+    # `{key: [(rowid, id, name, detail)]}` of the indexed rows
+    existing = {}
+    rows = conn.execute(
+        'SELECT rowid, id, name, detail FROM instances WHERE profile = ? AND region = ?',
+        (profile, region))
+    for row in rows:
+        existing.setdefault(get_row_key(row[2], row[1]), []).append(row)
+
+    for instance in instances_list:
+        row = get_row(instance)
+        matches = existing.get(get_row_key(instance['name'], row[2]))
+        if not matches:
+            conn.execute(
+                '''INSERT INTO instances (profile, region, name, name_lower, id, public_ip, private_ip, detail)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', (profile, region) + row)
+            insert_tags(conn, profile, region, instance)
+            continue
+
+        rowid, instance_id, name, detail = matches.pop()
+        if (name, detail) != (row[0], row[5]):
+            conn.execute(
+                '''UPDATE instances SET name = ?, name_lower = ?, id = ?, public_ip = ?, private_ip = ?,
+                    detail = ? WHERE rowid = ?''', row + (rowid,))
+            delete_tags(conn, profile, region, instance_id)
+            insert_tags(conn, profile, region, instance)
+
+    # Instances that are gone
+    for matches in existing.values():
+        for rowid, instance_id, name, detail in matches:
+            conn.execute('DELETE FROM instances WHERE rowid = ?', (rowid,))
+            delete_tags(conn, profile, region, instance_id)
+
+
+def write_regions(path, updates):
+    """
+        Replace the instances lists of several profiles/regions in one transaction.
+        `updates` is a dict `{(profile, region): (instances_list, refreshed_at)}`,
+        an `instances_list` set to None only updates the refresh timestamp.
+        Only the rows of the instances that changed are written.
+    """
+
+    conn = connect(path)
+    try:
+        with conn:
+            for (profile, region), (instances_list, refreshed_at) in updates.items():
+                if instances_list is not None:
+                    write_instances(conn, profile, region, instances_list)
+
+                conn.execute(
+                    'INSERT OR REPLACE INTO refreshed_at VALUES (?, ?, ?)',
+                    (profile, region, refreshed_at))
+    finally:
+        conn.close()
+
+    return True
+
+
+def read_refreshed_at(path):
+    """ Return the last refresh timestamps as `{profile: {region: timestamp}}` """
+
+    conn = connect(path)
+    try:
+        refreshed_at = {}
+        for profile, region, timestamp in conn.execute('SELECT profile, region, timestamp FROM refreshed_at'):
+            refreshed_at.setdefault(profile, {})[region] = timestamp
+        return refreshed_at
+    finally:
+        conn.close()
+
+
+def lookup(path, profile, region, name):
+    """ Return the first instance matching a name (case insensitive) or None """
+
+    conn = connect(path)
+    try:
+        row = conn.execute(
+            'SELECT name, detail FROM instances WHERE profile = ? AND region = ? AND name_lower = ? ORDER BY name LIMIT 1',
+            (profile, region, name.lower())).fetchone()
+        return to_record(row) if row else None
+    finally:
+        conn.close()
+
+
+def find_by(path, profile, region, field, value):
+    """ Return the instances matching an indexed field (`storage.indexed_fields`) """
+
+    storage.check_indexed_field(field)
+
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            'SELECT name, detail FROM instances WHERE profile = ? AND region = ? AND %s = ? ORDER BY name' % (
+                field),
+            (profile, region, value))
+        return [to_record(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def find_by_tags(path, profile, region, predicates):
+    """
+        Return the instances matching every tag predicate `(key, operator, value)`
+        of `search_index.parse_tag_query()`: `=` is an exact match and `~` a glob,
+        both case insensitive.
+    """
+
+    clauses = []
+    parameters = [profile, region]
+    for key, operator, value in predicates:
+        if operator == '=':
+            clauses.append('lower(value) = ?')
+        else:  # `fnmatch` negates a set with `[!...]`, SQLite with `[^...]`
+            clauses.append('lower(value) GLOB ?')
+            value = value.replace('[!', '[^')
+        parameters += [profile, region, key.lower(), value.lower()]
+
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            'SELECT name, detail FROM instances WHERE profile = ? AND region = ?' + ''.join(
+                ' AND id IN (SELECT instance_id FROM tags WHERE profile = ? AND region = ? AND lower(key) = ? AND %s)' % (clause)
+                for clause in clauses) + ' ORDER BY name',
+            parameters)
+        return [to_record(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def search(path, profile, region, query):
+    """ Return the instances whose name contains `query` (case insensitive) """
+
+    conn = connect(path)
+    try:
+        rows = conn.execute(
+            'SELECT name, detail FROM instances WHERE profile = ? AND region = ? AND instr(name_lower, ?) > 0 ORDER BY name',
+            (profile, region, query.lower()))
+        return [to_record(row) for row in rows]
+    finally:
+        conn.close()
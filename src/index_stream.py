@@ -0,0 +1,248 @@
+"""
+    Streaming reader and writer of the JSON index.
+
+    The index is written as regular JSON with one instance per line:
+
+        {
+        "profile": {
+        "region": [
+        {"name": ..., "detail": ...},
+        {"name": ..., "detail": ...}
+        ],
+        "other-region": []
+        },
+        "_refreshed_at": {"profile": {"region": 1700000000.0}}
+        }
+
+    so a region can be rewritten while the instances arrive and the untouched
+    regions are copied line by line without being decoded. Memory stays
+    bounded by the size of one instance instead of the whole index.
+    Indexes written in one line by older versions are decoded once and
+    rewritten in this layout.
+"""
+
+import os
+import json
+
+from . import storage
+
+decoder = json.JSONDecoder()
+
+# Instances are written with their name first
+name_prefix = '{"name": '
+
+
+def parse_key(line):
+    """ Return the key and the raw value (without trailing comma) of a `"key": value` line """
+
+    key, end = decoder.raw_decode(line)
+    value = line[end:].lstrip()[1:].strip()
+
+    return key, value[:-1] if value.endswith(',') else value
+
+
+def iter_record_lines(f):
+    """ Yield the instances of a region (JSON, one per line) until its closing bracket """
+
+    for line in f:
+        line = line.strip()
+        if line in (']', '],'):
+            return
+        yield line[:-1] if line.endswith(',') else line
+
+
+def iter_content_sections(content):
+    """ Yield the sections of a decoded index """
+
+    for key, value in content.items():
+        if key == '_refreshed_at':
+            yield ('refreshed_at', value)
+            continue
+
+        yield ('profile_start', key)
+        for region_name, instances_list in value.items():
+            yield ('region', key, region_name, (json.dumps(i) for i in instances_list))
+        yield ('profile_end', key)
+
+
+def iter_sections(path):
+    """
+        Yield the sections of an index file:
+            ('profile_start', profile)
+            ('region', profile, region, iterator of the JSON instances)
+            ('profile_end', profile)
+            ('refreshed_at', {profile: {region: timestamp}})
+        A region iterator is only valid until the next section.
+    """
+
+    if not os.path.isfile(path):
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        if f.readline().strip() != '{':  # Written in one line by older versions
+            f.seek(0)
+            content = f.read()
+            yield from iter_content_sections(json.loads(content) if content.strip() else {})
+            return
+
+        profile_name = None
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            if profile_name is None:  # Top level
+                if line == '}':
+                    return
+                key, value = parse_key(line)
+                if value == '{':
+                    profile_name = key
+                    yield ('profile_start', key)
+                else:  # Value on a single line
+                    yield from iter_content_sections({key: json.loads(value)})
+            elif line in ('}', '},'):
+                yield ('profile_end', profile_name)
+                profile_name = None
+            else:  # Region of a profile
+                key, value = parse_key(line)
+                if value == '[':
+                    records = iter_record_lines(f)
+                    yield ('region', profile_name, key, records)
+
+                    # Skip what the consumer did not read
+                    for record in records:
+                        pass
+                else:
+                    yield ('region', profile_name, key, (json.dumps(i) for i in json.loads(value)))
+
+
+def write_region(f, first, region_name, records):
+    """ Write a region from an iterable of JSON instances """
+
+    f.write('%s%s: [' % ('\n' if first else ',\n', json.dumps(region_name)))
+
+    count = 0
+    for record in records:
+        f.write(('\n' if count == 0 else ',\n') + record)
+        count += 1
+
+    f.write('\n]' if count else ']')
+
+
+def write_regions(path, updates):
+    """
+        Replace the instances lists of several profiles/regions.
+        `updates` is a dict `{(profile, region): (instances, refreshed_at)}` where
+        `instances` is any iterable (e.g. a generator fed by the AWS pages) or
+        None to only update the refresh timestamp. The other regions are
+        copied without being decoded, then the new file is swapped in.
+    """
+
+    # Discarded if e.g. the AWS pages fail mid-write
+    with storage.open_atomically(path) as f:
+        write_sections(f, path, updates)
+
+    return True
+
+
+def write_sections(f, path, updates):
+    """ Write the index at `path` to `f` with the regions of `updates` replaced """
+
+    # Regions to write, in the order of `updates`
+    pending = {}
+    for (profile_name, region_name), (instances, refreshed_at) in updates.items():
+        if instances is not None:
+            pending.setdefault(profile_name, {})[region_name] = instances
+
+    refreshed = {}
+
+    f.write('{')
+
+    profiles_count = 0
+    regions_count = 0
+    for section in iter_sections(path):
+        if section[0] == 'refreshed_at':
+            refreshed = section[1]
+        elif section[0] == 'profile_start':
+            f.write('%s%s: {' % ('\n' if profiles_count == 0 else ',\n', json.dumps(section[1])))
+            profiles_count += 1
+            regions_count = 0
+        elif section[0] == 'region':
+            profile_name, region_name, records = section[1:]
+            if region_name in pending.get(profile_name, {}):
+                records = (json.dumps(i) for i in pending[profile_name].pop(region_name))
+            write_region(f, regions_count == 0, region_name, records)
+            regions_count += 1
+        elif section[0] == 'profile_end':
+            # New regions of an existing profile
+            for region_name, instances in pending.pop(section[1], {}).items():
+                write_region(f, regions_count == 0, region_name,
+                             (json.dumps(i) for i in instances))
+                regions_count += 1
+            f.write('\n}')
+
+    # New profiles
+    for profile_name, profile_regions in pending.items():
+        f.write('%s%s: {' % ('\n' if profiles_count == 0 else ',\n', json.dumps(profile_name)))
+        profiles_count += 1
+        for position, (region_name, instances) in enumerate(profile_regions.items()):
+            write_region(f, position == 0, region_name,
+                         (json.dumps(i) for i in instances))
+        f.write('\n}')
+
+    for (profile_name, region_name), (instances, refreshed_at) in updates.items():
+        refreshed.setdefault(profile_name, {})[region_name] = refreshed_at
+    f.write('%s"_refreshed_at": %s\n}\n' % (
+        '\n' if profiles_count == 0 else ',\n', json.dumps(refreshed)))
+
+
+def iter_region(path, profile_name, region_name):
+    """ Yield the instances of a profile/region one at a time, only decoding this region """
+
+    for section in iter_sections(path):
+        if section[0] == 'region' and section[1:3] == (profile_name, region_name):
+            for record in section[3]:
+                yield json.loads(record)
+            return
+
+
+def read_region(path, profile_name, region_name):
+    """ Return the instances list of a profile/region, only decoding this region """
+
+    return list(iter_region(path, profile_name, region_name))
+
+
+def read_regions(path):
+    """ Return the `(profile, region)` pairs of an index without decoding the instances """
+
+    return [section[1:3] for section in iter_sections(path) if section[0] == 'region']
+
+
+def read_name(record):
+    """ Return the name of a JSON instance without decoding its detail """
+
+    if record.startswith(name_prefix):
+        return decoder.raw_decode(record, len(name_prefix))[0]
+
+    return json.loads(record)['name']
+
+
+def read_names(path, profile_name, region_name):
+    """ Return the names of a profile/region, only decoding the names """
+
+    for section in iter_sections(path):
+        if section[0] == 'region' and section[1:3] == (profile_name, region_name):
+            return [read_name(record) for record in section[3]]
+
+    return []
+
+
+def read_refreshed_at(path):
+    """ Return the last refresh timestamps as `{profile: {region: timestamp}}` """
+
+    refreshed = {}
+    for section in iter_sections(path):
+        if section[0] == 'refreshed_at':
+            refreshed = section[1]
+
+    return refreshed
@@ -0,0 +1,69 @@
+"""
+    Concurrent TCP reachability probing.
+
+    Every address gets a non-blocking connection at once and a single
+    selector waits for all of them until a shared deadline, so probing a
+    group of instances takes one probe window instead of serial timeouts.
+"""
+
+import time
+import errno
+import socket
+import selectors
+
+
+def probe(addresses, port=22, timeout=1.0):
+    """
+        Open a TCP connection to every address concurrently (an address can
+        also be a `(host, port)` tuple). Returns `{address: connect latency in
+        seconds}` with None for the addresses that refused the connection or
+        did not answer in time.
+    """
+
+    results = {address: None for address in addresses}
+    selector = selectors.DefaultSelector()
+    deadline = time.monotonic() + timeout
+
+    try:
+        for address in results:
+            host, host_port = address if isinstance(
+                address, tuple) else (address, port)
+            try:
+                sock = socket.socket(
+                    socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+            except OSError:
+                continue
+
+            sock.setblocking(False)
+            started = time.monotonic()
+            try:
+                code = sock.connect_ex((host, host_port))
+            except OSError:  # Unresolvable host name
+                code = errno.EHOSTUNREACH
+            if code == 0:  # Connected immediately (e.g. loopback)
+                results[address] = time.monotonic() - started
+                sock.close()
+            elif code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                selector.register(sock, selectors.EVENT_WRITE,
+                                  (address, started))
+            else:  # Refused or unroutable
+                sock.close()
+
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            for key, events in selector.select(remaining):
+                address, started = key.data
+                if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    results[address] = time.monotonic() - started
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+    finally:
+        # Give up on the connections still pending at the deadline
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+    return results
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+from fnmatch import fnmatchcase
+
+from . import storage
+
+
+def trigrams(text):
+    """ Return the set of trigrams of a case folded and padded string """
+
+    text = '  %s ' % (text.lower())
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def build(instances_list):
+    """ Return the search index of an instances list """
+
+    search_index = new()
+    for instance in instances_list:
+        add(search_index, instance)
+
+    return finish(search_index)
+
+
+def new():
+    """ Return an empty search index to fill with `add()` """
+
+    return {'names': [], 'trigrams': {}, 'tags': {}}
+
+
+def add(search_index, instance):
+    """
+        Add an instance to a search index being built. Only its name and
+        postings are kept so an index can be built while the instances stream.
+    """
+
+    position = len(search_index['names'])
+    search_index['names'].append(instance['name'])
+
+    # Inverted index: trigram -> positions in `names`
+    for trigram in trigrams(instance['name']):
+        search_index['trigrams'].setdefault(trigram, []).append(position)
+
+    # Inverted index: case folded tag key -> value -> positions in `names`
+    for tag in (instance.get('detail') or {}).get('tags') or []:
+        if tag.get('Key') is None:
+            continue
+        search_index['tags'].setdefault(sys.intern(tag['Key'].lower()), {}).setdefault(
+            sys.intern((tag.get('Value') or '').lower()), []).append(position)
+
+
+def finish(search_index):
+    """ Sort the names of a search index built with `add()` and renumber its postings """
+
+    names = search_index['names']
+    order = sorted(range(len(names)), key=names.__getitem__)
+    positions = [0] * len(names)
+    for new_position, position in enumerate(order):
+        positions[position] = new_position
+
+    def renumber(postings):
+        return sorted(positions[position] for position in postings)
+
+    return {
+        'names': [names[position] for position in order],
+        'trigrams': {trigram: renumber(postings) for trigram, postings in search_index['trigrams'].items()},
+        'tags': {key: {value: renumber(postings) for value, postings in values.items()}
+                 for key, values in search_index['tags'].items()},
+    }
+
+
+def read(path):
+    """ Read a search index file or return None """
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write(path, search_index):
+    """ Write a search index file """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # A temporary file per writer, concurrent refreshes can write the same region
+    with storage.open_atomically(path) as f:
+        json.dump(search_index, f)
+
+    return True
+
+
+def score(query, name, shared, total):
+    """
+        Score a name against a case folded query: share of the query trigrams
+        found in the name plus bonuses for exact, prefix, word boundary and
+        contiguous matches
+    """
+
+    name = name.lower()
+    value = shared / total
+
+    if name == query:
+        value += 4
+    elif name.startswith(query):
+        value += 3
+    else:
+        position = name.find(query)
+        if position > 0:
+            value += 1
+            # Match at the beginning of a word
+            if not name[position - 1].isalnum():
+                value += 1
+
+    return value
+
+
+def fuzzy_search(query, search_index, limit=10, min_similarity=0.3):
+    """
+        Return up to `limit` names matching `query` (typos allowed),
+        best match first
+    """
+
+    query = query.lower().strip()
+    query_trigrams = trigrams(query)
+    names = search_index['names']
+
+    # Count the query trigrams shared with each name
+    shared = {}
+    for trigram in query_trigrams:
+        for position in search_index['trigrams'].get(trigram, []):
+            shared[position] = shared.get(position, 0) + 1
+
+    minimum = max(1, int(len(query_trigrams) * min_similarity))
+    ranked = sorted(
+        ((score(query, names[position], count, len(query_trigrams)), names[position])
+         for position, count in shared.items() if count >= minimum),
+        key=lambda k: (-k[0], len(k[1]), k[1]))
+
+    return [name for value, name in ranked[:limit]]
+
+
+def parse_tag_query(query):
+    """
+        Parse a tag query like `env=prod role=web az~us-east-1*` into a list
+        of `(key, operator, value)`. `=` is an exact match and `~` a glob.
+        Returns None if the query is not a tag query.
+    """
+
+    predicates = []
+    for token in query.split():
+        position = min((token.find(operator) for operator in '=~' if token.find(operator) > 0),
+                       default=-1)
+        if position < 0:
+            return None
+        predicates.append(
+            (token[:position].lower(), token[position], token[position + 1:].lower()))
+
+    return predicates or None
+
+
+def tag_search(predicates, search_index):
+    """ Return the names matching every tag predicate (AND) """
+
+    postings = []
+    for key, operator, value in predicates:
+        values = search_index['tags'].get(key, {})
+        if operator == '=':
+            postings.append(set(values.get(value, [])))
+        else:  # Glob: union the postings of the matching values
+            postings.append({position for candidate, positions in values.items()
+                             if fnmatchcase(candidate, value) for position in positions})
+
+    # Intersect the smallest postings first
+    postings.sort(key=len)
+    matches = postings[0]
+    for positions in postings[1:]:
+        if not matches:
+            break
+        matches = matches & positions
+
+    return [search_index['names'][position] for position in sorted(matches)]
@@ -0,0 +1,75 @@
+"""
+    Helpers shared by the index storage engines (`index_sqlite`, `index_mmap`
+    and `index_sharded`) and by the writers of the files of the config directory.
+"""
+
+import os
+import fcntl
+from contextlib import contextmanager
+
+# Detail fields that can be queried with `find_by()`
+indexed_fields = ['id', 'public_ip', 'private_ip']
+
+
+def check_indexed_field(field):
+    """ Raise a ValueError if `find_by()` can't query a field """
+
+    if field not in indexed_fields:
+        raise ValueError('%s is not an indexed field' % (field))
+
+
+def find_by(instances_list, field, value):
+    """ Return the instances with `detail[field] == value` """
+
+    check_indexed_field(field)
+
+    return [i for i in instances_list if i['detail'].get(field) == value]
+
+
+def lookup(instances_list, name):
+    """ Return the first instance matching a name (case insensitive) or None """
+
+    name = name.lower()
+
+    return next((i for i in instances_list if i['name'].lower() == name), None)
+
+
+def search(instances_list, query):
+    """ Return the instances whose name contains `query` (case insensitive) """
+
+    query = query.lower()
+
+    return [i for i in instances_list if query in i['name'].lower()]
+
+
+@contextmanager
+def locked(file_path):
+    """ Hold an exclusive lock on `file_path` (through a `.lock` file) """
+
+    with open(file_path + '.lock', 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def open_atomically(path, mode='w'):
+    """
+        Open a temporary file of its own in the directory of `path` for
+        writing (`mode` is 'w' or 'wb'), swapped in when the block succeeds
+        and removed otherwise
+    """
+
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
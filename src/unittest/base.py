@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 
 
@@ -10,3 +12,44 @@ class BaseTest(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         pass
+
+
+class EngineTest(object):
+    """ Fixture of the index storage engine tests, mixed in before `BaseTest` """
+
+    engine = None
+
+    instances_list = [
+        {
+            'name': 'web-2',
+            'detail': {
+                'id': 'i-2',
+                'public_ip': '1.2.3.5',
+                'private_ip': '10.0.0.2',
+                'vpc': 'vpc-1',
+                'tags': [{'Key': 'Name', 'Value': 'web-2'}, {'Key': 'env', 'Value': 'prod'}]
+            }
+        },
+        {
+            'name': 'Web-1',
+            'detail': {
+                'id': 'i-1',
+                'public_ip': '1.2.3.4',
+                'private_ip': '10.0.0.1',
+                'vpc': 'vpc-1',
+                'tags': [{'Key': 'Name', 'Value': 'Web-1'}, {'Key': 'env', 'Value': 'dev'}]
+            }
+        },
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, self.engine.filename)
+
+        self.engine.write_regions(self.path, {
+            ('prod', 'us-east-1'): (self.instances_list, 1000),
+            ('prod', 'us-west-1'): ([], 2000),
+        })
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
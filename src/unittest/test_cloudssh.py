@@ -1,16 +1,20 @@
 
 import os
+import json
 import sys
 import tempfile
+import time
+import subprocess
 from unittest import mock
 from hashlib import sha1
 from random import random
 from io import StringIO
+from copy import deepcopy
 
 import argparse
 
 from .base import BaseTest
-from .. import cloudssh
+from .. import cloudssh, index_stream
 
 
 class Test(BaseTest):
@@ -133,7 +137,7 @@ class Test(BaseTest):
         self.tmp_config_dir.cleanup()
 
     @mock.patch('argparse.ArgumentParser.parse_args',
-                return_value=argparse.Namespace(region=None, build_index=None, instance='my_server', search=None, info=None))
+                return_value=argparse.Namespace(region=None, build_index=None, all_regions=None, refresh=None, export_ssh_config=None, instance='my_server', search=None, fuzzy=None, limit=None, probe=None, info=None, exec_command=None, parallel=None, close=None, completion=None, timings=None, daemon=None))
     def test_parse_cli_args(self, mock_args):
 
         args = cloudssh.parse_cli_args()
@@ -141,7 +145,20 @@ class Test(BaseTest):
         assert type(args) is dict
         assert args['region'] is None  # defaulted to None
         assert args['build_index'] is False  # defaulted to False
+        assert args['all_regions'] is False  # defaulted to False
+        assert args['profiles'] is None  # defaulted to None
+        assert args['refresh'] is False  # defaulted to False
+        assert args['export_ssh_config'] is False  # defaulted to False
+        assert args['fuzzy'] is False  # defaulted to False
+        assert args['limit'] == 10  # defaulted to 10
+        assert args['probe'] is False  # defaulted to False
         assert args['info'] is None  # defaulted to None
+        assert args['exec'] is None  # defaulted to None
+        assert args['parallel'] is None  # defaulted to None
+        assert args['close'] is False  # defaulted to False
+        assert args['completion'] is None  # defaulted to None
+        assert args['timings'] is False  # defaulted to False
+        assert args['daemon'] is False  # defaulted to False
 
     def test_parse_user_config(self):
 
@@ -175,6 +192,12 @@ class Test(BaseTest):
         # Invalid region name
         self.assertRaises(RuntimeError, cloudssh.set_region, 'us-invalid-1')
 
+        # A region that is not in the list once indexed
+        with mock.patch.object(cloudssh, 'get_index_regions', return_value=[('cloud_ssh_unittest', 'ap-east-2')]):
+            with mock.patch.object(os.path, 'exists', return_value=True):
+                assert cloudssh.set_region(from_args='ap-east-2') == 'ap-east-2'
+                self.assertRaises(RuntimeError, cloudssh.set_region, 'us-invalid-1')
+
     @mock.patch.object(cloudssh, 'get_value_from_user_config', return_value=None)
     def test_set_region_2(self, mock_args):
 
@@ -210,6 +233,373 @@ class Test(BaseTest):
         assert isinstance(response, dict)
         assert isinstance(response['Reservations'], list)
 
+    def test_aws_lookup_paginated(self):
+
+        client = mock.MagicMock()
+        client.get_paginator.return_value.paginate.return_value = [
+            {'Reservations': [{'Instances': [{'InstanceId': 'i-1'}]}]},
+            {'Reservations': [{'Instances': [{'InstanceId': 'i-2'}]}]},
+        ]
+
+        # Every page should be merged in a single response
+        response = cloudssh.aws_lookup(client=client, max_results=None)
+        assert [r['Instances'][0]['InstanceId']
+                for r in response['Reservations']] == ['i-1', 'i-2']
+        client.get_paginator.assert_called_once_with('describe_instances')
+        client.describe_instances.assert_not_called()
+
+    def test_get_lookup_filters(self):
+
+        assert cloudssh.is_ip_address('10.0.0.1') is True
+        assert cloudssh.is_ip_address('web-1') is False
+
+        assert cloudssh.get_lookup_filters('web-1') == [
+            {'Name': 'tag:Name', 'Values': ['web-1']}]
+        assert cloudssh.get_lookup_filters('10.0.0.1') == [
+            {'Name': 'private-ip-address', 'Values': ['10.0.0.1']}]
+        assert cloudssh.get_lookup_filters('3.84.141.144') == [
+            {'Name': 'ip-address', 'Values': ['3.84.141.144']}]
+
+        # Shared address space (carrier-grade NAT) used by VPCs
+        assert cloudssh.get_lookup_filters('100.64.0.1') == [
+            {'Name': 'private-ip-address', 'Values': ['100.64.0.1']}]
+        assert cloudssh.get_lookup_filters('10.0.0.1', private=False) == [
+            {'Name': 'ip-address', 'Values': ['10.0.0.1']}]
+
+    def test_aws_lookup_filters(self):
+
+        client = mock.MagicMock()
+
+        cloudssh.aws_lookup(client=client, instance='web-1')
+        client.describe_instances.assert_called_with(Filters=[
+            {'Name': 'tag:Name', 'Values': ['web-1']},
+            {'Name': 'instance-state-name', 'Values': ['running']},
+        ], MaxResults=5)
+
+        cloudssh.aws_lookup(client=client, instance='172.31.81.127')
+        client.describe_instances.assert_called_with(Filters=[
+            {'Name': 'private-ip-address', 'Values': ['172.31.81.127']},
+            {'Name': 'instance-state-name', 'Values': ['running']},
+        ], MaxResults=5)
+
+        # No filter on instance IDs
+        cloudssh.aws_lookup(client=client, instance='i-1')
+        client.describe_instances.assert_called_with(InstanceIds=['i-1'])
+
+        # A VPC using a public range privately: the other IP filter is tried
+        client.describe_instances.reset_mock()
+        client.describe_instances.side_effect = [
+            {'Reservations': []}, {'Reservations': self.fake_reservations}]
+        assert cloudssh.aws_lookup(client=client, instance='52.0.0.1') == {
+            'Reservations': self.fake_reservations}
+        assert client.describe_instances.call_args_list == [
+            mock.call(Filters=[
+                {'Name': 'ip-address', 'Values': ['52.0.0.1']},
+                {'Name': 'instance-state-name', 'Values': ['running']},
+            ], MaxResults=5),
+            mock.call(Filters=[
+                {'Name': 'private-ip-address', 'Values': ['52.0.0.1']},
+                {'Name': 'instance-state-name', 'Values': ['running']},
+            ], MaxResults=5)]
+
+    @mock.patch.object(cloudssh, 'get_aws_client')
+    def test_aws_search(self, mock_client):
+
+        with mock.patch.object(cloudssh, 'iter_reservations', return_value=iter(deepcopy(self.fake_reservations))) as mock_reservations:
+            assert [i['name'] for i in cloudssh.aws_search('instance')] == [
+                'test_instance', 'test_instance_2']
+            mock_reservations.assert_called_once_with(mock_client.return_value, [
+                {'Name': 'tag:Name', 'Values': ['*instance*']},
+                {'Name': 'instance-state-name', 'Values': ['running']},
+            ])
+
+        # Search misses in the index fall back to AWS
+        with mock.patch.object(cloudssh, 'aws_search', return_value=[{'name': 'web', 'detail': {'id': 'i-1'}}]):
+            with mock.patch('src.cloudssh.confirm', return_value=True):
+                assert cloudssh.search('web') == ('aws', {'id': 'i-1'})
+
+    def test_get_index_workers(self):
+
+        assert cloudssh.get_index_workers() == 8
+
+        with mock.patch.object(cloudssh, 'get_value_from_user_config', return_value='3'):
+            assert cloudssh.get_index_workers() == 3
+
+    @mock.patch.object(cloudssh, 'get_aws_client')
+    def test_get_region_instances(self, mock_client):
+
+        with mock.patch.object(cloudssh, 'iter_reservations', return_value=iter([])) as mock_reservations:
+            assert cloudssh.get_region_instances('us-west-2') == []
+            # Non running instances are filtered by AWS
+            mock_reservations.assert_called_once_with(mock_client.return_value, [
+                {'Name': 'instance-state-name', 'Values': ['running']}])
+        mock_client.assert_called_once_with(
+            region_name='us-west-2', profile_name=None)
+
+        with mock.patch.object(cloudssh, 'iter_reservations', return_value=iter(deepcopy(self.fake_reservations))):
+            names = [i['name']
+                     for i in cloudssh.get_region_instances('us-west-2')]
+            assert names == ['test_instance', 'test_instance_2']
+
+    def test_fetch_targets(self):
+
+        def fake_region_instances(region_name, profile_name=None):
+            if region_name == 'cn-north-1' or profile_name == 'broken':
+                raise RuntimeError('AuthFailure')
+            return [{'name': 'web-' + region_name}]
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            with mock.patch.object(cloudssh, 'iter_region_instances', side_effect=fake_region_instances):
+                results = cloudssh.fetch_targets(
+                    [(None, 'us-east-1'), (None, 'cn-north-1'), (None, 'eu-west-1')])
+
+            # A failing region is reported without stopping the others
+            assert results == {
+                (None, 'us-east-1'): [{'name': 'web-us-east-1'}],
+                (None, 'eu-west-1'): [{'name': 'web-eu-west-1'}],
+            }
+            assert 'Unable to index default/cn-north-1' in out.getvalue()
+
+            # A failing profile is reported without stopping the others
+            with mock.patch.object(cloudssh, 'iter_region_instances', side_effect=fake_region_instances):
+                results = cloudssh.fetch_targets(
+                    [('prod', 'us-east-1'), ('broken', 'us-east-1'), ('dev', 'us-east-1')])
+
+            assert results == {
+                ('prod', 'us-east-1'): [{'name': 'web-us-east-1'}],
+                ('dev', 'us-east-1'): [{'name': 'web-us-east-1'}],
+            }
+            assert 'Unable to index broken/us-east-1' in out.getvalue()
+        finally:
+            sys.stdout = saved_stdout
+
+    def test_get_enabled_regions(self):
+
+        client = mock.MagicMock()
+        client.describe_regions.return_value = {'Regions': [
+            {'RegionName': 'us-east-1'}, {'RegionName': 'eu-west-1'}]}
+
+        with mock.patch.object(cloudssh, 'get_aws_client', return_value=client):
+            assert cloudssh.get_enabled_regions() == ['eu-west-1', 'us-east-1']
+
+            # Every region of the partition if the regions can't be described
+            client.describe_regions.side_effect = RuntimeError('UnauthorizedOperation')
+            client.meta.partition = 'aws-cn'
+            assert cloudssh.get_enabled_regions() == [
+                'cn-north-1', 'cn-northwest-1']
+
+    def test_get_enabled_targets(self):
+
+        def fake_enabled_regions(profile_name=None):
+            if profile_name == 'broken':
+                raise RuntimeError('InvalidClientTokenId')
+            return {'prod': ['us-east-1', 'us-west-2'], 'china': ['cn-north-1']}[profile_name]
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            # The regions of each profile, a failing profile is reported
+            with mock.patch.object(cloudssh, 'get_enabled_regions', side_effect=fake_enabled_regions):
+                assert cloudssh.get_enabled_targets(['prod', 'broken', 'china']) == [
+                    ('prod', 'us-east-1'), ('prod', 'us-west-2'), ('china', 'cn-north-1')]
+            assert 'Unable to list the regions of broken' in out.getvalue()
+        finally:
+            sys.stdout = saved_stdout
+
+    @mock.patch.object(cloudssh, 'get_enabled_regions', side_effect=lambda profile_name=None: ['eu-west-1', 'us-east-1'])
+    @mock.patch.object(cloudssh, 'fetch_targets', return_value={(None, 'us-east-1'): [{'name': 'a'}], (None, 'eu-west-1'): [{'name': 'b'}]})
+    def test_build_index_all_regions(self, mock_args, mock_regions):
+
+        filename = 'test_index_all_regions'
+
+        assert cloudssh.build_index(
+            filename=filename, all_regions=True) is True
+        mock_regions.assert_called_once_with(None)
+        mock_args.assert_called_once_with(
+            [(None, 'eu-west-1'), (None, 'us-east-1')])
+
+        path = cloudssh.config_dir + filename
+        assert set(index_stream.read_refreshed_at(path)['cloud_ssh_unittest']) == {
+            'us-east-1', 'eu-west-1'}
+        assert index_stream.read_region(
+            path, 'cloud_ssh_unittest', 'us-east-1') == [{'name': 'a'}]
+        assert index_stream.read_region(
+            path, 'cloud_ssh_unittest', 'eu-west-1') == [{'name': 'b'}]
+
+    @mock.patch.object(cloudssh, 'fetch_targets', return_value={('prod', 'us-east-1'): [{'name': 'a'}], ('dev', 'us-east-1'): [{'name': 'b'}]})
+    def test_build_index_profiles(self, mock_args):
+
+        filename = 'test_index_profiles'
+
+        assert cloudssh.build_index(
+            filename=filename, profiles=['prod', 'dev']) is True
+        mock_args.assert_called_once_with(
+            [('prod', 'us-east-1'), ('dev', 'us-east-1')])
+
+        path = cloudssh.config_dir + filename
+        assert index_stream.read_regions(path) == [
+            ('prod', 'us-east-1'), ('dev', 'us-east-1')]
+        assert index_stream.read_region(path, 'prod', 'us-east-1') == [{'name': 'a'}]
+        assert index_stream.read_region(path, 'dev', 'us-east-1') == [{'name': 'b'}]
+
+    def test_refreshed_at(self):
+
+        index = {}
+        assert cloudssh.get_refreshed_at(index) is None
+        assert cloudssh.is_index_fresh(index) is False
+
+        index = {'_refreshed_at': {
+            'cloud_ssh_unittest': {'us-east-1': 1000},
+            'prod': {'us-east-1': time.time()},
+        }}
+        assert cloudssh.get_refreshed_at(index) == 1000
+        assert cloudssh.is_index_fresh(index) is False
+
+        assert cloudssh.is_index_fresh(index, profile_name='prod') is True
+        assert cloudssh.is_index_fresh(
+            index, profile_name='prod', ttl=0) is False
+
+    def test_merge_instances_list(self):
+
+        unchanged = {'name': 'a', 'detail': {'id': 'i-1', 'public_ip': '1.1.1.1'}}
+        existing = [
+            unchanged,
+            {'name': 'b', 'detail': {'id': 'i-2', 'public_ip': '2.2.2.2'}},
+            {'name': 'c', 'detail': {'id': 'i-3', 'public_ip': '3.3.3.3'}},
+        ]
+        new = [
+            {'name': 'a', 'detail': {'id': 'i-1', 'public_ip': '1.1.1.1'}},
+            {'name': 'b', 'detail': {'id': 'i-2', 'public_ip': '2.2.2.3'}},
+            {'name': 'd', 'detail': {'id': 'i-4', 'public_ip': '4.4.4.4'}},
+        ]
+
+        merged, changes = cloudssh.merge_instances_list(existing, new)
+
+        assert merged == new
+        assert merged[0] is unchanged  # Unchanged records are kept as is
+        assert changes == {'new': 1, 'changed': 1, 'removed': 1}
+
+    def test_build_index_refresh(self):
+
+        filename = 'test_index_refresh'
+
+        path = cloudssh.config_dir + filename
+        instances = [{'name': 'a', 'detail': {'id': 'i-1'}}]
+        index_stream.write_regions(path, {
+            ('cloud_ssh_unittest', 'us-east-1'): (instances, 0),
+            ('cloud_ssh_unittest', 'us-west-1'): (instances, cloudssh.time.time()),
+        })
+
+        # Only the stale region is fetched
+        with mock.patch.object(cloudssh, 'fetch_targets', return_value={(None, 'us-east-1'): instances + [{'name': 'b', 'detail': {'id': 'i-2'}}]}) as mock_fetch:
+            assert cloudssh.build_index(
+                filename=filename, refresh=True) is True
+            mock_fetch.assert_called_once_with([(None, 'us-east-1')])
+
+        assert [i['name'] for i in index_stream.read_region(path, 'cloud_ssh_unittest', 'us-east-1')] == [
+            'a', 'b']
+        assert cloudssh.is_index_fresh(cloudssh.read_index_meta(filename)) is True
+
+        # Nothing is fetched while the region is fresh
+        with mock.patch.object(cloudssh, 'fetch_targets') as mock_fetch:
+            assert cloudssh.build_index(
+                filename=filename, refresh=True) is True
+            mock_fetch.assert_not_called()
+
+    def test_get_index_engine(self):
+
+        assert cloudssh.get_index_engine() is None
+        assert cloudssh.get_index_filename() == 'index.json'
+        assert cloudssh.get_index_filename('custom.json') == 'custom.json'
+
+        cloudssh.user_config['index_engine'] = 'sqlite'
+        assert cloudssh.get_index_engine().__name__ == 'src.index_sqlite'
+        assert cloudssh.get_index_filename() == 'index.sqlite'
+
+        cloudssh.user_config['index_engine'] = 'mmap'
+        assert cloudssh.get_index_engine().__name__ == 'src.index_mmap'
+        assert cloudssh.get_index_filename() == 'index.bin'
+
+        cloudssh.user_config['index_engine'] = 'sharded'
+        assert cloudssh.get_index_engine().__name__ == 'src.index_sharded'
+        assert cloudssh.get_index_filename() == 'index.d'
+
+    @mock.patch.object(cloudssh, 'fetch_targets')
+    def test_build_index_sqlite(self, mock_fetch):
+
+        cloudssh.user_config['index_engine'] = 'sqlite'
+
+        instances = [
+            {'name': 'web', 'detail': {'id': 'i-1', 'public_ip': '1.2.3.4', 'private_ip': '10.0.0.1',
+                                       'tags': [{'Key': 'env', 'Value': 'prod'}]}},
+            {'name': 'db', 'detail': {'id': 'i-2', 'public_ip': '1.2.3.5', 'private_ip': '10.0.0.2',
+                                      'tags': [{'Key': 'env', 'Value': 'dev'}]}},
+        ]
+        with mock.patch.object(cloudssh, 'iter_region_instances', return_value=instances):
+            assert cloudssh.build_index() is True
+
+        assert [i['name'] for i in cloudssh.get_instances_list_from_index()] == [
+            'db', 'web']
+        assert cloudssh.is_index_fresh(cloudssh.read_index_meta()) is True
+
+        # Indexed lookups by name, instance ID and IP addresses
+        assert cloudssh.instance_lookup('WEB') == ('index', instances[0]['detail'])
+        assert cloudssh.instance_lookup('i-2') == ('index', instances[1]['detail'])
+        assert cloudssh.instance_lookup('1.2.3.4') == ('index', instances[0]['detail'])
+        assert cloudssh.instance_lookup('10.0.0.2') == ('index', instances[1]['detail'])
+
+        # Search, tags are queried from the index
+        with mock.patch('src.cloudssh.confirm', return_value=True):
+            assert cloudssh.search('we') == ('index', instances[0]['detail'])
+            with mock.patch.object(cloudssh, 'get_search_index') as mock_search_index:
+                assert cloudssh.tag_search([('env', '=', 'dev')]) == ('index', instances[1]['detail'])
+                assert cloudssh.match_instances('env~*') == [instances[1], instances[0]]
+            mock_search_index.assert_not_called()
+
+        # Refresh with no change only updates the timestamp
+        mock_fetch.return_value = {(None, 'us-east-1'): instances}
+        assert cloudssh.build_index(refresh=True) is True
+        mock_fetch.assert_not_called()
+
+    @mock.patch.object(cloudssh, 'iter_region_instances')
+    def test_build_index_sharded(self, mock_instances):
+
+        cloudssh.user_config['index_engine'] = 'sharded'
+
+        instances = [
+            {'name': 'web', 'detail': {'id': 'i-1', 'public_ip': '1.2.3.4'}},
+            {'name': 'db', 'detail': {'id': 'i-2', 'public_ip': '1.2.3.5'}},
+        ]
+        mock_instances.return_value = instances
+        assert cloudssh.build_index() is True
+        assert cloudssh.is_index_fresh(cloudssh.read_index_meta()) is True
+        assert cloudssh.get_index_signature() is not None
+
+        # Only the shard of the region is written
+        assert sorted(f for f in os.listdir(cloudssh.config_dir + 'index.d') if f.endswith('.json')) == [
+            'cloud_ssh_unittest.us-east-1.json', 'manifest.json']
+
+        assert cloudssh.instance_lookup('WEB') == ('index', instances[0]['detail'])
+        assert cloudssh.instance_lookup('i-2') == ('index', instances[1]['detail'])
+
+    def test_get_index_profiles(self):
+
+        # Default profile
+        assert cloudssh.get_index_profiles() is None
+
+        # From CLI args
+        assert cloudssh.get_index_profiles(['a', 'b']) == ['a', 'b']
+
+        # From config file
+        with mock.patch.object(cloudssh, 'get_value_from_user_config', return_value='prod, dev,'):
+            assert cloudssh.get_index_profiles() == ['prod', 'dev']
+
     def test_get_instance_infos(self):
 
         assert cloudssh.get_instance_infos(
@@ -228,9 +618,15 @@ class Test(BaseTest):
         self.assertRaises(
             SystemExit, cloudssh.get_instance_infos, reservations=[])
 
-        # Reservations but no public IP
+        # Private IP only
         altered = self.fake_reservations
         altered[0]['Instances'][0].pop('PublicIpAddress')
+        assert cloudssh.get_instance_infos(
+            reservations=altered)['private_ip'] == '10.0.0.60'
+
+        # No IP address
+        altered = deepcopy(altered)
+        altered[0]['Instances'][0].pop('PrivateIpAddress')
         self.assertRaises(SystemExit, cloudssh.get_instance_infos,
                           reservations=altered)
 
@@ -260,6 +656,414 @@ class Test(BaseTest):
             flag='-v'
         ) == ['ssh', '-J 1.2.3.4', '-v', 'paul@123.456.7.89']
 
+        assert cloudssh.get_ssh_command(
+            public_ip='123.456.7.89',
+            control_path='/tmp/cm/i-1'
+        ) == ['ssh', '-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/cm/i-1', '-o', 'ControlPersist=10m', '123.456.7.89']
+
+        assert cloudssh.get_ssh_command(
+            public_ip='123.456.7.89',
+            control_path='/tmp/cm/i-1',
+            control_persist='1h'
+        )[-2] == 'ControlPersist=1h'
+
+    def test_get_control_path(self):
+
+        assert cloudssh.get_control_path(
+            'i-1') == cloudssh.config_dir + 'cm/i-1'
+        assert cloudssh.get_control_path(None) is None
+
+        # Multiplexing disabled
+        cloudssh.user_config['ssh_multiplexing'] = 'false'
+        assert cloudssh.get_control_path('i-1') is None
+
+    def test_get_instance_ssh_command(self):
+
+        assert cloudssh.get_instance_ssh_command('1.2.3.4', 'i-1') == [
+            'ssh', '-o', 'ControlMaster=auto', '-o', 'ControlPath=%scm/i-1' % (cloudssh.config_dir), '-o', 'ControlPersist=10m', 'paul@1.2.3.4']
+        assert os.path.isdir(cloudssh.config_dir + 'cm')
+
+        assert cloudssh.get_instance_ssh_command('1.2.3.4') == [
+            'ssh', 'paul@1.2.3.4']
+
+        # The proxy jump comes from the route
+        cloudssh.user_config['ssh_proxyjump'] = 'jump.example.com'
+        assert cloudssh.get_instance_ssh_command('10.0.0.5') == [
+            'ssh', 'paul@10.0.0.5']
+
+    def test_get_user_config_section(self):
+
+        assert cloudssh.get_user_config_section('BASTIONS') == {}
+
+        with open(cloudssh.config_dir + 'cloudssh.cfg', 'a') as f:
+            f.write('\n[BASTIONS]\nvpc-1 = admin@bastion-1\nsubnet-2 = bastion-2:2222\n')
+        cloudssh.parse_user_config()
+
+        assert cloudssh.get_user_config_section('BASTIONS') == {
+            'vpc-1': 'admin@bastion-1', 'subnet-2': 'bastion-2:2222'}
+        assert cloudssh.get_bastion({'vpc': 'vpc-1', 'subnet': 'subnet-1'}) == 'admin@bastion-1'
+        assert cloudssh.get_bastion({'vpc': 'vpc-1', 'subnet': 'subnet-2'}) == 'bastion-2:2222'
+        assert cloudssh.get_bastion({'vpc': 'vpc-3'}) is None
+
+    def write_roles_config(self):
+        with open(cloudssh.config_dir + 'cloudssh.cfg', 'a') as f:
+            f.write('\n[ROLES]\nrole_arns = arn:aws:iam::111111111111:role/cloudssh\n'
+                    'role_name = ReadOnly\naccounts = 222222222222, 333333333333\n')
+        cloudssh.parse_user_config()
+        cloudssh.role_sessions.clear()
+
+    def test_get_role_arns(self):
+
+        assert cloudssh.get_role_arns() == {}
+
+        self.write_roles_config()
+        assert cloudssh.get_role_arns() == {
+            '111111111111': 'arn:aws:iam::111111111111:role/cloudssh',
+            '222222222222': 'arn:aws:iam::222222222222:role/ReadOnly',
+            '333333333333': 'arn:aws:iam::333333333333:role/ReadOnly',
+        }
+
+        # Accounts in the partition of the active region or of the config
+        cloudssh.region = 'us-gov-west-1'
+        assert cloudssh.get_role_arns()['222222222222'] == 'arn:aws-us-gov:iam::222222222222:role/ReadOnly'
+        cloudssh.user_config_sections['ROLES']['partition'] = 'aws-cn'
+        assert cloudssh.get_role_arns()['222222222222'] == 'arn:aws-cn:iam::222222222222:role/ReadOnly'
+
+        # Full ARNs are kept as is
+        cloudssh.user_config_sections['ROLES'] = {'role_arns': 'arn:aws-cn:iam::444444444444:role/cloudssh'}
+        assert cloudssh.get_role_arns() == {'444444444444': 'arn:aws-cn:iam::444444444444:role/cloudssh'}
+
+        cloudssh.user_config_sections['ROLES'] = {'role_arns': 'cloudssh'}
+        self.assertRaises(RuntimeError, cloudssh.get_role_arns)
+
+    def test_get_partition(self):
+
+        assert cloudssh.get_partition('eu-west-1') == 'aws'
+        assert cloudssh.get_partition('cn-north-1') == 'aws-cn'
+        assert cloudssh.get_partition('us-gov-east-1') == 'aws-us-gov'
+        assert cloudssh.get_partition('us-iso-east-1') == 'aws-iso'
+        assert cloudssh.get_partition('us-isob-east-1') == 'aws-iso-b'
+
+    @mock.patch('boto3.Session')
+    def test_get_role_session(self, mock_session):
+
+        import datetime
+
+        self.write_roles_config()
+        assume_role = mock_session.return_value.client.return_value.assume_role
+        assume_role.return_value = {'Credentials': {
+            'AccessKeyId': 'key', 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}}
+
+        session = cloudssh.get_role_session('222222222222')
+        assume_role.assert_called_once_with(
+            RoleArn='arn:aws:iam::222222222222:role/ReadOnly', RoleSessionName='cloudssh')
+        mock_session.assert_called_with(
+            aws_access_key_id='key', aws_secret_access_key='secret', aws_session_token='token')
+
+        # Assumed once
+        assert cloudssh.get_role_session('222222222222') is session
+        assert assume_role.call_count == 1
+
+        # Assumed again when the credentials expire
+        cloudssh.role_sessions['222222222222'] = (session, 0)
+        cloudssh.get_role_session('222222222222')
+        assert assume_role.call_count == 2
+
+        # Clients of the accounts use the role
+        with mock.patch.object(cloudssh, 'get_role_session') as mock_role_session:
+            cloudssh.get_aws_client(profile_name='111111111111')
+        mock_role_session.assert_called_once_with('111111111111')
+
+    def test_fetch_targets_roles(self):
+
+        self.write_roles_config()
+
+        def fake_role_session(account):
+            if account == '333333333333':
+                raise RuntimeError('AccessDenied')
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            with mock.patch.object(cloudssh, 'get_role_session', side_effect=fake_role_session) as mock_role_session:
+                with mock.patch.object(cloudssh, 'iter_region_instances', return_value=[{'name': 'web'}]) as mock_instances:
+                    results = cloudssh.fetch_targets([
+                        (profile_name, region_name)
+                        for profile_name in [None, '222222222222', '333333333333']
+                        for region_name in ['us-east-1', 'eu-west-1']])
+
+            # Roles are assumed once per account, a failing role skips its regions
+            assert mock_role_session.call_count == 2
+            assert mock_instances.call_count == 4
+            assert set(results) == {
+                (None, 'eu-west-1'), (None, 'us-east-1'),
+                ('222222222222', 'eu-west-1'), ('222222222222', 'us-east-1')}
+            assert 'Unable to assume arn:aws:iam::333333333333:role/ReadOnly: AccessDenied' in out.getvalue()
+        finally:
+            sys.stdout = saved_stdout
+
+    @mock.patch.object(cloudssh, 'fetch_targets', return_value={('111111111111', 'us-east-1'): [{'name': 'web', 'detail': {'public_ip': '1.2.3.4'}}]})
+    def test_build_index_roles(self, mock_fetch):
+
+        self.write_roles_config()
+
+        assert cloudssh.build_index() is True
+        mock_fetch.assert_called_once_with([
+            (None, 'us-east-1'), ('111111111111', 'us-east-1'),
+            ('222222222222', 'us-east-1'), ('333333333333', 'us-east-1')])
+
+        # Stored under the account
+        assert cloudssh.get_instances_list_from_index(profile_name='111111111111') == [
+            {'name': 'web', 'detail': {'public_ip': '1.2.3.4'}}]
+
+    @mock.patch.object(cloudssh, 'get_bastion', return_value='admin@bastion-1')
+    def test_get_routes(self, mock_bastion):
+
+        detail = {'public_ip': '1.2.3.4', 'private_ip': '10.0.0.1', 'vpc': 'vpc-1'}
+
+        # The public IP first by default
+        assert cloudssh.get_routes(detail) == [
+            {'route': 'public', 'ip': '1.2.3.4', 'proxyjump': None},
+            {'route': 'bastion', 'ip': '10.0.0.1', 'proxyjump': 'admin@bastion-1'},
+            {'route': 'private', 'ip': '10.0.0.1', 'proxyjump': None},
+        ]
+
+        # `ssh_proxyjump` only applies to the public IP
+        cloudssh.user_config['ssh_proxyjump'] = 'jump.example.com'
+        cloudssh.user_config['ssh_routes'] = 'private, bastion, public'
+        assert cloudssh.get_routes(detail) == [
+            {'route': 'private', 'ip': '10.0.0.1', 'proxyjump': None},
+            {'route': 'bastion', 'ip': '10.0.0.1', 'proxyjump': 'admin@bastion-1'},
+            {'route': 'public', 'ip': '1.2.3.4', 'proxyjump': 'jump.example.com'},
+        ]
+
+        # The last working route of the VPC first
+        assert cloudssh.save_route('vpc-1', 'public') is True
+        assert cloudssh.save_route('vpc-1', 'public') is False
+        assert [r['route'] for r in cloudssh.get_routes(detail)] == [
+            'public', 'private', 'bastion']
+
+        # Private only, no bastion
+        mock_bastion.return_value = None
+        assert cloudssh.get_routes({'private_ip': '10.0.0.1'}) == [
+            {'route': 'private', 'ip': '10.0.0.1', 'proxyjump': None}]
+        assert cloudssh.get_routes({}) == []
+
+    def test_save_route_concurrent(self):
+
+        import threading
+
+        # Writers of several VPCs at once
+        threads = [threading.Thread(target=lambda i=i: [cloudssh.save_route('vpc-%d' % (i), route) for route in ('public', 'private') * 5])
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert cloudssh.read_route_cache() == {
+            'vpc-%d' % (i): 'private' for i in range(20)}
+        assert not [f for f in os.listdir(cloudssh.config_dir) if f.endswith('.tmp')]
+
+    def test_get_probe_target(self):
+
+        assert cloudssh.get_probe_target(
+            {'ip': '10.0.0.1', 'proxyjump': None}) == ('10.0.0.1', 22)
+        assert cloudssh.get_probe_target(
+            {'ip': '10.0.0.1', 'proxyjump': 'admin@bastion-1'}) == ('bastion-1', 22)
+        assert cloudssh.get_probe_target(
+            {'ip': '10.0.0.1', 'proxyjump': 'bastion-2:2222,other'}) == ('bastion-2', 2222)
+
+    @mock.patch('src.probe.probe')
+    @mock.patch.object(cloudssh, 'get_bastion', return_value='bastion-1')
+    def test_select_route(self, mock_bastion, mock_probe):
+
+        detail = {'id': 'i-1', 'public_ip': '1.2.3.4', 'private_ip': '10.0.0.1', 'vpc': 'vpc-1'}
+        cloudssh.user_config['ssh_routes'] = 'private, bastion, public'
+
+        # Outside of the VPC: the private IP does not answer
+        mock_probe.return_value = {
+            ('10.0.0.1', 22): None, ('bastion-1', 22): 0.02, ('1.2.3.4', 22): 0.01}
+        assert cloudssh.select_route(detail) == {
+            'route': 'bastion', 'ip': '10.0.0.1', 'proxyjump': 'bastion-1'}
+        mock_probe.assert_called_once_with(
+            {('10.0.0.1', 22), ('bastion-1', 22), ('1.2.3.4', 22)}, timeout=1.0)
+        assert cloudssh.read_route_cache() == {'vpc-1': 'bastion'}
+        assert cloudssh.get_cached_route(detail, cloudssh.get_routes(detail)) == {
+            'route': 'bastion', 'ip': '10.0.0.1', 'proxyjump': 'bastion-1'}
+
+        # Nothing answers
+        mock_probe.return_value = {
+            ('10.0.0.1', 22): None, ('bastion-1', 22): None, ('1.2.3.4', 22): None}
+        assert cloudssh.select_route(detail)['route'] == 'bastion'
+
+        # Open multiplexed connection: no probe
+        mock_probe.reset_mock()
+        os.makedirs(cloudssh.config_dir + 'cm')
+        open(cloudssh.config_dir + 'cm/i-1', 'w').close()
+        assert cloudssh.select_route(detail)['route'] == 'bastion'
+        mock_probe.assert_not_called()
+
+        # No IP address
+        self.assertRaises(SystemExit, cloudssh.select_route, {'id': 'i-2'})
+
+    @mock.patch('src.probe.probe')
+    @mock.patch.object(cloudssh, 'ssh_subprocess', return_value=0)
+    @mock.patch.object(cloudssh, 'get_bastion', return_value='bastion-1')
+    def test_connect_instance(self, mock_bastion, mock_subprocess, mock_probe):
+
+        detail = {'id': 'i-1', 'public_ip': '1.2.3.4', 'private_ip': '10.0.0.1', 'vpc': 'vpc-1'}
+
+        # No route worked yet for the VPC: probe the routes
+        mock_probe.return_value = {
+            ('1.2.3.4', 22): None, ('bastion-1', 22): 0.02, ('10.0.0.1', 22): None}
+        assert cloudssh.connect_instance(detail) == 0
+        assert mock_probe.call_count == 1
+        assert mock_subprocess.call_args[0][0][-1].endswith('@10.0.0.1')
+
+        # The last working route of the VPC is used without probing
+        assert cloudssh.connect_instance(detail) == 0
+        assert mock_probe.call_count == 1
+
+        # It does not connect anymore: probe the routes and retry once
+        mock_subprocess.side_effect = [255, 0]
+        mock_probe.return_value = {
+            ('1.2.3.4', 22): 0.01, ('bastion-1', 22): None, ('10.0.0.1', 22): None}
+        assert cloudssh.connect_instance(detail) == 0
+        assert mock_probe.call_count == 2
+        assert mock_subprocess.call_args[0][0][-1].endswith('@1.2.3.4')
+        assert cloudssh.read_route_cache() == {'vpc-1': 'public'}
+
+        # A failing connection after probing is not retried
+        os.remove(cloudssh.get_route_cache_path())
+        mock_subprocess.side_effect = None
+        mock_subprocess.return_value = 255
+        assert cloudssh.connect_instance(detail) == 255
+        assert mock_probe.call_count == 3
+        assert mock_subprocess.call_count == 5
+
+    @mock.patch.object(cloudssh, 'ssh_subprocess')
+    def test_close(self, mock_subprocess):
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            # No control socket
+            assert cloudssh.get_close_command('1.2.3.4', 'i-1') is None
+            assert cloudssh.close('1.2.3.4', 'i-1') is False
+            assert out.getvalue() == 'No open connection to this instance.\n'
+        finally:
+            sys.stdout = saved_stdout
+
+        os.makedirs(cloudssh.config_dir + 'cm')
+        open(cloudssh.config_dir + 'cm/i-1', 'w').close()
+
+        assert cloudssh.close('1.2.3.4', 'i-1') is True
+        mock_subprocess.assert_called_once_with(
+            ['ssh', '-o', 'ControlPath=%scm/i-1' % (cloudssh.config_dir), '-O', 'exit', '1.2.3.4'])
+
+    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[
+        {'name': 'web-1', 'detail': {'id': 'i-1', 'public_ip': '1.2.3.4', 'tags': [{'Key': 'env', 'Value': 'prod'}]}},
+        {'name': 'Web-2', 'detail': {'id': 'i-2', 'public_ip': '1.2.3.5', 'tags': [{'Key': 'env', 'Value': 'dev'}]}},
+        {'name': 'db-1', 'detail': {'id': 'i-3', 'public_ip': '1.2.3.6', 'tags': [{'Key': 'env', 'Value': 'prod'}]}}])
+    def test_match_instances(self, mock_index):
+
+        assert [i['name'] for i in cloudssh.match_instances('web')] == [
+            'web-1', 'Web-2']
+        assert [i['name'] for i in cloudssh.match_instances('env=prod')] == [
+            'web-1', 'db-1']
+        assert cloudssh.match_instances('nope') == []
+
+    def test_get_exec_parallelism(self):
+
+        assert cloudssh.get_exec_parallelism() == 20
+
+    @mock.patch('subprocess.Popen')
+    def test_exec_on_instances(self, mock_popen):
+
+        def popen(command, **kwargs):
+            process = mock.Mock()
+            process.stdout = [b'up 3 days\n']
+            process.wait.return_value = 0 if command[-2] == 'paul@1.2.3.4' else 2
+            return process
+        mock_popen.side_effect = popen
+
+        instances_list = [
+            {'name': 'web-1', 'detail': {'id': 'i-1', 'public_ip': '1.2.3.4'}},
+            {'name': 'web-2', 'detail': {'id': 'i-2', 'public_ip': '1.2.3.5'}},
+            {'name': 'web-3', 'detail': {'id': 'i-3'}},
+        ]
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            assert cloudssh.exec_on_instances('uptime', instances_list, parallel=2) == {
+                'web-1': 0, 'web-2': 2, 'web-3': 255}
+        finally:
+            sys.stdout = saved_stdout
+
+        output = out.getvalue()
+        assert 'web-1 | up 3 days\n' in output
+        assert 'web-2 | up 3 days\n' in output
+        assert 'web-3 | No IP address found for this instance.\n' in output
+        assert '1 succeeded, 2 failed\n* web-2: exit code 2\n* web-3: exit code 255\n' in output
+
+        # Non interactive SSH command followed by the remote command
+        command = mock_popen.call_args_list[0][0][0]
+        assert command[:3] == ['ssh', '-o', 'BatchMode=yes']
+        assert command[-1] == 'uptime'
+
+    @mock.patch('subprocess.Popen')
+    def test_exec_on_instances_error(self, mock_popen):
+
+        def popen(command, **kwargs):
+            if command[-2] == 'paul@1.2.3.5':
+                raise OSError('Too many open files')
+            process = mock.Mock()
+            process.stdout = []
+            process.wait.return_value = 0
+            return process
+        mock_popen.side_effect = popen
+
+        instances_list = [
+            {'name': 'web-1', 'detail': {'id': 'i-1', 'public_ip': '1.2.3.4'}},
+            {'name': 'web-2', 'detail': {'id': 'i-2', 'public_ip': '1.2.3.5'}},
+        ]
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            # A host failing does not discard the others
+            assert cloudssh.exec_on_instances('uptime', instances_list) == {
+                'web-1': 0, 'web-2': 255}
+        finally:
+            sys.stdout = saved_stdout
+
+        output = out.getvalue()
+        assert 'web-2 | Too many open files\n' in output
+        assert '1 succeeded, 1 failed\n* web-2: exit code 255\n' in output
+
+    def test_exec_on_instances_no_match(self):
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            assert cloudssh.exec_on_instances('uptime', []) == {}
+            assert out.getvalue() == 'No result!\n'
+        finally:
+            sys.stdout = saved_stdout
+
     def test_resolve_home(self):
 
         assert cloudssh.resolve_home('/tmp/full/path') == '/tmp/full/path'
@@ -314,70 +1118,225 @@ class Test(BaseTest):
         self.assertRaises(
             SystemExit, cloudssh.get_instances_list, reservations=[])
 
-    def test_read_index(self):
+    def test_iter_instances(self):
+
+        reservations = [
+            {'Instances': [
+                {'InstanceId': 'i-1', 'Tags': [{'Key': 'Name', 'Value': 'web'}]},
+                {'InstanceId': 'i-2', 'Tags': [{'Key': 'Name', 'Value': 'WEB'}]},
+            ]},
+            {'Instances': [
+                {'InstanceId': 'i-3', 'State': {'Name': 'stopped'},
+                    'Tags': [{'Key': 'Name', 'Value': 'web'}]},
+                {'InstanceId': 'i-4', 'Tags': [{'Key': 'Name', 'Value': 'Web'}]},
+            ]},
+        ]
+
+        records = cloudssh.iter_instances(iter(reservations))
+
+        # Records are yielded one at a time
+        assert next(records)['name'] == 'web'
+        assert [r['name'] for r in records] == ['WEB#01', 'Web#02']
+
+    def test_build_index(self):
 
-        filename = 'test_read_file'
+        filename = 'test_index'
 
-        cloudssh.write_index(
-            filename=filename,
-            content={'a': True}
-        )
+        assert cloudssh.build_index(filename=filename) is True
 
-        # Read file
-        assert cloudssh.read_index(filename=filename) == {'a': True}
+        # Build index with config dir creation
+        with tempfile.TemporaryDirectory() as test_dir:
+            cloudssh.config_dir = test_dir + '/new_path/'
+            assert cloudssh.build_index(filename=filename) is True
 
-        # Read invalid file
-        assert cloudssh.read_index(filename='/tmp/nonexistent') == {}
+    def test_get_index_regions(self):
+
+        cloudssh.save_regions({
+            ('prod', 'us-west-1'): [],
+            (None, 'eu-west-1'): [],
+            (None, 'us-east-1'): [],
+        })
+
+        # Active profile/region first
+        assert cloudssh.get_index_regions() == [
+            ('cloud_ssh_unittest', 'us-east-1'), ('prod', 'us-west-1'), ('cloud_ssh_unittest', 'eu-west-1')]
+
+    def test_get_ssh_config_options(self):
+
+        assert cloudssh.get_ssh_config_options(None) == []
+        assert cloudssh.get_ssh_config_options('-v') == [
+            ('LogLevel', 'VERBOSE')]
+        assert cloudssh.get_ssh_config_options(
+            '-A -i ~/.ssh/key.pem -p2222 -o StrictHostKeyChecking=no -o "ServerAliveInterval 30" -T') == [
+            ('ForwardAgent', 'yes'),
+            ('IdentityFile', '~/.ssh/key.pem'),
+            ('Port', '2222'),
+            ('StrictHostKeyChecking', 'no'),
+            ('ServerAliveInterval', '30'),
+        ]
 
-    def test_write_index(self):
+    def test_export_ssh_config(self):
 
-        filename = 'test_write_index'
+        with open(cloudssh.config_dir + 'cloudssh.cfg', 'a') as f:
+            f.write('\n        ssh_flag = -A\n\n[BASTIONS]\nvpc-1 = bastion-1\n')
+        cloudssh.parse_user_config()
 
-        assert cloudssh.write_index(
-            filename=filename,
-            content={}
-        ) is True
+        cloudssh.save_regions({
+            (None, 'us-east-1'): [
+                {'name': 'web', 'detail': {'id': 'i-1', 'public_ip': '1.2.3.4', 'private_ip': '10.0.0.1'}},
+                {'name': 'web#01', 'detail': {'id': 'i-2', 'private_ip': '10.0.0.2', 'vpc': 'vpc-1'}},
+                {'name': 'db', 'detail': {'private_ip': '10.0.0.3'}},
+                {'name': 'no ip', 'detail': {}},
+                {'name': 'WEB2', 'detail': {'public_ip': '1.2.3.5'}},
+            ],
+            (None, 'eu-west-1'): [
+                {'name': 'web2', 'detail': {'public_ip': '1.2.3.6'}},
+            ],
+        })
+
+        path = cloudssh.export_ssh_config()
+        assert path == cloudssh.config_dir + 'ssh_config'
+
+        # The directory of the control sockets is created for plain `ssh`
+        assert os.stat(cloudssh.config_dir + 'cm').st_mode & 0o777 == 0o700
+
+        # Index order, streamed region by region
+        with open(path) as f:
+            assert f.read() == """# Generated by cloudssh from the instances index, do not edit
+
+Host web
+    HostName 1.2.3.4
+    User paul
+    ForwardAgent yes
+    ControlMaster auto
+    ControlPath "%scm/i-1"
+    ControlPersist 10m
+
+Host "web#01"
+    HostName 10.0.0.2
+    User paul
+    ProxyJump bastion-1
+    ForwardAgent yes
+    ControlMaster auto
+    ControlPath "%scm/i-2"
+    ControlPersist 10m
+
+Host db
+    HostName 10.0.0.3
+    User paul
+    ForwardAgent yes
+
+Host WEB2
+    HostName 1.2.3.5
+    User paul
+    ForwardAgent yes
+""" % (cloudssh.config_dir, cloudssh.config_dir)
+
+    @mock.patch.object(cloudssh, 'iter_region_instances', return_value=[{'name': 'web', 'detail': {'public_ip': '1.2.3.4'}}])
+    def test_build_index_export_ssh_config(self, mock_instances):
+
+        assert cloudssh.build_index() is True
+
+        with open(cloudssh.config_dir + 'ssh_config') as f:
+            assert 'Host web\n    HostName 1.2.3.4\n' in f.read()
+
+    def test_save_regions_stream(self):
+
+        from .. import search_index
+
+        # Generator written as it is consumed, with the search index of the region
+        cloudssh.save_regions({(None, 'us-east-1'): (i for i in [
+            {'name': 'web', 'detail': {'tags': [{'Key': 'env', 'Value': 'prod'}]}},
+            {'name': 'db', 'detail': {}},
+        ])})
+
+        assert cloudssh.get_index_regions() == [('cloud_ssh_unittest', 'us-east-1')]
+        assert [i['name'] for i in cloudssh.get_instances_list_from_index()] == ['db', 'web']
+        assert search_index.read(cloudssh.get_search_index_path()) == search_index.build([
+            {'name': 'web', 'detail': {'tags': [{'Key': 'env', 'Value': 'prod'}]}},
+            {'name': 'db', 'detail': {}},
+        ])
+
+    def test_write_completion_names_file(self):
+
+        cloudssh.save_regions({(None, 'us-east-1'): [
+            {'name': 'web-2', 'detail': {}},
+            {'name': 'Web-1', 'detail': {}},
+            {'name': 'db', 'detail': {}},
+            {'name': 'db', 'detail': {}},
+        ]})
+
+        path = cloudssh.write_completion_names_file()
+        assert path == cloudssh.get_completion_names_path()
+
+        with open(path) as f:
+            assert f.read() == 'Web-1\ndb\nweb-2\n'
+
+    def test_export_concurrent(self):
+
+        import threading
+
+        cloudssh.save_regions({(None, 'us-east-1'): [
+            {'name': 'web-%d' % (i), 'detail': {'public_ip': '1.2.3.%d' % (i)}} for i in range(50)]})
+
+        # Concurrent refreshes write the derived files at once
+        errors = []
+
+        def export():
+            try:
+                cloudssh.export_ssh_config()
+                cloudssh.write_completion_names_file()
+            except Exception as e:
+                errors.append(e)
 
-    @mock.patch.object(cloudssh, 'get_value_from_user_config', return_value='my_profile')
-    def test_append_to_index(self, mock_args):
+        threads = [threading.Thread(target=export) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        cloudssh.region = 'us-east-1'
+        assert errors == []
+        assert not [f for f in os.listdir(cloudssh.config_dir) if f.endswith('.tmp')]
+        with open(cloudssh.get_completion_names_path()) as f:
+            assert len(f.read().splitlines()) == 50
 
-        # With an existing index
-        assert cloudssh.append_to_index(
-            existing_index={
-                'my_profile': {
-                    'us-west-1': ['name_123']
-                }
-            },
-            new=['name_1', 'name_2']
-        ) == {
-            'my_profile': {
-                'us-west-1': ['name_123'],
-                'us-east-1': ['name_1', 'name_2'],
-            }
-        }
+    def test_is_index_stale(self):
 
-        # Without an existing index
-        assert cloudssh.append_to_index(
-            existing_index={},
-            new=['name_1', 'name_2']
-        ) == {
-            'my_profile': {
-                'us-east-1': ['name_1', 'name_2'],
-            }
-        }
+        filename = 'test_is_index_stale'
 
-    def test_build_index(self):
+        # No index
+        assert cloudssh.is_index_stale(filename=filename) is False
 
-        filename = 'test_index'
+        cloudssh.save_regions({}, filename)
+        assert cloudssh.is_index_stale(filename=filename) is False
+        assert cloudssh.is_index_stale(filename=filename, ttl=0) is True
 
-        assert cloudssh.build_index(filename=filename) is True
+    def test_get_self_command(self):
 
-        # Build index with config dir creation
-        with tempfile.TemporaryDirectory() as test_dir:
-            cloudssh.config_dir = test_dir + '/new_path/'
-            assert cloudssh.build_index(filename=filename) is True
+        assert cloudssh.get_self_command() == [
+            sys.executable, '-m', 'src.cloudssh']
+
+        # Run with `python -m src.cloudssh`
+        with mock.patch.object(cloudssh, '__name__', '__main__'):
+            assert cloudssh.get_self_command() == [
+                sys.executable, '-m', 'src.cloudssh']
+
+    @mock.patch('subprocess.Popen')
+    def test_refresh_index_in_background(self, mock_popen):
+
+        assert cloudssh.refresh_index_in_background() is True
+        mock_popen.assert_called_once()
+        assert mock_popen.call_args[0][0] == [
+            sys.executable, '-m', 'src.cloudssh', '--refresh']
+        assert mock_popen.call_args[1]['start_new_session'] is True
+
+        # A refresh was started recently
+        assert cloudssh.refresh_index_in_background() is False
+        assert mock_popen.call_count == 1
+
+        # The lock expired
+        assert cloudssh.refresh_index_in_background(lock_ttl=0) is True
+        assert mock_popen.call_count == 2
 
     @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing', 'detail': {'publicIp': '123.456.789.0'}}, {'name': 'one_other_thing', 'detail': {'publicIp': '123.456.789.1'}}, {'name': 'third_thing', 'detail': {'publicIp': '123.456.789.2'}}])
     @mock.patch('src.cloudssh.confirm', return_value=True)
@@ -411,7 +1370,76 @@ class Test(BaseTest):
         finally:
             sys.stdout = saved_stdout
 
-    def test_search_no_result(self):
+    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[
+        {'name': 'web', 'detail': {'id': 'i-1', 'public_ip': '10.0.0.1', 'private_ip': '10.0.1.1'}},
+        {'name': 'web#01', 'detail': {'id': 'i-2', 'public_ip': '10.0.0.2'}},
+        {'name': 'web#02', 'detail': {'id': 'i-3', 'private_ip': '10.0.1.3'}},
+        {'name': 'web-other', 'detail': {'id': 'i-4'}}])
+    def test_get_duplicate_records(self, mock_index):
+
+        assert [i['name'] for i in cloudssh.get_duplicate_records('WEB')] == [
+            'web', 'web#01', 'web#02']
+        assert [i['name'] for i in cloudssh.get_records(['web#02', 'web', 'nope'])] == [
+            'web#02', 'web']
+
+    @mock.patch('src.probe.probe', return_value={'10.0.0.1': None, '10.0.1.1': 0.030, '10.0.0.2': None, '10.0.1.3': 0.005})
+    def test_probe_records(self, mock_probe):
+
+        records = [
+            {'name': 'web', 'detail': {'public_ip': '10.0.0.1', 'private_ip': '10.0.1.1'}},
+            {'name': 'web#01', 'detail': {'public_ip': '10.0.0.2'}},
+            {'name': 'web#02', 'detail': {'private_ip': '10.0.1.3'}},
+        ]
+
+        results = cloudssh.probe_records(records)
+        assert [(i['name'], i['reachable'], i['latency'], i['ip']) for i in results] == [
+            ('web#02', True, 0.005, '10.0.1.3'),
+            ('web', True, 0.030, '10.0.1.1'),
+            ('web#01', False, None, None),
+        ]
+
+        # Every address is probed at once
+        mock_probe.assert_called_once_with(
+            {'10.0.0.1', '10.0.1.1', '10.0.0.2', '10.0.1.3'}, timeout=1.0)
+
+    @mock.patch('src.cloudssh.confirm', return_value=True)
+    @mock.patch('src.probe.probe', return_value={'10.0.0.1': 0.012, '10.0.0.2': None})
+    def test_select_reachable(self, mock_probe, mock_confirm):
+
+        records = [
+            {'name': 'web', 'detail': {'id': 'i-1', 'public_ip': '10.0.0.2'}},
+            {'name': 'web#01', 'detail': {'id': 'i-2', 'public_ip': '10.0.0.1'}},
+        ]
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            assert cloudssh.select_reachable(records) == (
+                'index', {'id': 'i-2', 'public_ip': '10.0.0.1'})
+            assert out.getvalue() == 'Results:\n* web#01 (12.0 ms via 10.0.0.1)\n* web (unreachable)\n'
+            mock_confirm.assert_called_once_with(
+                'Fastest reachable: "web#01", continue?', True)
+
+            # Nothing reachable
+            mock_probe.return_value = {'10.0.0.1': None, '10.0.0.2': None}
+            self.assertRaises(SystemExit, cloudssh.select_reachable, records)
+            assert out.getvalue().endswith('No reachable instance!\n')
+        finally:
+            sys.stdout = saved_stdout
+
+    @mock.patch.object(cloudssh, 'select_reachable', return_value=('index', {'id': 'i-1'}))
+    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing', 'detail': {}}, {'name': 'one_other_thing', 'detail': {}}])
+    def test_search_probe(self, mock_index, mock_select):
+
+        assert cloudssh.search(query='thing', probe=True) == (
+            'index', {'id': 'i-1'})
+        mock_select.assert_called_once_with(
+            [{'name': 'one_thing', 'detail': {}}, {'name': 'one_other_thing', 'detail': {}}])
+
+    @mock.patch.object(cloudssh, 'aws_search', return_value=[])
+    def test_search_no_result(self, mock_aws):
         saved_stdout = sys.stdout
         try:
             out = StringIO()
@@ -426,6 +1454,71 @@ class Test(BaseTest):
         finally:
             sys.stdout = saved_stdout
 
+    @mock.patch('src.cloudssh.confirm', return_value=True)
+    def test_fuzzy_search(self, mock_args):
+
+        instances = [
+            {'name': 'web-http-prod', 'detail': {'id': 'i-1'}},
+            {'name': 'web-http-staging', 'detail': {'id': 'i-2'}},
+            {'name': 'db-prod', 'detail': {'id': 'i-3'}},
+        ]
+
+        # The search index is written with the index
+        cloudssh.save_regions({(None, 'us-east-1'): instances})
+        assert os.path.isfile(cloudssh.get_search_index_path())
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            # Typo in the query, best match first
+            assert cloudssh.fuzzy_search(
+                'web-htp-prod') == ('index', {'id': 'i-1'})
+            assert out.getvalue().startswith(
+                'Results:\n* web-http-prod\n')
+
+            # No result
+            self.assertRaises(SystemExit, cloudssh.fuzzy_search, 'zzzz')
+        finally:
+            sys.stdout = saved_stdout
+
+    @mock.patch('src.cloudssh.confirm', return_value=True)
+    def test_tag_search(self, mock_args):
+
+        instances = [
+            {'name': 'web-1', 'detail': {'id': 'i-1', 'tags': [{'Key': 'env', 'Value': 'prod'}, {'Key': 'role', 'Value': 'web'}]}},
+            {'name': 'web-2', 'detail': {'id': 'i-2', 'tags': [{'Key': 'env', 'Value': 'dev'}, {'Key': 'role', 'Value': 'web'}]}},
+        ]
+        cloudssh.save_regions({(None, 'us-east-1'): instances})
+
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            # One result
+            assert cloudssh.tag_search([('env', '=', 'prod')]) == (
+                'index', instances[0]['detail'])
+
+            # Multiple results
+            self.assertRaises(SystemExit, cloudssh.tag_search,
+                              [('role', '=', 'web')])
+            assert out.getvalue() == 'Results:\n* web-1\n* web-2\n'
+
+            # No result
+            self.assertRaises(SystemExit, cloudssh.tag_search,
+                              [('role', '=', 'db')])
+        finally:
+            sys.stdout = saved_stdout
+
+    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing'}, {'name': 'other_thing'}])
+    def test_get_search_index(self, mock_args):
+
+        # Built from the index when there is no search index file
+        assert cloudssh.get_search_index()['names'] == [
+            'one_thing', 'other_thing']
+
     def test_confirm(self):
         with mock.patch('builtins.input', return_value='y'):
             self.assertTrue(cloudssh.confirm())
@@ -448,15 +1541,10 @@ class Test(BaseTest):
         cloudssh.region = 'us-east-1'
 
         # Write test index
-        cloudssh.write_index(
-            filename=filename,
-            content={
-                'cloud_ssh_unittest': {
-                    'us-west-1': [{'name': 'name_123'}],
-                    'us-east-1': [{'name': 'name_1'}, {'name': 'name_2'}],
-                }
-            }
-        )
+        cloudssh.save_regions({
+            (None, 'us-west-1'): [{'name': 'name_123'}],
+            (None, 'us-east-1'): [{'name': 'name_1'}, {'name': 'name_2'}],
+        }, filename)
 
         assert cloudssh.get_instances_list_from_index(filename=filename) == [
             {'name': 'name_1'}, {'name': 'name_2'}]
@@ -468,7 +1556,7 @@ class Test(BaseTest):
 
         assert cloudssh.get_instances_list_from_index(filename=filename) == []
 
-    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing'}, {'name': 'one_other_thing'}, {'name': 'third_thing'}, {'name': 'with space'}])
+    @mock.patch.object(cloudssh, 'get_names_from_index', return_value=['one_thing', 'one_other_thing', 'third_thing', 'with space'])
     @mock.patch('readline.get_line_buffer', return_value='one')
     def test_autocomplete(self, mock_args, mock_args_2):
 
@@ -477,20 +1565,20 @@ class Test(BaseTest):
             'on', state=1) == 'one_other_thing'
         assert cloudssh.autocomplete('on', state=2) is None
 
-    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing'}, {'name': 'one_other_thing'}, {'name': 'third_thing'}, {'name': 'with space'}])
+    @mock.patch.object(cloudssh, 'get_names_from_index', return_value=['one_thing', 'one_other_thing', 'third_thing', 'with space'])
     @mock.patch('readline.get_line_buffer', return_value='with ')
     def test_autocomplete_2(self, mock_args, mock_args_2):
 
         assert cloudssh.autocomplete('on', state=0) == 'space'
 
-    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing'}, {'name': 'one_other_thing'}, {'name': 'third_thing'}])
+    @mock.patch.object(cloudssh, 'get_names_from_index', return_value=['one_thing', 'one_other_thing', 'third_thing'])
     @mock.patch('readline.get_line_buffer', return_value='ONE')
     def test_autocomplete_3(self, mock_args, mock_args_2):
 
         assert cloudssh.autocomplete(
             'on', state=0, is_case_sensitive=True) is None
 
-    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing'}, {'name': 'one_other_thing'}, {'name': 'third_thing'}])
+    @mock.patch.object(cloudssh, 'get_names_from_index', return_value=['one_thing', 'one_other_thing', 'third_thing'])
     @mock.patch('readline.get_line_buffer', return_value='ONE')
     def test_autocomplete_4(self, mock_args, mock_args_2):
 
@@ -499,7 +1587,47 @@ class Test(BaseTest):
             'on', state=1) == 'one_other_thing'
         assert cloudssh.autocomplete('on', state=2) is None
 
-    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing'}, {'name': 'one_other_thing'}, {'name': 'third_thing'}])
+    def test_get_names_from_index(self):
+
+        cloudssh.save_regions({
+            (None, 'us-east-1'): [{'name': 'web-2', 'detail': {}}, {'name': 'Web-1', 'detail': {}}],
+        })
+
+        assert cloudssh.get_names_from_index() == ['Web-1', 'web-2']
+        assert cloudssh.get_names_from_index(region_name='eu-west-1') == []
+
+    def test_get_completion_names(self):
+
+        filename = cloudssh.get_index_filename()
+        cloudssh.save_regions({
+            (None, 'us-east-1'): [{'name': 'web-2'}, {'name': 'Web-1'}, {'name': 'db'}],
+        }, filename)
+
+        cache = cloudssh.get_completion_names()
+        assert cache['names'] == ['Web-1', 'db', 'web-2']
+        assert cache['folded'][0] == ['db', 'web-1', 'web-2']
+
+        # The index is not read again until it changes
+        with mock.patch.object(cloudssh, 'get_names_from_index') as mock_list:
+            cloudssh.get_completion_names()
+            mock_list.assert_not_called()
+
+        cloudssh.save_regions({(None, 'us-east-1'): [{'name': 'db'}]}, filename)
+        os.utime(cloudssh.config_dir + filename, ns=(0, 0))
+        assert cloudssh.get_completion_names()['names'] == ['db']
+
+    @mock.patch.object(cloudssh, 'get_names_from_index', return_value=['Web-1', 'db', 'web-2', 'web-10'])
+    def test_complete_prefix(self, mock_args):
+
+        # Results are returned in index order
+        assert cloudssh.complete_prefix('web') == ['web-1', 'web-2', 'web-10']
+        assert cloudssh.complete_prefix(
+            'web', is_case_sensitive=True) == ['web-2', 'web-10']
+        assert cloudssh.complete_prefix('') == [
+            'web-1', 'db', 'web-2', 'web-10']
+        assert cloudssh.complete_prefix('x') == []
+
+    @mock.patch.object(cloudssh, 'get_names_from_index', return_value=['one_thing', 'one_other_thing', 'third_thing'])
     @mock.patch('builtins.input', return_value='some_value')
     def test_get_input_autocomplete(self, mock_args, mock_args_2):
 
@@ -511,6 +1639,181 @@ class Test(BaseTest):
         assert cloudssh.instance_lookup(
             'one_thing') == ('index', {'public_ip': '123.456.789.0'})
 
+    @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[
+        {'name': 'web-1', 'detail': {'public_ip': '1.2.3.4', 'private_ip': '10.0.0.1'}},
+        {'name': 'web-2', 'detail': {'private_ip': '100.64.0.2'}}])
+    def test_index_lookup_ip(self, mock_args):
+
+        # Public or private IP address of an indexed instance
+        assert cloudssh.index_lookup('1.2.3.4') == {'public_ip': '1.2.3.4', 'private_ip': '10.0.0.1'}
+        assert cloudssh.index_lookup('100.64.0.2') == {'private_ip': '100.64.0.2'}
+        assert cloudssh.index_lookup('10.0.0.3') is None
+
+    def test_instance_lookup_index_no_boto3(self):
+
+        # Run in a new interpreter: boto3 is already imported by other tests
+        code = '''
+import sys
+from src import cloudssh
+cloudssh.config_dir = sys.argv[1]
+cloudssh.parse_user_config()
+cloudssh.set_region()
+cloudssh.save_regions({(None, 'us-east-1'): [{'name': 'web-1', 'detail': {'id': 'i-1'}}]})
+assert cloudssh.instance_lookup('web-1') == ('index', {'id': 'i-1'})
+print(sorted(m for m in ('boto3', 'botocore', 'readline') if m in sys.modules))
+'''
+        result = subprocess.run(
+            [sys.executable, '-c', code, cloudssh.config_dir],
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+            stdout=subprocess.PIPE, check=True)
+
+        assert result.stdout.decode().strip() == '[]'
+
+    @mock.patch.object(cloudssh, 'get_aws_client')
+    @mock.patch.object(cloudssh, 'aws_lookup')
+    def test_instance_lookup_cache(self, mock_lookup, mock_client):
+
+        mock_lookup.return_value = {'Reservations': self.fake_reservations}
+        detail = cloudssh.get_instance_infos(self.fake_reservations)
+
+        # The second lookup is served by the cache
+        assert cloudssh.instance_lookup('i-b929323f777f4c016d') == ('aws', detail)
+        assert cloudssh.instance_lookup('i-b929323f777f4c016d') == ('cache', detail)
+        mock_lookup.assert_called_once()
+
+        # Misses are cached too
+        mock_lookup.return_value = {'Reservations': []}
+        saved_stdout = sys.stdout
+        try:
+            out = StringIO()
+            sys.stdout = out
+
+            self.assertRaises(SystemExit, cloudssh.instance_lookup, 'i-typo')
+            self.assertRaises(SystemExit, cloudssh.instance_lookup, 'i-typo')
+            assert out.getvalue() == 'No instance found matching this input.\n' * 2
+        finally:
+            sys.stdout = saved_stdout
+        assert mock_lookup.call_count == 2
+
+    def test_lookup_cache_ttl(self):
+
+        cloudssh.cache_lookup('web', {'id': 'i-1'}, now=1000)
+        cloudssh.cache_lookup('typo', None, now=1000)
+
+        assert cloudssh.get_cached_lookup('web', now=1029) == (True, {'id': 'i-1'})
+        assert cloudssh.get_cached_lookup('typo', now=1029) == (True, None)
+
+        # Misses expire first
+        assert cloudssh.get_cached_lookup('web', now=1030) == (True, {'id': 'i-1'})
+        assert cloudssh.get_cached_lookup('typo', now=1030) == (False, None)
+        assert cloudssh.get_cached_lookup('web', now=1300) == (False, None)
+
+        # Per profile/region
+        cloudssh.set_region('eu-west-1')
+        assert cloudssh.get_cached_lookup('web', now=1001) == (False, None)
+
+        # Expired entries are dropped on write
+        cloudssh.cache_lookup('other', None, now=2000)
+        assert list(cloudssh.read_lookup_cache()) == [
+            'cloud_ssh_unittest/eu-west-1/other']
+
+    @mock.patch.object(cloudssh, 'get_lookup_cache_size', return_value=2)
+    def test_lookup_cache_lru(self, mock_size):
+
+        cloudssh.cache_lookup('a', {'id': 'i-a'}, now=1000)
+        cloudssh.cache_lookup('b', {'id': 'i-b'}, now=1001)
+
+        # A hit only writes the cache to refresh a recency older than a minute
+        with mock.patch.object(cloudssh, 'write_lookup_cache') as mock_write:
+            assert cloudssh.get_cached_lookup('a', now=1030) == (True, {'id': 'i-a'})
+            mock_write.assert_not_called()
+        cloudssh.get_cached_lookup('a', now=1100)
+        assert cloudssh.read_lookup_cache()['cloud_ssh_unittest/us-east-1/a']['used_at'] == 1100
+
+        # `b` is the least recently used
+        cloudssh.cache_lookup('c', {'id': 'i-c'}, now=1101)
+        assert sorted(cloudssh.read_lookup_cache()) == [
+            'cloud_ssh_unittest/us-east-1/a', 'cloud_ssh_unittest/us-east-1/c']
+
+    @mock.patch.dict(cloudssh.timings, {'phases': [], 'depth': 0, 'aws': {'requests': 0, 'retries': 0, 'bytes': 0}})
+    def test_timed_phase(self):
+
+        with cloudssh.timed_phase('outer'):
+            with cloudssh.timed_phase('inner') as entry:
+                assert entry['seconds'] is None
+
+        assert [(e['phase'], e['depth']) for e in cloudssh.timings['phases']] == [
+            ('outer', 0), ('inner', 1)]
+        assert cloudssh.timings['phases'][0]['seconds'] >= cloudssh.timings['phases'][1]['seconds'] >= 0
+        assert cloudssh.timings['depth'] == 0
+
+        report = cloudssh.get_timings_report().split('\n')
+        assert report[1].startswith('outer ')
+        assert report[2].startswith('  inner ')
+        assert report[3].startswith('Total ')
+        assert report[4] == 'AWS requests: 0, retries: 0, bytes: 0'
+
+        # JSON lines log
+        log_path = cloudssh.config_dir + 'trace.log'
+        cloudssh.report_timings(log_path=log_path)
+        cloudssh.report_timings(log_path=log_path)
+        with open(log_path) as f:
+            lines = [json.loads(line) for line in f]
+        assert len(lines) == 2
+        assert [e['phase'] for e in lines[0]['phases']] == ['outer', 'inner']
+        assert lines[0]['region'] == 'us-east-1'
+
+    @mock.patch.dict(cloudssh.timings, {'phases': [], 'depth': 0, 'aws': {'requests': 0, 'retries': 0, 'bytes': 0}})
+    def test_timed_phase_threads(self):
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(i):
+            with cloudssh.timed_phase('get_aws_client'):
+                with cloudssh.timed_phase('describe_instances'):
+                    time.sleep(0.01)
+
+        with cloudssh.timed_phase('fetch'):
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                list(executor.map(fetch, range(16)))
+
+        # Aggregated under the phase of the main thread
+        assert [(e['phase'], e['depth'], e.get('count')) for e in cloudssh.timings['phases']] == [
+            ('fetch', 0, None), ('get_aws_client', 1, 16), ('describe_instances', 2, 16)]
+        assert cloudssh.timings['phases'][2]['seconds'] >= 0.16
+        assert cloudssh.timings['depth'] == 0
+
+        report = cloudssh.get_timings_report().split('\n')
+        assert report[2].startswith('  get_aws_client (x16) ')
+        assert report[3].startswith('    describe_instances (x16) ')
+
+    @mock.patch.dict(cloudssh.timings, {'phases': [], 'depth': 0, 'aws': {'requests': 0, 'retries': 0, 'bytes': 0}})
+    def test_count_aws_calls(self):
+
+        import boto3
+        from botocore.stub import Stubber
+
+        client = cloudssh.count_aws_calls(boto3.client(
+            'ec2', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test'))
+        with Stubber(client) as stubber:
+            stubber.add_response('describe_instances', {
+                'Reservations': [], 'ResponseMetadata': {'RetryAttempts': 2}})
+            stubber.add_response('describe_instances', {'Reservations': []})
+            client.describe_instances()
+            client.describe_instances()
+
+        assert cloudssh.timings['aws'] == {
+            'requests': 2, 'retries': 2, 'bytes': 0}
+
+    def test_daemon_request(self):
+
+        # Daemon not running
+        assert cloudssh.daemon_request({'op': 'lookup', 'instance': 'web'}) is None
+
+        # Stale socket file
+        open(cloudssh.get_daemon_socket_path(), 'w').close()
+        assert cloudssh.daemon_request({'op': 'lookup', 'instance': 'web'}) is None
+
     @mock.patch.object(cloudssh, 'get_instances_list_from_index', return_value=[{'name': 'one_thing', 'detail': {'public_ip': '123.456.789.0'}}, {'name': 'one_other_thing', 'detail': {'public_ip': '123.456.789.1'}}, {'name': 'third_thing', 'detail': {'public_ip': '123.456.789.2'}}])
     def test_instance_lookup_aws(self, mock_args):
 
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import subprocess
+
+from .base import BaseTest
+from .. import completion
+
+
+class Test(BaseTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.names_path = os.path.join(self.tmp_dir.name, 'names')
+
+        with open(self.names_path, 'w') as f:
+            f.write('api-1\nweb#01\nweb-1\nweb-2\nworker\n')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_script(self):
+
+        for shell in ['bash', 'zsh', 'fish']:
+            script = completion.get_script(shell, self.names_path)
+            assert self.names_path in script
+            assert 'cssh cloudssh' in script
+
+        self.assertRaises(ValueError, completion.get_script,
+                          'tcsh', self.names_path)
+
+    def test_bash(self):
+
+        if not shutil.which('bash'):
+            self.skipTest('bash is not installed')
+
+        code = completion.get_script('bash', self.names_path) + '''
+COMP_WORDS=(cssh web); COMP_CWORD=1; _cloudssh; printf '%s\\n' "${COMPREPLY[@]}"
+COMP_WORDS=(cssh --re); COMP_CWORD=1; COMPREPLY=(); _cloudssh; echo "${#COMPREPLY[@]}"
+'''
+        result = subprocess.run(
+            ['bash', '-c', code], stdout=subprocess.PIPE, check=True)
+
+        assert result.stdout.decode() == 'web#01\nweb-1\nweb-2\n0\n'
@@ -0,0 +1,106 @@
+import tempfile
+import threading
+from unittest import mock
+
+from .base import BaseTest
+from .. import cloudssh, daemon
+
+
+class Test(BaseTest):
+
+    instances_list = [
+        {'name': 'web-2', 'detail': {'id': 'i-2', 'public_ip': '1.2.3.5'}},
+        {'name': 'Web-1', 'detail': {'id': 'i-1', 'public_ip': '1.2.3.4'}},
+        {'name': 'db', 'detail': {'id': 'i-3', 'public_ip': '1.2.3.6'}},
+    ]
+
+    def setUp(self):
+        self.tmp_config_dir = tempfile.TemporaryDirectory()
+        cloudssh.config_dir = self.tmp_config_dir.name + '/'
+        cloudssh.user_config = None
+        cloudssh.set_region()
+        daemon.regions_cache.clear()
+        daemon.clients.clear()
+
+        cloudssh.save_regions({('default', 'us-east-1'): self.instances_list})
+
+        # Run the daemon in a thread
+        self.server = daemon.Server(
+            cloudssh.get_daemon_socket_path(), daemon.RequestHandler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmp_config_dir.cleanup()
+
+    def test_lookup(self):
+
+        assert cloudssh.index_lookup('web-1') == {
+            'id': 'i-1', 'public_ip': '1.2.3.4'}
+        assert cloudssh.index_lookup('i-3') == {
+            'id': 'i-3', 'public_ip': '1.2.3.6'}
+
+        # Served from the daemon memory, the index is not read again
+        with mock.patch.object(cloudssh, 'get_instances_list_from_index') as mock_list:
+            assert cloudssh.index_lookup('1.2.3.6') == {
+                'id': 'i-3', 'public_ip': '1.2.3.6'}
+            assert cloudssh.index_lookup('web-3') is None
+            assert cloudssh.index_lookup('WEB-2') == {
+                'id': 'i-2', 'public_ip': '1.2.3.5'}
+            mock_list.assert_not_called()
+
+    def test_get_region(self):
+
+        cached = daemon.get_region('default', 'us-east-1')
+        assert [i['name'] for i in cached['instances_list']] == [
+            'Web-1', 'db', 'web-2']
+
+        # Cached until the index changes
+        assert daemon.get_region('default', 'us-east-1') is cached
+
+        cloudssh.save_regions({('default', 'us-east-1'): self.instances_list[:1]})
+        cloudssh.os.utime(cloudssh.config_dir + 'index.json', ns=(0, 0))
+        assert [i['name'] for i in daemon.get_region(
+            'default', 'us-east-1')['instances_list']] == ['web-2']
+
+    def test_search(self):
+
+        response = cloudssh.daemon_request({'op': 'search', 'query': 'WEB'})
+        assert [i['name'] for i in response['matches']] == ['Web-1', 'web-2']
+
+    def test_complete(self):
+
+        assert cloudssh.complete_prefix('web') == ['web-1', 'web-2']
+        assert cloudssh.complete_prefix('web', is_case_sensitive=True) == [
+            'web-2']
+
+    @mock.patch.object(cloudssh, 'get_aws_client')
+    def test_describe(self, mock_client):
+
+        reservations = [{'Instances': [{'InstanceId': 'i-4', 'PublicIpAddress': '1.2.3.7',
+                                        'LaunchTime': cloudssh.time.gmtime(0)}]}]
+        mock_client.return_value.describe_instances.return_value = {
+            'Reservations': reservations}
+
+        assert cloudssh.instance_lookup('i-4')[1]['public_ip'] == '1.2.3.7'
+        assert cloudssh.instance_lookup('i-4')[1]['public_ip'] == '1.2.3.7'
+
+        # The client is created once and kept warm, with the default credentials
+        mock_client.assert_called_once_with(
+            region_name='us-east-1', profile_name=None)
+
+        # Named profiles
+        daemon.get_client('prod', 'eu-west-1')
+        mock_client.assert_called_with(
+            region_name='eu-west-1', profile_name='prod')
+
+    def test_error(self):
+
+        # Unknown operation: the client falls back to in-process
+        assert cloudssh.daemon_request({'op': 'invalid'}) is None
+        assert daemon.handle({'op': 'invalid', 'profile': 'default', 'region': 'us-east-1'}) == {
+            'error': 'Unknown operation invalid'}
@@ -0,0 +1,57 @@
+import os
+from unittest import mock
+
+from .base import BaseTest, EngineTest
+from .. import index_mmap
+
+
+class Test(EngineTest, BaseTest):
+
+    engine = index_mmap
+
+    def test_read_names(self):
+
+        # Records are not decoded
+        with mock.patch.object(index_mmap, 'read_record') as mock_record:
+            assert index_mmap.read_names(self.path, 'prod', 'us-east-1') == ['Web-1', 'web-2']
+        mock_record.assert_not_called()
+
+    def test_write_regions(self):
+
+        # A failed write leaves the index and no temporary file
+        with mock.patch.object(index_mmap, 'pack_section', side_effect=RuntimeError('full')):
+            self.assertRaises(RuntimeError, index_mmap.write_regions, self.path, {
+                ('prod', 'us-west-1'): (self.instances_list, 3000)})
+        with mock.patch.object(index_mmap.os, 'replace', side_effect=OSError('full')):
+            self.assertRaises(OSError, index_mmap.write_regions, self.path, {
+                ('prod', 'us-west-1'): (self.instances_list, 3000)})
+        assert index_mmap.read_refreshed_at(self.path)['prod']['us-west-1'] == 2000
+        assert not [f for f in os.listdir(self.tmp_dir.name) if f.endswith('.tmp')]
+
+    def test_find_by(self):
+
+        # Only the records containing the value are decoded
+        with mock.patch.object(index_mmap, 'read_record', wraps=index_mmap.read_record) as mock_record:
+            assert index_mmap.find_by(
+                self.path, 'prod', 'us-east-1', 'private_ip', '10.0.0.2') == [self.instances_list[0]]
+        assert mock_record.call_count == 1
+
+    def test_open_index(self):
+
+        # Missing file
+        assert index_mmap.open_index(self.tmp_dir.name + '/missing') == (None, {})
+
+        # Not an index
+        invalid = self.tmp_dir.name + '/invalid'
+        with open(invalid, 'wb') as f:
+            f.write(b'{"a": true}')
+        self.assertRaises(RuntimeError, index_mmap.open_index, invalid)
+
+    def test_pack_section(self):
+
+        content = index_mmap.pack_section(self.instances_list)
+
+        assert index_mmap.read_count(content, 0) == 2
+        entry = index_mmap.read_entry(content, 0, 0)
+        assert index_mmap.read_name(content, 0, entry) == 'Web-1'
+        assert index_mmap.read_record(content, 0, entry) == self.instances_list[1]
@@ -0,0 +1,45 @@
+import os
+
+from .base import BaseTest, EngineTest
+from .. import index_sharded
+
+
+class Test(EngineTest, BaseTest):
+
+    engine = index_sharded
+
+    def test_get_shard_path(self):
+
+        assert index_sharded.get_shard_path(self.path, 'prod', 'us-east-1') == \
+            self.path + '/prod.us-east-1.json'
+        assert index_sharded.get_shard_path(self.path, '../a b', 'us-east-1') == \
+            self.path + '/..%2Fa%20b.us-east-1.json'
+
+    def test_write_regions(self):
+
+        shard_path = index_sharded.get_shard_path(self.path, 'prod', 'us-east-1')
+        other_shard_mtime = os.stat(index_sharded.get_shard_path(
+            self.path, 'prod', 'us-west-1')).st_mtime_ns
+
+        # Replace a region, the other shards are untouched
+        index_sharded.write_regions(self.path, {
+            ('prod', 'us-east-1'): (self.instances_list[:1], 3000),
+        })
+        assert os.stat(index_sharded.get_shard_path(
+            self.path, 'prod', 'us-west-1')).st_mtime_ns == other_shard_mtime
+
+        # Only update the refresh timestamp
+        shard_mtime = os.stat(shard_path).st_mtime_ns
+        index_sharded.write_regions(self.path, {
+            ('prod', 'us-east-1'): (None, 4000),
+        })
+        assert os.stat(shard_path).st_mtime_ns == shard_mtime
+        assert index_sharded.read_manifest(self.path)['prod']['us-east-1'] == {
+            'count': 1, 'refreshed_at': 4000}
+
+        # No temporary file left
+        assert not [f for f in os.listdir(self.path) if f.endswith('.tmp')]
+
+    def test_read_refreshed_at(self):
+
+        assert index_sharded.read_refreshed_at(self.tmp_dir.name + '/missing') == {}
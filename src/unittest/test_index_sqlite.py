@@ -0,0 +1,65 @@
+import copy
+import sqlite3
+
+from .base import BaseTest, EngineTest
+from .. import index_sqlite
+
+
+class Test(EngineTest, BaseTest):
+
+    engine = index_sqlite
+
+    def get_rows(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return dict(conn.execute('SELECT name, rowid FROM instances WHERE region = ?', ('us-east-1',)))
+        finally:
+            conn.close()
+
+    def test_write_regions(self):
+
+        rows = self.get_rows()
+
+        # Web-1 is modified, web-2 is unchanged, web-3 is new and has no ID
+        instances_list = copy.deepcopy(self.instances_list)
+        instances_list[1]['detail']['public_ip'] = '1.2.3.6'
+        instances_list.append({'name': 'web-3', 'detail': {'private_ip': '10.0.0.3'}})
+        index_sqlite.write_regions(self.path, {
+            ('prod', 'us-east-1'): (instances_list, 3000),
+        })
+
+        # Only the new instance got a new row
+        assert index_sqlite.read_region(self.path, 'prod', 'us-east-1') == [
+            instances_list[1], instances_list[0], instances_list[2]]
+        assert rows.items() < self.get_rows().items()
+        assert index_sqlite.find_by_tags(
+            self.path, 'prod', 'us-east-1', [('env', '=', 'dev')]) == [instances_list[1]]
+
+        # Removed instances and their tags
+        index_sqlite.write_regions(self.path, {
+            ('prod', 'us-east-1'): (instances_list[1:2], 4000),
+        })
+        assert index_sqlite.read_region(self.path, 'prod', 'us-east-1') == instances_list[1:2]
+        assert index_sqlite.find_by_tags(
+            self.path, 'prod', 'us-east-1', [('env', '=', 'prod')]) == []
+
+    def test_find_by_tags(self):
+
+        def find(*predicates):
+            return [i['name'] for i in index_sqlite.find_by_tags(self.path, 'prod', 'us-east-1', predicates)]
+
+        # Case insensitive exact match
+        assert find(('ENV', '=', 'Prod')) == ['web-2']
+        assert find(('env', '=', 'staging')) == []
+
+        # Globs
+        assert find(('name', '~', 'web-*')) == ['Web-1', 'web-2']
+        assert find(('name', '~', 'web-[!1]')) == ['web-2']
+
+        # Every predicate (AND)
+        assert find(('name', '~', 'web-*'), ('env', '=', 'dev')) == ['Web-1']
+        assert find(('name', '~', 'web-2'), ('env', '=', 'dev')) == []
+
+        # Other regions are not matched
+        assert index_sqlite.find_by_tags(
+            self.path, 'prod', 'us-west-1', [('env', '=', 'prod')]) == []
@@ -0,0 +1,137 @@
+import os
+import json
+import tempfile
+
+from .base import BaseTest
+from .. import index_stream
+
+
+class Test(BaseTest):
+
+    instances_list = [
+        {'name': 'web-1', 'detail': {'id': 'i-1', 'public_ip': '1.2.3.4', 'tags': [{'Key': 'Name', 'Value': 'web-1'}]}},
+        {'name': 'web-2', 'detail': {'id': 'i-2', 'public_ip': '1.2.3.5', 'tags': [{'Key': 'Name', 'Value': 'web-2'}]}},
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = self.tmp_dir.name + '/index.json'
+
+        index_stream.write_regions(self.path, {
+            ('prod', 'us-east-1'): (self.instances_list, 1000),
+            ('prod', 'us-west-1'): ([], 2000),
+        })
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_layout(self):
+
+        lines = self.read().splitlines()
+
+        # One instance per line
+        assert json.loads(lines[3].rstrip(',')) == self.instances_list[0]
+        assert json.loads(lines[4]) == self.instances_list[1]
+
+        # Regular JSON
+        assert json.loads(self.read()) == {
+            'prod': {'us-east-1': self.instances_list, 'us-west-1': []},
+            '_refreshed_at': {'prod': {'us-east-1': 1000, 'us-west-1': 2000}},
+        }
+
+    def test_write_regions(self):
+
+        # Generator, new profile, timestamp only
+        index_stream.write_regions(self.path, {
+            ('prod', 'us-west-1'): ((i for i in self.instances_list[:1]), 3000),
+            ('dev', 'eu-west-1'): (self.instances_list[1:], 4000),
+            ('prod', 'us-east-1'): (None, 5000),
+        })
+
+        assert json.loads(self.read()) == {
+            'prod': {'us-east-1': self.instances_list, 'us-west-1': self.instances_list[:1]},
+            'dev': {'eu-west-1': self.instances_list[1:]},
+            '_refreshed_at': {'prod': {'us-east-1': 5000, 'us-west-1': 3000}, 'dev': {'eu-west-1': 4000}},
+        }
+
+        # New region of an existing profile
+        index_stream.write_regions(self.path, {
+            ('dev', 'eu-central-1'): ([], 6000),
+        })
+
+        assert json.loads(self.read())['dev'] == {
+            'eu-west-1': self.instances_list[1:], 'eu-central-1': []}
+
+    def test_write_regions_legacy(self):
+
+        # Index written in one line by older versions
+        with open(self.path, 'w') as f:
+            json.dump({'prod': {'us-east-1': self.instances_list}, '_refreshed_at': {'prod': {'us-east-1': 1000}}}, f)
+
+        assert index_stream.read_region(self.path, 'prod', 'us-east-1') == self.instances_list
+
+        index_stream.write_regions(self.path, {
+            ('prod', 'us-west-1'): (self.instances_list[:1], 2000),
+        })
+
+        assert self.read().startswith('{\n')
+        assert json.loads(self.read()) == {
+            'prod': {'us-east-1': self.instances_list, 'us-west-1': self.instances_list[:1]},
+            '_refreshed_at': {'prod': {'us-east-1': 1000, 'us-west-1': 2000}},
+        }
+
+    def test_write_regions_no_index(self):
+
+        path = self.tmp_dir.name + '/new.json'
+        index_stream.write_regions(path, {('prod', 'us-east-1'): ([], 1000)})
+
+        assert json.loads(open(path).read()) == {
+            'prod': {'us-east-1': []}, '_refreshed_at': {'prod': {'us-east-1': 1000}}}
+
+    def test_write_regions_error(self):
+
+        def pages():
+            yield self.instances_list[0]
+            raise RuntimeError('RequestLimitExceeded')
+
+        # The index is left untouched and the temporary file removed
+        content = self.read()
+        with self.assertRaises(RuntimeError):
+            index_stream.write_regions(self.path, {('prod', 'us-east-1'): (pages(), 3000)})
+
+        assert self.read() == content
+        assert os.listdir(self.tmp_dir.name) == ['index.json']
+
+    def test_read_regions(self):
+
+        assert index_stream.read_regions(self.path) == [
+            ('prod', 'us-east-1'), ('prod', 'us-west-1')]
+
+    def test_read_region(self):
+
+        assert index_stream.read_region(
+            self.path, 'prod', 'us-east-1') == self.instances_list
+        assert index_stream.read_region(self.path, 'prod', 'us-west-1') == []
+        assert index_stream.read_region(self.path, 'prod', 'eu-west-1') == []
+        assert index_stream.read_region(
+            self.tmp_dir.name + '/missing.json', 'prod', 'us-east-1') == []
+
+    def test_read_names(self):
+
+        assert index_stream.read_names(
+            self.path, 'prod', 'us-east-1') == ['web-1', 'web-2']
+        assert index_stream.read_names(self.path, 'prod', 'eu-west-1') == []
+
+        # Name not written first
+        assert index_stream.read_name('{"detail": {}, "name": "web-3"}') == 'web-3'
+
+    def test_read_refreshed_at(self):
+
+        assert index_stream.read_refreshed_at(self.path) == {
+            'prod': {'us-east-1': 1000, 'us-west-1': 2000}}
+        assert index_stream.read_refreshed_at(
+            self.tmp_dir.name + '/missing.json') == {}
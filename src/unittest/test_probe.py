@@ -0,0 +1,44 @@
+import socket
+
+from .base import BaseTest
+from .. import probe
+
+
+class Test(BaseTest):
+
+    def setUp(self):
+        # Listening port
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(8)
+        self.open_port = self.server.getsockname()[1]
+
+        # Port without listener
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        self.closed_port = sock.getsockname()[1]
+        sock.close()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_probe(self):
+
+        results = probe.probe(['127.0.0.1'], port=self.open_port)
+        assert list(results) == ['127.0.0.1']
+        assert results['127.0.0.1'] is not None
+        assert results['127.0.0.1'] >= 0
+
+    def test_probe_refused(self):
+
+        assert probe.probe(['127.0.0.1'], port=self.closed_port, timeout=0.5) == {
+            '127.0.0.1': None}
+
+    def test_probe_timeout(self):
+
+        # TEST-NET-1 is never routed: unreachable or timed out
+        assert probe.probe(['192.0.2.1'], timeout=0.05) == {'192.0.2.1': None}
+
+    def test_probe_empty(self):
+
+        assert probe.probe([]) == {}
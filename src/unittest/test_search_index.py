@@ -0,0 +1,103 @@
+import tempfile
+
+from .base import BaseTest
+from .. import search_index
+
+
+class Test(BaseTest):
+
+    names = ['web-http-prod', 'web-http-staging', 'api-web-prod',
+             'db-prod', 'WEB', 'mywebserver', 'cache-prod']
+
+    tags = {
+        'web-http-prod': {'env': 'prod', 'role': 'web', 'zone': 'us-east-1a'},
+        'web-http-staging': {'env': 'staging', 'role': 'web', 'zone': 'us-east-1b'},
+        'api-web-prod': {'Env': 'Prod', 'role': 'api', 'zone': 'us-east-1b'},
+        'db-prod': {'env': 'prod', 'role': 'db', 'zone': 'us-west-2a'},
+    }
+
+    def setUp(self):
+        self.search_index = search_index.build(
+            [{'name': name, 'detail': {'tags': [{'Key': k, 'Value': v} for k, v in self.tags.get(name, {}).items()]}}
+             for name in self.names])
+
+    def test_trigrams(self):
+
+        assert search_index.trigrams('Web') == {'  w', ' we', 'web', 'eb '}
+
+    def test_build(self):
+
+        assert self.search_index['names'] == sorted(self.names)
+
+        position = self.search_index['names'].index('db-prod')
+        assert position in self.search_index['trigrams']['db-']
+
+    def test_read_write(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = tmp_dir + '/search/index.json'
+
+            assert search_index.read(path) is None
+            assert search_index.write(path, self.search_index) is True
+            assert search_index.read(path) == self.search_index
+
+    def test_score(self):
+
+        # Exact > prefix > word boundary > contiguous
+        assert search_index.score('web', 'web', 3, 4) > search_index.score(
+            'web', 'web-http-prod', 3, 4)
+        assert search_index.score('web', 'web-http-prod', 3, 4) > search_index.score(
+            'web', 'api-web-prod', 3, 4)
+        assert search_index.score('web', 'api-web-prod', 3, 4) > search_index.score(
+            'web', 'mywebserver', 3, 4)
+
+    def test_fuzzy_search(self):
+
+        # Ranked results
+        assert search_index.fuzzy_search('web', self.search_index) == [
+            'WEB', 'web-http-prod', 'web-http-staging', 'api-web-prod', 'mywebserver']
+
+        # Typo tolerance
+        assert search_index.fuzzy_search(
+            'web-htp-prod', self.search_index)[0] == 'web-http-prod'
+        assert search_index.fuzzy_search(
+            'db-prdo', self.search_index)[0] == 'db-prod'
+
+        # Limit
+        assert len(search_index.fuzzy_search(
+            'web', self.search_index, limit=2)) == 2
+
+        # No match
+        assert search_index.fuzzy_search('zzzz', self.search_index) == []
+
+    def test_build_tags(self):
+
+        names = self.search_index['names']
+        assert sorted(names[p] for p in self.search_index['tags']['env']['prod']) == [
+            'api-web-prod', 'db-prod', 'web-http-prod']
+
+    def test_parse_tag_query(self):
+
+        assert search_index.parse_tag_query('env=prod Role~WEB* az~us-east-1*') == [
+            ('env', '=', 'prod'), ('role', '~', 'web*'), ('az', '~', 'us-east-1*')]
+        assert search_index.parse_tag_query('url=a~b') == [
+            ('url', '=', 'a~b')]
+
+        # Not a tag query
+        assert search_index.parse_tag_query('web-http') is None
+        assert search_index.parse_tag_query('env=prod web') is None
+        assert search_index.parse_tag_query('=prod') is None
+        assert search_index.parse_tag_query('') is None
+
+    def test_tag_search(self):
+
+        def query(q):
+            return search_index.tag_search(search_index.parse_tag_query(q), self.search_index)
+
+        assert query('env=prod') == ['api-web-prod', 'db-prod', 'web-http-prod']
+        assert query('env=prod role=web') == ['web-http-prod']
+        assert query('zone~us-east-1*') == ['api-web-prod',
+                                            'web-http-prod', 'web-http-staging']
+        assert query('env=prod zone~us-east-1*') == ['api-web-prod', 'web-http-prod']
+        assert query('env=dev') == []
+        assert query('owner=me') == []
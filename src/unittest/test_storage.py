@@ -0,0 +1,170 @@
+import os
+import tempfile
+import threading
+
+from .base import BaseTest, EngineTest
+from .. import storage, index_sqlite, index_mmap, index_sharded
+
+
+class EngineContract(EngineTest):
+    """ Behaviour shared by every index storage engine """
+
+    def test_read_names(self):
+
+        assert self.engine.read_names(self.path, 'prod', 'us-east-1') == ['Web-1', 'web-2']
+        assert self.engine.read_names(self.path, 'prod', 'us-west-1') == []
+        assert self.engine.read_names(self.path, 'dev', 'us-east-1') == []
+
+    def test_read_region(self):
+
+        # Sorted by name
+        assert self.engine.read_region(
+            self.path, 'prod', 'us-east-1') == [self.instances_list[1], self.instances_list[0]]
+
+        assert self.engine.read_region(self.path, 'prod', 'us-west-1') == []
+        assert self.engine.read_region(self.path, 'dev', 'us-east-1') == []
+
+    def test_write_regions(self):
+
+        # Replace a region
+        assert self.engine.write_regions(self.path, {
+            ('prod', 'us-east-1'): (self.instances_list[:1], 3000),
+        }) is True
+        assert self.engine.read_region(
+            self.path, 'prod', 'us-east-1') == self.instances_list[:1]
+        assert self.engine.find_by(
+            self.path, 'prod', 'us-east-1', 'id', 'i-1') == []
+
+        # Only update the refresh timestamp
+        self.engine.write_regions(self.path, {
+            ('prod', 'us-east-1'): (None, 4000),
+        })
+        assert self.engine.read_region(
+            self.path, 'prod', 'us-east-1') == self.instances_list[:1]
+        assert self.engine.read_refreshed_at(
+            self.path)['prod']['us-east-1'] == 4000
+
+    def test_write_regions_concurrently(self):
+
+        def write(region_name):
+            self.engine.write_regions(self.path, {
+                ('dev', region_name): (self.instances_list, 5000),
+            })
+
+        threads = [threading.Thread(target=write, args=('region-%d' % (i),))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # No region was lost
+        assert sorted(self.engine.read_refreshed_at(self.path)['dev']) == [
+            'region-%d' % (i) for i in range(8)]
+        assert self.engine.read_names(self.path, 'dev', 'region-7') == ['Web-1', 'web-2']
+        assert self.engine.read_refreshed_at(self.path)['prod'] == {'us-east-1': 1000, 'us-west-1': 2000}
+
+    def test_read_refreshed_at(self):
+
+        assert self.engine.read_refreshed_at(self.path) == {
+            'prod': {'us-east-1': 1000, 'us-west-1': 2000}
+        }
+
+    def test_lookup(self):
+
+        assert self.engine.lookup(
+            self.path, 'prod', 'us-east-1', 'WEB-1') == self.instances_list[1]
+        assert self.engine.lookup(
+            self.path, 'prod', 'us-east-1', 'web-3') is None
+        assert self.engine.lookup(
+            self.path, 'prod', 'us-west-1', 'web-1') is None
+
+    def test_find_by(self):
+
+        assert self.engine.find_by(
+            self.path, 'prod', 'us-east-1', 'id', 'i-2') == [self.instances_list[0]]
+        assert self.engine.find_by(
+            self.path, 'prod', 'us-east-1', 'public_ip', '1.2.3.4') == [self.instances_list[1]]
+        assert self.engine.find_by(
+            self.path, 'prod', 'us-east-1', 'private_ip', '10.0.0.1') == [self.instances_list[1]]
+        assert self.engine.find_by(
+            self.path, 'prod', 'us-east-1', 'private_ip', '10.0.0.3') == []
+        assert self.engine.find_by(
+            self.path, 'prod', 'us-west-1', 'id', 'i-2') == []
+
+        # Not an indexed field
+        self.assertRaises(ValueError, self.engine.find_by,
+                          self.path, 'prod', 'us-east-1', 'vpc', 'vpc-1')
+
+    def test_search(self):
+
+        assert self.engine.search(
+            self.path, 'prod', 'us-east-1', 'WEB') == [self.instances_list[1], self.instances_list[0]]
+        assert self.engine.search(
+            self.path, 'prod', 'us-east-1', '-2') == [self.instances_list[0]]
+        assert self.engine.search(
+            self.path, 'prod', 'us-east-1', 'db') == []
+
+
+class TestSqlite(EngineContract, BaseTest):
+
+    engine = index_sqlite
+
+
+class TestMmap(EngineContract, BaseTest):
+
+    engine = index_mmap
+
+
+class TestSharded(EngineContract, BaseTest):
+
+    engine = index_sharded
+
+
+class Test(BaseTest):
+
+    def test_find_by(self):
+
+        instances_list = EngineTest.instances_list
+
+        assert storage.find_by(instances_list, 'id', 'i-1') == [instances_list[1]]
+        assert storage.find_by(instances_list, 'public_ip', '1.2.3.6') == []
+        self.assertRaises(ValueError, storage.find_by,
+                          instances_list, 'vpc', 'vpc-1')
+
+    def test_lookup(self):
+
+        instances_list = EngineTest.instances_list
+
+        assert storage.lookup(instances_list, 'web-1') == instances_list[1]
+        assert storage.lookup(instances_list, 'web-3') is None
+
+    def test_search(self):
+
+        instances_list = EngineTest.instances_list
+
+        assert storage.search(instances_list, 'WEB') == instances_list
+        assert storage.search(instances_list, 'db') == []
+
+    def test_open_atomically(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'atomic')
+            with storage.open_atomically(path) as f:
+                f.write('content')
+
+            # Failed writes are discarded
+            with self.assertRaises(RuntimeError):
+                with storage.open_atomically(path) as f:
+                    f.write('partial')
+                    raise RuntimeError('AWS error')
+
+            with open(path) as f:
+                assert f.read() == 'content'
+            assert os.listdir(tmp_dir) == ['atomic']
+
+            # Binary files
+            with storage.open_atomically(path, 'wb') as f:
+                f.write(b'\x00')
+            with open(path, 'rb') as f:
+                assert f.read() == b'\x00'